@@ -100,12 +100,24 @@ exports.tiktokCallback = (req, res, next) => {
       // Remove any keys with `null` values
       Object.keys(tokens).forEach((key) => tokens[key] === null && delete tokens[key]);
 
+      // Absolute expiries let the token refresh job select only accounts that need it.
+      // Without expires_in the token is treated as already due for a refresh.
+      const issuedAt = Date.now();
+      const accessExpiresAt = new Date(issuedAt + (tokens.expires_in ?? 0) * 1000);
+      const refreshExpiresAt = tokens.refresh_expires_in != null
+        ? new Date(issuedAt + tokens.refresh_expires_in * 1000)
+        : undefined;
+
       await tikTokRef.set(
         {
           tokens: tokens,
           profileImage: user.profile.profileImage,
           username: user.profile.username,
           displayName: user.profile.displayName,
+          access_expires_at: accessExpiresAt,
+          refresh_expires_at: refreshExpiresAt,
+          // Re-linking replaces a revoked token, so clear any failure state
+          circuit_breaker: admin.firestore.FieldValue.delete(),
           updatedAt: admin.firestore.FieldValue.serverTimestamp(),
         },
         { merge: true }
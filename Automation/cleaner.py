@@ -1,10 +1,12 @@
 import os
 import logging
 import json
-from datetime import datetime, timedelta
+import argparse
+from datetime import datetime
 from dotenv import load_dotenv
 import firebase_admin
 from firebase_admin import credentials, firestore
+from utils.migration_runner import Migration, MigrationRunner, FileCheckpointStore, FirestoreCheckpointStore
 
 # Load environment variables from .env file
 load_dotenv()
@@ -22,14 +24,12 @@ def initialize_firebase():
     with open(firebase_creds_path, 'r') as f:
         firebase_creds = json.load(f)
 
-    cred = credentials.Certificate(firebase_creds)
-    firebase_admin.initialize_app(cred)
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(firebase_creds)
+        firebase_admin.initialize_app(cred)
     logging.info("Firebase initialized successfully")
     return firestore.client()
 
-# Initialize Firebase
-db = initialize_firebase()
-
 # Function to convert create_time to datetime
 def convert_create_time(create_time):
     if isinstance(create_time, dict) and 'seconds' in create_time:
@@ -42,44 +42,57 @@ def convert_create_time(create_time):
         logging.warning(f"Unrecognized format for create_time: {create_time}")
         return None
 
-# Function to check and update the create_time field in videos
-def process_content_plan_videos(org_id, plan_id):
-    videos_ref = db.collection('organizations').document(org_id).collection('contentPlans').document(plan_id).collection('videos').stream()
-
-    for video in videos_ref:
-        video_data = video.to_dict()
-        video_id = video.id
-
-        if 'create_time' in video_data:
-            original_create_time = video_data['create_time']
-            converted_create_time = convert_create_time(original_create_time)
-
-            if converted_create_time:
-                # Update the video document with the correct create_time format
-                logging.info(f"Updating create_time for video {video_id} in content plan {plan_id}. Original: {original_create_time}, Converted: {converted_create_time}")
-                video.reference.update({'create_time': converted_create_time})
-            else:
-                logging.warning(f"Failed to convert create_time for video {video_id} in content plan {plan_id}")
-        else:
-            logging.warning(f"create_time field missing for video {video_id} in content plan {plan_id}")
-
-# Process organizations and their content plans
-def process_content_plans():
-    orgs_ref = db.collection('organizations').stream()
-
-    for org in orgs_ref:
-        org_id = org.id
-        content_plans_ref = db.collection('organizations').document(org_id).collection('contentPlans').stream()
+class CreateTimeMigration(Migration):
+    """Converts create_time on content plan videos from epoch seconds or {seconds, nanoseconds} maps to timestamps."""
+    name = 'content_plan_videos_create_time'
+
+    def collections(self, db):
+        for org in db.collection('organizations').select([]).stream():
+            for plan in org.reference.collection('contentPlans').select([]).stream():
+                yield plan.reference.collection('videos')
+
+    def migrate(self, data):
+        if 'create_time' not in data:
+            return None
+        create_time = data['create_time']
+        # Already converted (Firestore returns timestamps as datetimes)
+        if isinstance(create_time, datetime):
+            return None
+        converted_create_time = convert_create_time(create_time)
+        if converted_create_time is None:
+            return None
+        return {'create_time': converted_create_time}
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts create_time on content plan videos to timestamps. Resumes from the last checkpoint.")
+    parser.add_argument('--checkpoint-file', help="Keep the checkpoint in this local JSON file instead of migrationCheckpoints in Firestore")
+    parser.add_argument('--batch-size', type=int, default=200, help="Documents read and updated per page (max 500)")
+    parser.add_argument('--max-writes-per-second', type=float, help="Limit document updates per second across workers")
+    parser.add_argument('--workers', type=int, default=1, help="Collections migrated in parallel")
+    parser.add_argument('--dry-run', action='store_true', help="Count what would be updated without writing or checkpointing")
+    parser.add_argument('--restart', action='store_true', help="Discard the checkpoint and start from the beginning")
+    args = parser.parse_args()
+
+    db = initialize_firebase()
+    migration = CreateTimeMigration()
+    checkpoint_store = FileCheckpointStore(args.checkpoint_file) if args.checkpoint_file else FirestoreCheckpointStore(db)
+    if args.restart:
+        checkpoint_store.reset(migration.name)
 
-        for plan in content_plans_ref:
-            plan_id = plan.id
-            logging.info(f"Processing content plan {plan_id} in organization {org_id}")
-            process_content_plan_videos(org_id, plan_id)
-
-if __name__ == '__main__':
     logging.info("Starting conversion of create_time...")
-
-    # Process content plans and update create_time
-    process_content_plans()
-
+    runner = MigrationRunner(
+        db,
+        migration,
+        checkpoint_store,
+        batch_size=args.batch_size,
+        max_writes_per_second=args.max_writes_per_second,
+        max_workers=args.workers,
+        dry_run=args.dry_run
+    )
+    summary = runner.run()
+    if summary['failed']:
+        logging.warning(f"{len(summary['failed'])} collections failed; run again to resume them.")
     logging.info("Conversion of create_time completed.")
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,9 @@
 import os
 import logging
 import json
+import threading
 from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import credentials, firestore
-from utils.metrics_scraper import MetricsScraper
-from utils.content_plan_aggregation import ContentPlanAggregator
-from utils.organization_aggregation import OrganizationMetricsAggregator
+from utils.profiling import profiled
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,7 +11,18 @@ load_dotenv()
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
+# Firebase is initialized on first use rather than at import, so cold starts don't
+# pay for loading credentials and building the gRPC client before they need it.
+_db = None
+_db_lock = threading.Lock()
+
 def initialize_firebase():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    if firebase_admin._apps:
+        return firestore.client()
+
     firebase_creds_path = os.getenv('FIREBASE_CREDENTIALS_JSON')
     logging.info(f"Firebase Credentials Path: {firebase_creds_path}")
 
@@ -29,24 +37,41 @@ def initialize_firebase():
     logging.info("Firebase initialized successfully")
     return firestore.client()
 
-# Initialize Firebase
-db = initialize_firebase()
+def get_db():
+    """Returns the storage client, initializing Firebase on first use unless STORAGE_BACKEND selects another backend."""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                from utils.storage import get_client, storage_backend
+                _db = initialize_firebase() if storage_backend() == 'firestore' else get_client()
+    return _db
 
+@profiled('metrics_scraper')
 def metrics_scraper_http(request):
-    logging.info("Starting metrics scraping job...")
-    scraper = MetricsScraper()
-    scraper.run()
-    logging.info("Metrics scraping job completed successfully.")
-
-    logging.info("Starting content plan aggregation...")
-    aggregator = ContentPlanAggregator()
-    aggregator.run()
-    logging.info("Content plan aggregation completed successfully.")
-
-    logging.info("Starting content plan aggregation...")
-    aggregator = OrganizationMetricsAggregator()
-    aggregator.run()
-    logging.info("Content plan aggregation completed successfully.")
+    from utils.metrics_scraper import MetricsScraper
+    from utils.content_plan_aggregation import ContentPlanAggregator
+    from utils.organization_aggregation import OrganizationMetricsAggregator
+    from utils.stage_dag import run_pipeline
+    from utils.checkpoint import CheckpointStore, Deadline
+    from utils.firestore_accounting import start_run
+    from utils import pipeline_metrics
+
+    # Taken first so the time spent initializing counts against the function's timeout
+    deadline = Deadline.from_env()
+    # The jobs below use pooled clients, which are counted along with the default app's client
+    accounting = start_run('metrics_scraper', get_db())
+    timings = pipeline_metrics.start_run('metrics_scraper', get_db())
+
+    try:
+        # Content plans are aggregated as soon as their accounts are scraped, and organizations as soon as their plans are
+        logging.info("Starting metrics scraping and aggregation...")
+        run_pipeline(MetricsScraper(), ContentPlanAggregator(), OrganizationMetricsAggregator(),
+                     deadline=deadline, checkpoints=CheckpointStore(get_db(), 'metrics_scraper'))
+        logging.info("Metrics scraping and aggregation completed successfully.")
+    finally:
+        accounting.log_summary()
+        timings.report()
 
     return "Metrics scraping and content plan aggregation jobs completed successfully."
 
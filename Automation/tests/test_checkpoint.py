@@ -0,0 +1,16 @@
+import logging
+from utils.checkpoint import Deadline
+
+def test_from_env_warns_without_a_budget(monkeypatch, caplog):
+    monkeypatch.delenv('RUN_DEADLINE_SECONDS', raising=False)
+    monkeypatch.delenv('FUNCTION_TIMEOUT_SEC', raising=False)
+
+    with caplog.at_level(logging.WARNING):
+        assert Deadline.from_env() is None
+    assert 'RUN_DEADLINE_SECONDS' in caplog.text
+
+def test_from_env_subtracts_the_margin(monkeypatch):
+    monkeypatch.setenv('RUN_DEADLINE_SECONDS', '540')
+    monkeypatch.setenv('RUN_DEADLINE_MARGIN_SECONDS', '40')
+
+    assert 499 < Deadline.from_env().remaining() <= 500
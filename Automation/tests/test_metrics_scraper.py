@@ -0,0 +1,61 @@
+import threading
+import requests
+from utils import metrics_scraper
+from utils.metrics_scraper import MetricsScraper
+from utils.retry_queue import RetryPolicy
+
+class ManualDeadline:
+    """A deadline the test reaches by hand."""
+
+    def __init__(self):
+        self.passed = threading.Event()
+
+    def reached(self):
+        return self.passed.is_set()
+
+    def remaining(self):
+        return 0 if self.reached() else 60
+
+def test_run_blocks_on_in_flight_accounts_after_deadline_with_a_retry_due(monkeypatch):
+    deadline = ManualDeadline()
+    failing_started = threading.Event()
+    release = threading.Event()
+    scraper = MetricsScraper(max_workers=2, retry_policy=RetryPolicy(base_delay=0, jitter=0), deadline=deadline)
+    slow_account = ('user-a', {'username': 'slow'})
+    failing_account = ('user-b', {'username': 'failing'})
+    monkeypatch.setattr(scraper, 'iter_linked_accounts', lambda: iter([slow_account, failing_account]))
+    monkeypatch.setattr(scraper.poll_scheduler, 'is_account_due', lambda account_data: True)
+
+    def process_account(user_id, account_data):
+        if account_data['username'] == 'failing':
+            failing_started.set()
+            # Fails once the deadline has passed, so its retry is due but must not be started
+            deadline.passed.wait(5)
+            raise requests.exceptions.ConnectionError('connection reset')
+        failing_started.wait(5)
+        deadline.passed.set()
+        release.wait(5)
+
+    monkeypatch.setattr(scraper, 'process_account', process_account)
+
+    wait_calls = []
+    real_wait = metrics_scraper.wait
+
+    def counting_wait(*args, **kwargs):
+        wait_calls.append(kwargs.get('timeout'))
+        return real_wait(*args, **kwargs)
+
+    monkeypatch.setattr(metrics_scraper, 'wait', counting_wait)
+
+    releaser = threading.Timer(0.5, release.set)
+    releaser.start()
+    try:
+        scraper.run()
+    finally:
+        releaser.cancel()
+        release.set()
+
+    # Spinning on a zero timeout makes thousands of calls in the half second the slow account runs
+    assert len(wait_calls) < 20
+    assert wait_calls[-1] is None
+    assert scraper.deferred_accounts == [failing_account]
@@ -0,0 +1,30 @@
+from utils.pipeline_metrics import BUCKET_BOUNDS, LatencyHistogram, PipelineMetrics
+
+def test_histogram_keeps_fixed_buckets_and_estimates_quantiles():
+    histogram = LatencyHistogram()
+    # 1ms to 1s, evenly
+    samples = [i / 1000 for i in range(1, 1001)]
+    for seconds in samples:
+        histogram.observe(seconds)
+
+    assert len(histogram.counts) == len(BUCKET_BOUNDS) + 1
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 1000
+    assert abs(snapshot['sum'] - sum(samples)) < 1e-9
+    assert snapshot['max'] == 1.0
+    # Within the bucket of the exact value
+    assert 0.316 <= snapshot['p50'] <= 0.563
+    assert 0.562 <= snapshot['p95'] <= 1.0
+    assert 0.562 <= snapshot['p99'] <= 1.0
+
+def test_prometheus_buckets_are_cumulative():
+    metrics = PipelineMetrics('job')
+    for seconds in (0.002, 0.002, 0.5, 5000):
+        metrics.observe('tiktok_api', seconds)
+
+    lines = metrics.prometheus_text().splitlines()
+    assert 'ovrsee_operation_latency_seconds_bucket{job="job",operation="tiktok_api",le="0.001"} 0' in lines
+    assert 'ovrsee_operation_latency_seconds_bucket{job="job",operation="tiktok_api",le="0.003162"} 2' in lines
+    assert 'ovrsee_operation_latency_seconds_bucket{job="job",operation="tiktok_api",le="1000.0"} 3' in lines
+    assert 'ovrsee_operation_latency_seconds_bucket{job="job",operation="tiktok_api",le="+Inf"} 4' in lines
+    assert 'ovrsee_operation_latency_seconds_count{job="job",operation="tiktok_api"} 4' in lines
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta, timezone
+from utils.poll_schedule import PollScheduler
+
+class RecordingAccountRef:
+    def __init__(self):
+        self.updates = []
+
+    def update(self, data):
+        self.updates.append(data)
+
+def test_record_keeps_only_the_older_entries_of_videos_not_polled_since(monkeypatch):
+    now = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    scheduler = PollScheduler(db=None)
+    account_ref = RecordingAccountRef()
+    monkeypatch.setattr(scheduler, 'get_account_ref', lambda user_id, account_username: account_ref)
+    account_data = {'username': 'creator', 'poll_schedule': {'videos': {
+        'legacy-due': now - timedelta(minutes=1),
+        'legacy-later': now + timedelta(hours=5),
+        'untracked': now + timedelta(hours=1),
+    }}}
+    next_polls = {'legacy-due': None, 'legacy-later': None, 'scheduled': now + timedelta(hours=3)}
+
+    assert scheduler.due_video_ids(account_data, next_polls, now) == ['legacy-due']
+
+    scheduler.record('user', account_data, next_polls, {'legacy-due': now + timedelta(hours=2)}, now)
+
+    schedule = account_ref.updates[-1]['poll_schedule']
+    assert schedule['videos'] == {'legacy-later': now + timedelta(hours=5)}
+    # The account is polled at least hourly
+    assert schedule['next_poll_at'] == now + timedelta(hours=1)
@@ -0,0 +1,21 @@
+from utils.retry_queue import DelayedRetryQueue, RetryPolicy
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_deadline_counts_from_each_tasks_first_attempt():
+    clock = FakeClock()
+    retry_queue = DelayedRetryQueue(RetryPolicy(base_delay=2, jitter=0, deadline=300), clock=clock)
+
+    # First tried long after the queue was created, still within its own budget
+    clock.now = 1000.0
+    assert retry_queue.schedule('late task', 2, first_attempt_at=990.0)
+    # Its retry would only be ready past 300 seconds from its first attempt
+    assert not retry_queue.schedule('old task', 2, first_attempt_at=699.0)
+
+    clock.now = 1002.0
+    assert retry_queue.pop_ready() == [('late task', 2, 990.0)]
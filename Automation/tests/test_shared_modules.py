@@ -0,0 +1,11 @@
+import importlib.util
+import os
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def test_shared_module_copies_match_automation():
+    spec = importlib.util.spec_from_file_location('sync_shared_modules', os.path.join(REPO_ROOT, 'Utils', 'sync_shared_modules.py'))
+    sync_shared_modules = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sync_shared_modules)
+    # Run Utils/sync_shared_modules.py after editing a shared module in Automation/utils
+    assert list(sync_shared_modules.out_of_date()) == []
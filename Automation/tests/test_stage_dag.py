@@ -0,0 +1,24 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import pipeline_metrics
+from utils.pipeline_metrics import PipelineMetrics
+from utils.stage_dag import DependencyScheduler
+
+def test_stage_spans_first_start_to_last_finish(monkeypatch):
+    metrics = PipelineMetrics('job')
+    monkeypatch.setattr(pipeline_metrics, '_active_run', metrics)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        scheduler = DependencyScheduler(executor)
+        scheduler.add(('plan', 'a'), 'content_plan', time.sleep, 0.05, depends_on=[('account', 'a')], stage='content_plan_aggregation')
+        scheduler.add(('plan', 'b'), 'content_plan', time.sleep, 0.05, depends_on=[('plan', 'a')], stage='content_plan_aggregation')
+        scheduler.add(('organization', 'o'), 'organization', time.sleep, 0.01, depends_on=[('plan', 'b')], stage='organization_aggregation')
+        # The first plan only starts once its account is scraped
+        time.sleep(0.05)
+        scheduler.done(('account', 'a'))
+        scheduler.wait()
+        scheduler.record_stages()
+
+    stages = metrics.summary()['stages']
+    assert 0.1 <= stages['content_plan_aggregation'] < 0.15
+    assert 0.01 <= stages['organization_aggregation'] < 0.05
@@ -0,0 +1,64 @@
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+# One document per job, holding what its last run didn't get to
+CHECKPOINTS_COLLECTION = 'jobCheckpoints'
+
+class Deadline:
+    """
+    When a run has to stop taking new work: margin_seconds before its time budget runs
+    out, which leaves time for the work in flight to finish and the checkpoint to be saved.
+    """
+
+    def __init__(self, budget_seconds, margin_seconds=60, clock=time.monotonic):
+        self.clock = clock
+        self.stop_at = clock() + max(0, budget_seconds - margin_seconds)
+
+    @classmethod
+    def from_env(cls):
+        """
+        The deadline for a run starting now, from RUN_DEADLINE_SECONDS (or the function's
+        FUNCTION_TIMEOUT_SEC) and RUN_DEADLINE_MARGIN_SECONDS (default 60). None, with a
+        warning, when neither budget is set: 2nd gen functions don't set FUNCTION_TIMEOUT_SEC,
+        so RUN_DEADLINE_SECONDS has to be set to their timeout.
+        """
+        budget = os.getenv('RUN_DEADLINE_SECONDS') or os.getenv('FUNCTION_TIMEOUT_SEC')
+        if not budget:
+            logging.warning("Neither RUN_DEADLINE_SECONDS nor FUNCTION_TIMEOUT_SEC is set, so the run has no deadline: "
+                            "if it times out, what it didn't get to is not checkpointed. Set RUN_DEADLINE_SECONDS to the function's timeout.")
+            return None
+        return cls(float(budget), float(os.getenv('RUN_DEADLINE_MARGIN_SECONDS', '60')))
+
+    def remaining(self):
+        return max(0, self.stop_at - self.clock())
+
+    def reached(self):
+        return self.clock() >= self.stop_at
+
+class CheckpointStore:
+    """Saves and loads the work a job's run left undone, for the next run to resume."""
+
+    def __init__(self, db, job):
+        self.db = db
+        self.job = job
+
+    def get_ref(self):
+        return self.db.collection(CHECKPOINTS_COLLECTION).document(self.job)
+
+    def load(self):
+        snapshot = self.get_ref().get()
+        if not snapshot.exists:
+            return None
+        checkpoint = snapshot.to_dict()
+        logging.info(f"Resuming {self.job} from the checkpoint saved at {checkpoint.get('saved_at')}")
+        return checkpoint
+
+    def save(self, checkpoint):
+        self.get_ref().set(dict(checkpoint, saved_at=datetime.now(timezone.utc)))
+        logging.warning(f"Saved a checkpoint for {self.job}: {len(checkpoint.get('pending_accounts', []))} accounts and "
+                        f"{len(checkpoint.get('pending_organizations', []))} organizations deferred to the next run")
+
+    def clear(self):
+        self.get_ref().delete()
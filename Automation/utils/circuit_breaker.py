@@ -0,0 +1,108 @@
+import logging
+from datetime import datetime, timedelta, timezone
+import requests
+from google.cloud.firestore_v1 import DELETE_FIELD
+
+def is_invalid_grant(response):
+    """True for the 400 response to a revoked or already used refresh token."""
+    if response is None or response.status_code != 400:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and body.get('error') == 'invalid_grant'
+
+def classify_error(error):
+    """Maps an exception to the error class stored on the account's breaker state."""
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status_code = error.response.status_code
+        if status_code in (401, 403) or is_invalid_grant(error.response):
+            return 'auth'
+        if status_code == 429:
+            return 'rate_limited'
+        return 'http_error'
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return 'network'
+    return type(error).__name__
+
+class AccountCircuitBreaker:
+    """
+    Persistent per-account failure state, stored on the TikTok account document
+    under 'circuit_breaker'.
+
+    After failure_threshold consecutive failures (or a single auth failure, which
+    means the token was revoked) the breaker opens and the account is skipped until
+    next_eligible_at. The cool-down doubles with every further failure, up to
+    max_cooldown. A success closes the breaker again.
+    """
+
+    def __init__(self, db, failure_threshold=3, base_cooldown=timedelta(hours=1), max_cooldown=timedelta(days=7)):
+        self.db = db
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+
+    def get_account_ref(self, user_id, account_username):
+        return self.db.collection('users').document(user_id).collection('SocialMediaPlatforms').document('TikTok').collection('Accounts').document(account_username)
+
+    def is_open(self, account_data, now=None):
+        """True while the account is cooling down and should not be contacted."""
+        state = account_data.get('circuit_breaker') or {}
+        if state.get('state') != 'open':
+            return False
+        next_eligible_at = state.get('next_eligible_at')
+        if next_eligible_at is None:
+            return False
+        if next_eligible_at.tzinfo is None:
+            next_eligible_at = next_eligible_at.replace(tzinfo=timezone.utc)
+        return next_eligible_at > (now or datetime.now(timezone.utc))
+
+    def record_success(self, user_id, account_data, batch=None):
+        # Only accounts that have failed before need a write
+        if not (account_data.get('circuit_breaker') or {}).get('consecutive_failures'):
+            return
+        account_ref = self.get_account_ref(user_id, account_data['username'])
+        if batch is not None:
+            batch.update(account_ref, {'circuit_breaker': DELETE_FIELD})
+        else:
+            account_ref.update({'circuit_breaker': DELETE_FIELD})
+        logging.info(f"Circuit breaker closed for user {user_id}, TikTok account {account_data['username']}")
+
+    def record_failure(self, user_id, account_data, error, error_class=None):
+        error_class = error_class or classify_error(error)
+        previous_state = account_data.get('circuit_breaker') or {}
+        consecutive_failures = previous_state.get('consecutive_failures', 0) + 1
+        if error_class == 'auth':
+            # A revoked token will not recover on its own
+            consecutive_failures = max(consecutive_failures, self.failure_threshold)
+
+        now = datetime.now(timezone.utc)
+        state = {
+            'state': 'closed',
+            'consecutive_failures': consecutive_failures,
+            'last_error': error_class,
+            'last_error_message': str(error)[:500],
+            'last_failure_at': now,
+            'next_eligible_at': now
+        }
+        if consecutive_failures >= self.failure_threshold:
+            cooldown = self.base_cooldown * (2 ** (consecutive_failures - self.failure_threshold))
+            state['state'] = 'open'
+            state['next_eligible_at'] = now + min(cooldown, self.max_cooldown)
+            logging.warning(f"Circuit breaker open for user {user_id}, TikTok account {account_data['username']} until {state['next_eligible_at']} ({error_class}, {consecutive_failures} consecutive failures)")
+
+        self.get_account_ref(user_id, account_data['username']).set({'circuit_breaker': state}, merge=True)
+        # Keep the in-memory copy current in case the account is retried in this run
+        account_data['circuit_breaker'] = state
+
+    def get_open_accounts(self):
+        """
+        Yields (user_id, account_data) for every TikTok account with an open breaker,
+        e.g. to prompt the creator to re-authenticate.
+        """
+        query = self.db.collection_group('Accounts').where('circuit_breaker.state', '==', 'open')
+        for acc in query.stream():
+            platform_ref = acc.reference.parent.parent
+            if platform_ref.id == 'TikTok':
+                yield platform_ref.parent.parent.id, acc.to_dict()
@@ -3,20 +3,21 @@ from datetime import datetime, timedelta
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
 from firebase_admin import firestore
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from utils.firestore_accounting import call_in_tenant
+from utils.storage import PooledClient, get_pooled_client
+from utils.metric_records import MetricSample, MetricTotals
+from utils.pipeline_metrics import stage_timer, submit_timed
 
 logging.basicConfig(level=logging.INFO)
 
 class ContentPlanAggregator:
     def __init__(self, max_workers=10):
-        self.db = firestore.client()
+        # Worker threads each use their own pooled client, whichever of these they call
+        self.db = PooledClient()
         self.max_workers = max_workers
-        self.thread_local = threading.local()
 
     def get_db(self):
-        if not hasattr(self.thread_local, "db"):
-            self.thread_local.db = firestore.client()
-        return self.thread_local.db
+        return get_pooled_client()
 
     def format_timestamp(self, timestamp):
         return timestamp.strftime('%Y%m%d-%H%M')
@@ -24,7 +25,8 @@ class ContentPlanAggregator:
     def process_content_plan(self, org_id, plan_id, plan_data):
         db = self.get_db()
         current_timestamp = datetime.utcnow()
-        formatted_timestamp = self.format_timestamp(current_timestamp)
+        # Runs more often than hourly update the entry of their hour rather than adding entries off the hour
+        current_hour = current_timestamp.replace(minute=0, second=0, microsecond=0)
         current_date = current_timestamp.date()
 
         logging.info(f"\n  Processing Content Plan: {plan_id}")
@@ -33,13 +35,7 @@ class ContentPlanAggregator:
         videos_ref = db.collection('organizations').document(org_id).collection('contentPlans').document(plan_id).collection('videos')
         videos = videos_ref.stream()
 
-        aggregated_metrics = {
-            'comment_count': 0,
-            'like_count': 0,
-            'view_count': 0,
-            'share_count': 0,
-            'new_view_count': 0
-        }
+        totals = MetricTotals()
 
         for video in videos:
             video_data = video.to_dict()
@@ -50,32 +46,29 @@ class ContentPlanAggregator:
                 latest_metric = metrics_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).get()
 
                 if first_metric and latest_metric:
-                    first_metric_data = first_metric[0].to_dict()
-                    latest_metric_data = latest_metric[0].to_dict()
+                    totals.add_growth(MetricSample.from_dict(first_metric[0].to_dict()), MetricSample.from_dict(latest_metric[0].to_dict()))
 
-                    aggregated_metrics['new_view_count'] += max(0, latest_metric_data['view_count'] - first_metric_data['view_count'])
-                    for key in aggregated_metrics:
-                        if key != 'new_view_count':
-                            aggregated_metrics[key] += latest_metric_data.get(key, 0)
-
-        self.process_hourly_metrics(org_id, plan_id, aggregated_metrics, formatted_timestamp)
+        self.process_hourly_metrics(org_id, plan_id, totals.to_dict(), current_hour)
         self.process_daily_metrics(org_id, plan_id, current_date)
         self.process_aggregated_metrics(org_id, plan_id, "weekly", 7, current_date)
         self.process_aggregated_metrics(org_id, plan_id, "monthly", 30, current_date)
         self.process_aggregated_metrics(org_id, plan_id, "quarterly", 90, current_date)
 
-    def process_hourly_metrics(self, org_id, plan_id, aggregated_metrics, formatted_timestamp):
+    def process_hourly_metrics(self, org_id, plan_id, aggregated_metrics, current_hour):
         hourly_metrics_ref = self.db.collection('organizations').document(org_id).collection('contentPlans').document(plan_id).collection('metrics').document('hourly')
-        previous_hourly_entry = hourly_metrics_ref.collection('data').order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).get()
+        # new_view_count is relative to the previous hour, not to an earlier run in this one
+        previous_hourly_entry = hourly_metrics_ref.collection('data').where('timestamp', '<', current_hour) \
+            .order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).get()
 
-        # Add timestamp to the hourly metrics
-        aggregated_metrics['timestamp'] = SERVER_TIMESTAMP
+        # Entries are keyed and timestamped on the hour they cover
+        aggregated_metrics['timestamp'] = current_hour
+        aggregated_metrics['updated_at'] = SERVER_TIMESTAMP
 
         if previous_hourly_entry:
             previous_entry_data = previous_hourly_entry[0].to_dict()
             aggregated_metrics['new_view_count'] = max(0, aggregated_metrics['view_count'] - previous_entry_data.get('view_count', 0))
 
-        hourly_metrics_ref.collection('data').document(formatted_timestamp).set(aggregated_metrics)
+        hourly_metrics_ref.collection('data').document(self.format_timestamp(current_hour)).set(aggregated_metrics)
         hourly_metrics_ref.set({
             'most_recent_entry': aggregated_metrics,
             'updated_at': SERVER_TIMESTAMP
@@ -189,23 +182,24 @@ class ContentPlanAggregator:
 
 
     def run(self):
-        db = self.get_db()
-        orgs_ref = db.collection('organizations')
-        orgs = orgs_ref.stream()
-
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = []
-            for org in orgs:
-                plans_ref = orgs_ref.document(org.id).collection('contentPlans')
-                active_plans = plans_ref.where('status', '==', 'active').stream()
-
-                for plan in active_plans:
-                    futures.append(executor.submit(self.process_content_plan, org.id, plan.id, plan.to_dict()))
-
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    logging.error(f"An error occurred while processing a content plan: {e}")
-
-        logging.info("Content plan aggregation completed for all plans.")
+        with stage_timer('content_plan_aggregation'):
+            db = self.get_db()
+            orgs_ref = db.collection('organizations')
+            orgs = orgs_ref.stream()
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = []
+                for org in orgs:
+                    plans_ref = orgs_ref.document(org.id).collection('contentPlans')
+                    active_plans = plans_ref.where('status', '==', 'active').stream()
+
+                    for plan in active_plans:
+                        futures.append(submit_timed(executor, 'content_plan', call_in_tenant, org.id, self.process_content_plan, org.id, plan.id, plan.to_dict()))
+
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"An error occurred while processing a content plan: {e}")
+
+            logging.info("Content plan aggregation completed for all plans.")
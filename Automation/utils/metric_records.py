@@ -0,0 +1,104 @@
+from array import array
+
+# Engagement counters TikTok reports for a video, in the order they are stored
+COUNTER_FIELDS = ('comment_count', 'like_count', 'view_count', 'share_count')
+TOTAL_FIELDS = COUNTER_FIELDS + ('new_view_count',)
+
+class VideoSnapshot:
+    """The fields of a Videos document, as built from a TikTok video list or query item."""
+
+    __slots__ = ('title', 'description', 'create_time', 'share_url', 'thumbnail_url', 'is_up', 'is_tracked', 'is_in_plan')
+
+    def __init__(self, title, description, create_time, share_url, thumbnail_url, is_up=True, is_tracked=True, is_in_plan=False):
+        self.title = title
+        self.description = description
+        self.create_time = create_time
+        self.share_url = share_url
+        self.thumbnail_url = thumbnail_url
+        self.is_up = is_up
+        self.is_tracked = is_tracked
+        self.is_in_plan = is_in_plan
+
+    @classmethod
+    def from_media(cls, media):
+        return cls(
+            media.get('title', ''),
+            media.get('video_description', ''),
+            media.get('create_time', ''),
+            media['embed_link'],
+            media.get('cover_image_url', '')
+        )
+
+    def matches(self, data):
+        """True when the stored document data has exactly these fields and values."""
+        if len(data) != len(self.__slots__):
+            return False
+        missing = object()
+        return all(data.get(field, missing) == getattr(self, field) for field in self.__slots__)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+class MetricSample:
+    """One Metrics entry: the counters of a video at timestamp."""
+
+    __slots__ = ('comment_count', 'like_count', 'view_count', 'share_count', 'new_view_count', 'timestamp')
+
+    def __init__(self, comment_count=0, like_count=0, view_count=0, share_count=0, new_view_count=0, timestamp=None):
+        self.comment_count = comment_count
+        self.like_count = like_count
+        self.view_count = view_count
+        self.share_count = share_count
+        self.new_view_count = new_view_count
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_media(cls, media, new_view_count, timestamp):
+        return cls(media['comment_count'], media['like_count'], media['view_count'], media['share_count'], new_view_count, timestamp)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Missing counters read as 0, as they do everywhere the entries are summed."""
+        return cls(
+            data.get('comment_count', 0),
+            data.get('like_count', 0),
+            data.get('view_count', 0),
+            data.get('share_count', 0),
+            data.get('new_view_count', 0),
+            data.get('timestamp')
+        )
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+class MetricTotals:
+    """
+    Running totals of TOTAL_FIELDS over many samples, kept in one array of 64-bit
+    integers instead of a dict of boxed ints that is updated key by key.
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self):
+        self.values = array('q', bytes(8 * len(TOTAL_FIELDS)))
+
+    def add(self, sample):
+        """Adds every counter of sample, new_view_count included."""
+        values = self.values
+        values[0] += int(sample.comment_count)
+        values[1] += int(sample.like_count)
+        values[2] += int(sample.view_count)
+        values[3] += int(sample.share_count)
+        values[4] += int(sample.new_view_count)
+
+    def add_growth(self, first, latest):
+        """Adds latest's counters, and the views gained since first as new_view_count."""
+        values = self.values
+        values[0] += int(latest.comment_count)
+        values[1] += int(latest.like_count)
+        values[2] += int(latest.view_count)
+        values[3] += int(latest.share_count)
+        values[4] += max(0, int(latest.view_count) - int(first.view_count))
+
+    def to_dict(self):
+        return dict(zip(TOTAL_FIELDS, self.values))
@@ -2,65 +2,236 @@ import logging
 import pytz
 from datetime import datetime, timedelta
 from firebase_admin import firestore
-from utils.tiktok_api import TikTokAPI
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from utils.tiktok_api import TikTokAPI, is_retryable_error, collect_videos_since
+from utils.token_provider import TokenProvider, TokenRefreshError
+from utils.circuit_breaker import AccountCircuitBreaker
+from utils.retry_queue import DelayedRetryQueue, RetryPolicy
+from utils.firestore_accounting import call_in_tenant
+from utils.storage import PooledClient, get_pooled_client
+from utils.metric_records import MetricSample, VideoSnapshot
+from utils.poll_schedule import VIDEO_NEXT_POLL_FIELD, PollScheduler
+from utils.pipeline_metrics import observe_tiktok_response, stage_timer, submit_timed
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import queue
 import threading
+import time
 
 logging.basicConfig(level=logging.INFO)
 
+# Put on the work queue by the discovery thread once every account has been queued
+DISCOVERY_DONE = object()
+# How long blocked queue operations wait before rechecking for retries or a stop
+DISCOVERY_POLL_SECONDS = 0.1
+
+def should_retry_account(error):
+    return isinstance(error, requests.exceptions.RequestException) and is_retryable_error(error)
+
 class MetricsScraper:
-    def __init__(self, max_workers=10):
-        self.db = firestore.client()
+    def __init__(self, max_workers=10, retry_policy=None, discovery_queue_size=None, users_page_size=100, poll_scheduler=None, on_account_done=None,
+                 deadline=None, resume_from=None):
+        # Worker threads each use their own pooled client, whichever of these they call
+        self.db = PooledClient()
         self.eastern = pytz.timezone('America/New_York')
         self.max_workers = max_workers
-        self.thread_local = threading.local()
+        # Accounts discovered but not yet handed to a worker; discovery pauses when it is full
+        self.discovery_queue_size = discovery_queue_size or 2 * max_workers
+        self.users_page_size = users_page_size
+        # Failed fetches go back through the retry queue rather than sleeping in the worker
+        self.platform_api = TikTokAPI(pool_size=max_workers, max_attempts=1)
+        self.platform_api.session.hooks['response'].append(observe_tiktok_response)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.token_provider = TokenProvider(self.db, self.platform_api)
+        self.circuit_breaker = AccountCircuitBreaker(self.db)
+        # Only accounts and videos that are due are polled each run
+        self.poll_scheduler = poll_scheduler or PollScheduler(self.db)
+        # Called with (user_id, account_username) once an account is finished with in this run, scraped or not
+        self.on_account_done = on_account_done
+        # No new accounts are started once the deadline is reached; what is left goes into checkpoint_state()
+        self.deadline = deadline
+        # checkpoint_state() of a previous run that stopped early
+        self.resume_from = resume_from
+        self.deferred_accounts = []
+        self.resumed_accounts = []
+        self.discovery_cursor = None
+        self.discovery_complete = False
 
     def get_db(self):
-        if not hasattr(self.thread_local, "db"):
-            self.thread_local.db = firestore.client()
-        return self.thread_local.db
-
-    def get_users_with_linked_accounts(self):
-        users_ref = self.db.collection('users')
-        users_with_accounts = []
-        
-        for user in users_ref.stream():
-            # Query the Accounts subcollection directly under the 'TikTok' document
-            accounts_ref = user.reference.collection('SocialMediaPlatforms').document('TikTok').collection('Accounts')
-            
-            # Check if the Accounts subcollection contains any documents
-            if accounts_ref.limit(1).get():
-                users_with_accounts.append(user.id)
-        
-        return users_with_accounts
+        return get_pooled_client()
+
+    def iter_user_ids(self, after=None, until=None):
+        """
+        Yields every user ID after `after` up to and including `until`, reading
+        users_page_size at a time so neither the full user list nor a long-lived stream
+        is held while the scrape runs.
+        """
+        query = self.db.collection('users').order_by('__name__').select([]).limit(self.users_page_size)
+        if after is not None:
+            query = query.start_after({'__name__': after})
+        if until is not None:
+            query = query.end_at({'__name__': until})
+        last_user = None
+        while True:
+            page = (query.start_after(last_user) if last_user is not None else query).get()
+            for user in page:
+                yield user.id
+            if len(page) < self.users_page_size:
+                return
+            last_user = page[-1]
+
+    def iter_linked_accounts(self):
+        """
+        Yields (user_id, account_data) for every linked TikTok account, in user order.
+        When resuming, the accounts the previous run deferred come first, then the users
+        it never reached, then the rest. discovery_cursor follows the last user whose
+        accounts have all been taken.
+        """
+        resume = self.resume_from or {}
+        cursor = self.discovery_cursor = resume.get('resume_after_user')
+        deferred = set()
+        # Entries leave the list once taken, so those never reached stay in checkpoint_state()
+        self.resumed_accounts = list(resume.get('pending_accounts') or ())
+        while self.resumed_accounts:
+            entry = self.resumed_accounts[0]
+            account = self.poll_scheduler.get_account_ref(entry['user_id'], entry['username']).get()
+            if account.exists:
+                deferred.add((entry['user_id'], entry['username']))
+                yield entry['user_id'], account.to_dict()
+            self.resumed_accounts.pop(0)
+
+        for after, until in ([(cursor, None), (None, cursor)] if cursor is not None else [(None, None)]):
+            for user_id in self.iter_user_ids(after, until):
+                for account_data in self.get_account_data(user_id):
+                    if (user_id, account_data.get('username')) not in deferred:
+                        yield user_id, account_data
+                self.discovery_cursor = user_id
+        self.discovery_complete = True
+
+    def checkpoint_state(self):
+        """
+        What this run left undone (accounts it deferred, and where discovery stopped),
+        for a later run to pass as resume_from. None when it got through everything.
+        """
+        if self.discovery_complete and not self.deferred_accounts:
+            return None
+        pending_accounts = [{'user_id': user_id, 'username': account_data.get('username')} for user_id, account_data in self.deferred_accounts]
+        return {
+            'pending_accounts': pending_accounts + self.resumed_accounts,
+            'resume_after_user': None if self.discovery_complete else self.discovery_cursor
+        }
+
+    def discover_accounts(self, work_queue, stop):
+        """
+        Producer side of run(): feeds accounts whose circuit breaker is closed into the
+        bounded work_queue, blocking while it is full, then puts DISCOVERY_DONE.
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    work_queue.put(item, timeout=DISCOVERY_POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            with stage_timer('scrape_discovery'):
+                for user_id, account_data in self.iter_linked_accounts():
+                    if self.circuit_breaker.is_open(account_data):
+                        logging.info(f"Skipping user {user_id}, account {account_data.get('username')}: circuit breaker open")
+                        self.account_done(user_id, account_data)
+                        continue
+                    if not self.poll_scheduler.is_account_due(account_data):
+                        self.account_done(user_id, account_data)
+                        continue
+                    if not put((user_id, account_data)):
+                        return
+        except Exception as e:
+            logging.error(f"Account discovery failed, scraping only the accounts found so far: {e}")
+        finally:
+            put(DISCOVERY_DONE)
+
+    def account_done(self, user_id, account_data):
+        if self.on_account_done is not None:
+            self.on_account_done(user_id, account_data.get('username'))
 
     def get_account_data(self, user_id):
         accounts_ref = self.db.collection('users').document(user_id).collection('SocialMediaPlatforms').document('TikTok').collection('Accounts')
         return [acc.to_dict() for acc in accounts_ref.stream()]
 
+    def get_videos_ref(self, user_id, platform, account_username):
+        return self.db.collection('users').document(user_id).collection('SocialMediaPlatforms').document(platform).collection('Accounts').document(account_username).collection('Videos')
+
+    def get_tracked_video_polls(self, user_id, platform, account_username):
+        """Maps the ID of every tracked video to its next poll time, None when it has none yet."""
+        videos_ref = self.get_videos_ref(user_id, platform, account_username)
+        # Only the document IDs and the schedule are needed
+        return {video.id: video.to_dict().get(VIDEO_NEXT_POLL_FIELD)
+                for video in videos_ref.where('is_tracked', '==', True).select([VIDEO_NEXT_POLL_FIELD]).stream()}
+
+    def fetch_account_videos(self, access_token, open_id, tracked_video_ids):
+        """
+        Uses the list endpoint to discover new uploads and the query endpoint to refresh
+        tracked videos that are no longer on the first page of the list.
+        """
+        # Only uploads from the last 24 hours are added, so paging stops once a page reaches older videos
+        cutoff = int((datetime.now(pytz.utc) - timedelta(hours=24)).timestamp())
+        videos = collect_videos_since(self.platform_api.fetch_video_list(access_token, open_id), cutoff)
+
+        listed_video_ids = {video['id'] for video in videos}
+        unlisted_video_ids = [video_id for video_id in tracked_video_ids if video_id not in listed_video_ids]
+        if unlisted_video_ids:
+            videos.extend(self.platform_api.query_videos(access_token, unlisted_video_ids))
+        return videos
+
     def process_account(self, user_id, account_data):
         db = self.get_db()
-        platform_api = TikTokAPI()
-        access_token = account_data['tokens']['access_token']
-        
+        platform_api = self.platform_api
+
         open_id = account_data['tokens'].get('open_id')
         if not open_id:
             logging.error(f"open_id not found for TikTok user {user_id}, account: {account_data.get('username')}")
             return
-        
+    
         account_username = account_data['username']
-        
+    
+        tracked_polls = self.get_tracked_video_polls(user_id, platform_api.platform_name, account_username)
+        now = datetime.now(pytz.utc)
+        due_video_ids = self.poll_scheduler.due_video_ids(account_data, tracked_polls, now)
         try:
-            video_list = platform_api.fetch_video_list(access_token, open_id)
-            logging.info(f"Fetched video list for user {user_id}, account {account_username}")
-            self.store_videos_and_metrics(platform_api, user_id, platform_api.platform_name, account_username, video_list)
+            video_list = self.token_provider.call_with_token(
+                user_id, account_data, lambda access_token: self.fetch_account_videos(access_token, open_id, due_video_ids)
+            )
+        except TokenRefreshError as e:
+            logging.error(f"Failed to refresh token for user {user_id}, account {account_username}: {e}")
+            self.circuit_breaker.record_failure(user_id, account_data, e, error_class='auth')
+            return
         except Exception as e:
+            if should_retry_account(e):
+                # run() decides whether to retry later or record the failure
+                raise
             logging.error(f"Failed to fetch video list for user {user_id}, account {account_username}: {e}")
+            self.circuit_breaker.record_failure(user_id, account_data, e)
+            return
+
+        logging.info(f"Fetched video list for user {user_id}, account {account_username}")
+        self.circuit_breaker.record_success(user_id, account_data)
+        # Tracked videos that are not due yet are skipped even when the video list returned them
+        due = set(due_video_ids)
+        video_list = [media for media in video_list if media['id'] in due or media['id'] not in tracked_polls]
+        polled = self.store_videos_and_metrics(platform_api, user_id, platform_api.platform_name, account_username, video_list, due_video_ids)
+        still_tracked = {video_id: next_poll_at for video_id, next_poll_at in tracked_polls.items() if video_id not in due or video_id in polled}
+        self.poll_scheduler.record(user_id, account_data, still_tracked, polled, now)
 
-    def store_videos_and_metrics(self, platform_api, user_id, platform, account_username, media_list):
+    def store_videos_and_metrics(self, platform_api, user_id, platform, account_username, video_data_list, tracked_video_ids):
+        """
+        Stores the videos and a metrics entry for each one, along with each video's next
+        poll time, from its age and views gained since its last entry. Returns those
+        next poll times.
+        """
+        next_polls = {}
         try:
-            videos_ref = self.db.collection('users').document(user_id).collection('SocialMediaPlatforms').document(platform).collection('Accounts').document(account_username).collection('Videos')
-            video_data_list = media_list.get('data', {}).get('videos', [])
+            videos_ref = self.get_videos_ref(user_id, platform, account_username)
             fetched_video_ids = set()
             current_time = datetime.now(pytz.utc)
             
@@ -77,22 +248,13 @@ class MetricsScraper:
                     create_time_calculation = datetime.utcfromtimestamp(create_time)  # Convert to datetime
                     create_time_calculation = pytz.utc.localize(create_time_calculation)  # Make timezone-aware (UTC)
 
-                new_video_data = {
-                    'title': media.get('title', ''),
-                    'description': media.get('video_description', ''),
-                    'create_time': create_time,
-                    'share_url': media['embed_link'],
-                    'thumbnail_url': media.get('cover_image_url', ''),
-                    'is_up': True,
-                    'is_tracked': True,
-                    'is_in_plan': False
-                }
+                new_video = VideoSnapshot.from_media(media)
 
                 if not existing_video.exists:
                     # Only add new videos if they're less than 24 hours old
                     if current_time - create_time_calculation <= timedelta(hours=24):
                         logging.info(f"New video detected within last 24 hours: {media_id}")
-                        video_doc_ref.set(new_video_data)
+                        video_changed = True
                     else:
                         logging.info(f"Video {media_id} is older than 24 hours. Not adding to database.")
                         continue
@@ -100,13 +262,13 @@ class MetricsScraper:
                     existing_data = existing_video.to_dict()
                     # Preserve the current 'is_in_plan' value if it exists
                     if 'is_in_plan' in existing_data:
-                        new_video_data['is_in_plan'] = existing_data['is_in_plan']
-                    
-                    if existing_data != new_video_data:
+                        new_video.is_in_plan = existing_data['is_in_plan']
+
+                    # The schedule is written with every poll, so it doesn't count as a change
+                    existing_data.pop(VIDEO_NEXT_POLL_FIELD, None)
+                    video_changed = not new_video.matches(existing_data)
+                    if video_changed:
                         logging.info(f"Updating video data for {media_id}")
-                        video_doc_ref.set(new_video_data)
-                    else:
-                        logging.info(f"No changes detected for video {media_id}, skipping update.")
 
                 # Store metrics for all videos (new and existing)
                 current_view_count = media['view_count']
@@ -115,42 +277,43 @@ class MetricsScraper:
                 metrics_collection = video_doc_ref.collection('Metrics')
                 latest_metric = metrics_collection.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).get()
                 
+                view_velocity = None
                 if latest_metric:
-                    last_view_count = latest_metric[0].to_dict().get('view_count', 0)
-                    new_view_count = max(0, current_view_count - last_view_count)
-
-                metrics = {
-                    'comment_count': media['comment_count'],
-                    'like_count': media['like_count'],
-                    'view_count': current_view_count,
-                    'share_count': media['share_count'],
-                    'new_view_count': new_view_count,
-                    'timestamp': current_time
-                }
+                    last_metric = MetricSample.from_dict(latest_metric[0].to_dict())
+                    new_view_count = max(0, current_view_count - last_metric.view_count)
+                    hours_since = (current_time - last_metric.timestamp).total_seconds() / 3600 if last_metric.timestamp else 0
+                    view_velocity = new_view_count / hours_since if hours_since > 0 else None
+
+                metrics = MetricSample.from_media(media, new_view_count, current_time)
 
                 eastern_timestamp = current_time.astimezone(pytz.timezone('America/New_York'))
                 formatted_timestamp = self.format_timestamp(eastern_timestamp)
 
                 metrics_ref = video_doc_ref.collection('Metrics').document(formatted_timestamp)
-                metrics_ref.set(metrics)
+                metrics_ref.set(metrics.to_dict())
 
                 self.handle_historical_data_and_cleanup(video_doc_ref, eastern_timestamp)
+                next_polls[media_id] = self.poll_scheduler.next_poll_at(create_time, view_velocity, current_time)
+                if video_changed:
+                    video_doc_ref.set(dict(new_video.to_dict(), **{VIDEO_NEXT_POLL_FIELD: next_polls[media_id]}))
+                else:
+                    video_doc_ref.update({VIDEO_NEXT_POLL_FIELD: next_polls[media_id]})
 
                 logging.info(f"Metrics added to Metrics collection for video {media_id}")
 
-            # Update is_up to False for videos that are no longer available
-            all_videos = videos_ref.stream()
-            for video in all_videos:
-                if video.id not in fetched_video_ids:
-                    video.reference.update({
+            # Tracked videos the query endpoint no longer returns were deleted or made private
+            for video_id in tracked_video_ids:
+                if video_id not in fetched_video_ids:
+                    videos_ref.document(video_id).update({
                         'is_up': False,
                         'is_tracked': False
                     })
-                    logging.info(f"Video {video.id} is no longer available. Updated is_up and is_tracked to False.")
+                    logging.info(f"Video {video_id} is no longer available. Updated is_up and is_tracked to False.")
 
             logging.info(f'Successfully stored videos and metrics for user {user_id}, platform {platform}, and account {account_username}')
         except Exception as e:
             logging.error(f'Error storing videos and metrics in Firestore: {e}')
+        return next_polls
 
     def handle_historical_data_and_cleanup(self, video_doc_ref, current_timestamp):
         metrics_ref = video_doc_ref.collection('Metrics')
@@ -198,17 +361,98 @@ class MetricsScraper:
         return timestamp.strftime('%Y%m%d-%H%M')
 
     def run(self):
-        users_with_accounts = self.get_users_with_linked_accounts()
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = []
-            for user_id in users_with_accounts:
-                for account_data in self.get_account_data(user_id):
-                    futures.append(executor.submit(self.process_account, user_id, account_data))
-            
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    logging.error(f"An error occurred while processing an account: {e}")
+        """
+        Streams accounts from discovery to the workers: a producer thread fills a bounded
+        queue while this thread hands accounts to free workers and consumes results as
+        they complete, so the first fetch starts as soon as the first account is found
+        and memory does not grow with the number of accounts. Once the deadline is
+        reached, accounts still queued or waiting for a retry are deferred instead.
+        """
+        with stage_timer('scrape'):
+            retry_queue = DelayedRetryQueue(self.retry_policy)
+            work_queue = queue.Queue(maxsize=self.discovery_queue_size)
+            stop = threading.Event()
+            producer = threading.Thread(target=self.discover_accounts, args=(work_queue, stop), name='account-discovery', daemon=True)
+            producer.start()
+            out_of_time = False
+
+            try:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    futures = {}
+                    discovering = True
+                    while True:
+                        if not out_of_time and self.deadline is not None and self.deadline.reached():
+                            logging.warning(f"Deadline reached with {len(futures)} accounts in progress, deferring the rest to the next run")
+                            out_of_time = True
+                            discovering = False
+                            stop.set()
+
+                        if not out_of_time:
+                            for (user_id, account_data), attempt, first_attempt_at in retry_queue.pop_ready():
+                                futures[submit_timed(executor, 'account', call_in_tenant, user_id, self.process_account, user_id, account_data)] = (user_id, account_data, attempt, first_attempt_at)
+
+                        # New accounts are only taken while a worker is free, which keeps the producer blocked on a full queue otherwise
+                        while discovering and len(futures) < self.max_workers:
+                            try:
+                                item = work_queue.get(block=not futures, timeout=DISCOVERY_POLL_SECONDS)
+                            except queue.Empty:
+                                break
+                            if item is DISCOVERY_DONE:
+                                discovering = False
+                                break
+                            user_id, account_data = item
+                            futures[submit_timed(executor, 'account', call_in_tenant, user_id, self.process_account, user_id, account_data)] = (user_id, account_data, 1, retry_queue.clock())
+
+                        if not futures:
+                            if not discovering and (out_of_time or not len(retry_queue)):
+                                break
+                            if not discovering:
+                                delay = retry_queue.next_ready_in() or 0
+                                time.sleep(min(delay, self.deadline.remaining()) if self.deadline is not None else delay)
+                            continue
+
+                        # Past the deadline, retries are deferred rather than started, so only the accounts in flight are waited for
+                        timeout = None
+                        if not out_of_time:
+                            timeout = retry_queue.next_ready_in()
+                            if discovering and len(futures) < self.max_workers:
+                                timeout = min(timeout, DISCOVERY_POLL_SECONDS) if timeout is not None else DISCOVERY_POLL_SECONDS
+                            if self.deadline is not None:
+                                timeout = min(timeout, self.deadline.remaining()) if timeout is not None else self.deadline.remaining()
+                        done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            user_id, account_data, attempt, first_attempt_at = futures.pop(future)
+                            try:
+                                future.result()
+                            except Exception as e:
+                                account_username = account_data.get('username')
+                                if should_retry_account(e) and retry_queue.schedule((user_id, account_data), attempt + 1, first_attempt_at):
+                                    logging.warning(f"Fetch failed for user {user_id}, account {account_username} (attempt {attempt}), retrying later: {e}")
+                                    continue
+                                elif should_retry_account(e):
+                                    logging.error(f"Giving up on user {user_id}, account {account_username} after {attempt} attempts: {e}")
+                                    self.circuit_breaker.record_failure(user_id, account_data, e)
+                                else:
+                                    logging.error(f"An error occurred while processing an account: {e}")
+                            self.account_done(user_id, account_data)
+            finally:
+                # Unblocks the producer if the loop exits early
+                stop.set()
+                producer.join()
+                if out_of_time:
+                    self.defer_remaining(work_queue, retry_queue)
+
+            logging.info("Metric scraping completed for all accounts." if not out_of_time else
+                         f"Metric scraping stopped at the deadline, {len(self.deferred_accounts)} accounts deferred.")
 
-        logging.info("Metric scraping completed for all accounts.")
+    def defer_remaining(self, work_queue, retry_queue):
+        """Moves the accounts still queued or waiting for a retry to deferred_accounts."""
+        for (user_id, account_data), _, _ in retry_queue.drain():
+            self.deferred_accounts.append((user_id, account_data))
+        while True:
+            try:
+                item = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not DISCOVERY_DONE:
+                self.deferred_accounts.append(item)
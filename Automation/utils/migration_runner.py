@@ -0,0 +1,230 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+from google.cloud.firestore_v1.field_path import FieldPath
+
+# Firestore rejects batches with more than 500 writes
+MAX_BATCH_SIZE = 500
+
+class Migration:
+    """
+    A schema fix applied to every document of a set of collections.
+
+    Subclasses set name (the checkpoint key) and implement collections() and migrate().
+    migrate() must return None for documents that are already in the target format,
+    which is what makes re-running a migration after a crash cheap and safe.
+    """
+    name = None
+
+    def collections(self, db):
+        """Yields the collection references to migrate. Each one keeps its own cursor."""
+        raise NotImplementedError
+
+    def migrate(self, data):
+        """Returns the fields to update on a document, or None to leave it unchanged."""
+        raise NotImplementedError
+
+def checkpoint_key(collection_path):
+    # Slashes aren't allowed in Firestore document IDs, nor in the map keys older checkpoints used
+    return collection_path.replace('/', '|')
+
+class FileCheckpointStore:
+    """Keeps migration checkpoints in a local JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def load(self, migration_name):
+        with self.lock:
+            return self._read().get(migration_name, {})
+
+    def _write(self, checkpoints):
+        # Write then rename so a crash never leaves a truncated checkpoint file
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoints, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def save(self, migration_name, collection_path, state):
+        with self.lock:
+            checkpoints = self._read()
+            checkpoints.setdefault(migration_name, {})[checkpoint_key(collection_path)] = state
+            self._write(checkpoints)
+
+    def reset(self, migration_name):
+        with self.lock:
+            checkpoints = self._read()
+            checkpoints.pop(migration_name, None)
+            self._write(checkpoints)
+
+class FirestoreCheckpointStore:
+    """
+    Keeps migration checkpoints in migrationCheckpoints/{migration name}/collections,
+    one document per migrated collection, so a migration over many collections never
+    grows a single document towards Firestore's size limit.
+    """
+
+    def __init__(self, db, collection='migrationCheckpoints'):
+        self.db = db
+        self.collection_ref = db.collection(collection)
+
+    def get_collections_ref(self, migration_name):
+        return self.collection_ref.document(migration_name).collection('collections')
+
+    def load(self, migration_name):
+        # Checkpoints saved before they had one document each are kept in the migration's document
+        snapshot = self.collection_ref.document(migration_name).get()
+        checkpoints = dict(snapshot.to_dict().get('collections', {})) if snapshot.exists else {}
+        for document in self.get_collections_ref(migration_name).stream():
+            state = document.to_dict()
+            state.pop('updated_at', None)
+            checkpoints[document.id] = state
+        return checkpoints
+
+    def save(self, migration_name, collection_path, state):
+        self.get_collections_ref(migration_name).document(checkpoint_key(collection_path)).set(dict(state, updated_at=SERVER_TIMESTAMP))
+
+    def reset(self, migration_name):
+        batch, pending = self.db.batch(), 0
+        for document in self.get_collections_ref(migration_name).select([]).stream():
+            batch.delete(document.reference)
+            pending += 1
+            if pending == MAX_BATCH_SIZE:
+                batch.commit()
+                batch, pending = self.db.batch(), 0
+        batch.delete(self.collection_ref.document(migration_name))
+        batch.commit()
+
+class RateLimiter:
+    """Token bucket shared by all workers, limiting document writes per second."""
+
+    def __init__(self, writes_per_second):
+        self.writes_per_second = writes_per_second
+        self.allowance = writes_per_second
+        self.last_check = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, writes):
+        if not self.writes_per_second:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.allowance = min(self.writes_per_second, self.allowance + (now - self.last_check) * self.writes_per_second)
+                self.last_check = now
+                # A batch larger than one second of budget is let through once the bucket is full
+                if self.allowance >= min(writes, self.writes_per_second):
+                    self.allowance -= writes
+                    return
+                wait = (min(writes, self.writes_per_second) - self.allowance) / self.writes_per_second
+            time.sleep(wait)
+
+class MigrationRunner:
+    """
+    Applies a Migration collection by collection, page by page in document ID order.
+
+    After each committed page the collection's cursor (last document ID) is saved to
+    the checkpoint store, so an interrupted run resumes where it stopped. With
+    max_workers > 1 collections are migrated in parallel.
+    """
+
+    def __init__(self, db, migration, checkpoint_store, batch_size=200, max_writes_per_second=None, max_workers=1, dry_run=False):
+        self.db = db
+        self.migration = migration
+        self.checkpoint_store = checkpoint_store
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.rate_limiter = RateLimiter(max_writes_per_second)
+        self.max_workers = max_workers
+        self.dry_run = dry_run
+        self.totals_lock = threading.Lock()
+        self.totals = {'collections': 0, 'scanned': 0, 'migrated': 0, 'skipped': 0}
+
+    def migrate_collection(self, collection_ref, state):
+        collection_path = f"{collection_ref.parent.path}/{collection_ref.id}" if collection_ref.parent else collection_ref.id
+        if state.get('done'):
+            return state
+
+        state = dict(state)
+        state.setdefault('scanned', 0)
+        state.setdefault('migrated', 0)
+        state.setdefault('skipped', 0)
+
+        base_query = collection_ref.order_by(FieldPath.document_id()).limit(self.batch_size)
+        while True:
+            query = base_query
+            if state.get('last_doc_id'):
+                query = query.start_after({FieldPath.document_id(): state['last_doc_id']})
+            documents = list(query.stream())
+
+            updates = []
+            for document in documents:
+                fields = self.migration.migrate(document.to_dict())
+                if fields:
+                    updates.append((document.reference, fields))
+
+            if updates and not self.dry_run:
+                self.rate_limiter.acquire(len(updates))
+                batch = self.db.batch()
+                for reference, fields in updates:
+                    batch.update(reference, fields)
+                batch.commit()
+
+            state['scanned'] += len(documents)
+            state['migrated'] += len(updates)
+            state['skipped'] += len(documents) - len(updates)
+            with self.totals_lock:
+                self.totals['scanned'] += len(documents)
+                self.totals['migrated'] += len(updates)
+                self.totals['skipped'] += len(documents) - len(updates)
+
+            if len(documents) < self.batch_size:
+                state['done'] = True
+            else:
+                state['last_doc_id'] = documents[-1].id
+
+            # Dry runs never advance the checkpoint
+            if not self.dry_run:
+                self.checkpoint_store.save(self.migration.name, collection_path, state)
+            if state.get('done'):
+                break
+
+        logging.info(f"Migrated {collection_path}: {state['migrated']} updated, {state['skipped']} already migrated")
+        return state
+
+    def run(self):
+        checkpoints = self.checkpoint_store.load(self.migration.name)
+        logging.info(f"Starting migration {self.migration.name} (dry_run={self.dry_run}, {len(checkpoints)} collections checkpointed)")
+        started_at = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for collection_ref in self.migration.collections(self.db):
+                collection_path = f"{collection_ref.parent.path}/{collection_ref.id}" if collection_ref.parent else collection_ref.id
+                state = checkpoints.get(checkpoint_key(collection_path), {})
+                if state.get('done'):
+                    continue
+                self.totals['collections'] += 1
+                futures[executor.submit(self.migrate_collection, collection_ref, state)] = collection_path
+
+            failed = []
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(futures[future])
+                    logging.error(f"Migration {self.migration.name} failed for {futures[future]}: {e}")
+
+        summary = dict(self.totals, failed=failed, elapsed_seconds=round(time.monotonic() - started_at, 2))
+        logging.info(f"Migration {self.migration.name} finished: {json.dumps(summary)}")
+        return summary
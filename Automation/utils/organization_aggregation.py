@@ -3,18 +3,19 @@ from datetime import datetime, timedelta
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
 from firebase_admin import firestore
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from utils.firestore_accounting import call_in_tenant
+from utils.storage import PooledClient, get_pooled_client
+from utils.metric_records import MetricSample, MetricTotals
+from utils.pipeline_metrics import stage_timer, submit_timed
 
 class OrganizationMetricsAggregator:
     def __init__(self, max_workers=10):
-        self.db = firestore.client()
+        # Worker threads each use their own pooled client, whichever of these they call
+        self.db = PooledClient()
         self.max_workers = max_workers
-        self.thread_local = threading.local()
 
     def get_db(self):
-        if not hasattr(self.thread_local, "db"):
-            self.thread_local.db = firestore.client()
-        return self.thread_local.db
+        return get_pooled_client()
 
     def format_timestamp(self, timestamp):
         return timestamp.strftime('%Y%m%d-%H%M')
@@ -22,20 +23,15 @@ class OrganizationMetricsAggregator:
     def aggregate_content_plan_metrics(self, org_id):
         db = self.get_db()
         current_timestamp = datetime.utcnow()
-        formatted_timestamp = self.format_timestamp(current_timestamp)
+        # Runs more often than hourly update the entry of their hour rather than adding entries off the hour
+        current_hour = current_timestamp.replace(minute=0, second=0, microsecond=0)
+        formatted_timestamp = self.format_timestamp(current_hour)
         current_date = current_timestamp.date()
 
         logging.info(f"Aggregating metrics for organization: {org_id}")
 
-        # Initialize aggregated metrics for the organization
-        aggregated_metrics = {
-            'comment_count': 0,
-            'like_count': 0,
-            'view_count': 0,
-            'share_count': 0,
-            'new_view_count': 0,
-            'timestamp': SERVER_TIMESTAMP  # Add timestamp for hourly entries
-        }
+        # Totals across every video of the organization's active content plans
+        totals = MetricTotals()
 
         # Fetch all active content plans for the organization
         plans_ref = db.collection('organizations').document(org_id).collection('contentPlans')
@@ -58,16 +54,20 @@ class OrganizationMetricsAggregator:
                     latest_metric = metrics_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).get()
 
                     if latest_metric:
-                        metric_data = latest_metric[0].to_dict()
-                        for key in aggregated_metrics:
-                            if key != 'timestamp':  # Don't add timestamp twice
-                                aggregated_metrics[key] += metric_data.get(key, 0)
+                        totals.add(MetricSample.from_dict(latest_metric[0].to_dict()))
+
+        aggregated_metrics = totals.to_dict()
+        # Hourly entries are timestamped on the hour they cover
+        aggregated_metrics['timestamp'] = current_hour
+        aggregated_metrics['updated_at'] = SERVER_TIMESTAMP
 
         org_metrics_ref = db.collection('organizations').document(org_id).collection('metrics')
 
         # Hourly aggregation logic (unchanged)
         hourly_metrics_ref = org_metrics_ref.document('hourly')
-        previous_hourly_entry = hourly_metrics_ref.collection('data').order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).get()
+        # new_view_count is relative to the previous hour, not to an earlier run in this one
+        previous_hourly_entry = hourly_metrics_ref.collection('data').where('timestamp', '<', current_hour) \
+            .order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).get()
 
         if previous_hourly_entry and previous_hourly_entry[0].exists:
             previous_entry_data = previous_hourly_entry[0].to_dict()
@@ -207,20 +207,21 @@ class OrganizationMetricsAggregator:
 
 
     def run(self):
-        db = self.get_db()
-        orgs_ref = db.collection('organizations')
-        orgs = orgs_ref.stream()
-
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            futures = []
-            for org in orgs:
-                org_id = org.id
-                futures.append(executor.submit(self.aggregate_content_plan_metrics, org_id))
-
-            for future in as_completed(futures):
-                try:
-                    future.result()
-                except Exception as e:
-                    logging.error(f"An error occurred while processing an organization: {e}")
-
-        logging.info("Organization metrics aggregation completed for all organizations.")
+        with stage_timer('organization_aggregation'):
+            db = self.get_db()
+            orgs_ref = db.collection('organizations')
+            orgs = orgs_ref.stream()
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = []
+                for org in orgs:
+                    org_id = org.id
+                    futures.append(submit_timed(executor, 'organization', call_in_tenant, org_id, self.aggregate_content_plan_metrics, org_id))
+
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"An error occurred while processing an organization: {e}")
+
+            logging.info("Organization metrics aggregation completed for all organizations.")
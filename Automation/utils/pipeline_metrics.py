@@ -0,0 +1,207 @@
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from utils.firestore_accounting import add_latency_listener, instrument
+
+PROMETHEUS_PREFIX = 'ovrsee'
+QUANTILES = (0.5, 0.95, 0.99)
+# Upper bounds of the latency buckets in seconds: four per decade from 1ms to 1000s,
+# so a quantile estimated within its bucket is off by at most a factor of 1.8
+BUCKET_BOUNDS = tuple(round(10 ** (exponent / 4), 6) for exponent in range(-12, 13))
+
+# Run that timings are currently recorded against
+_active_run = None
+
+class LatencyHistogram:
+    """
+    Counts the observations of one operation, in seconds, in the fixed BUCKET_BOUNDS
+    buckets, plus one for anything slower. Memory stays constant however many
+    operations a run makes; count, sum, min and max are exact, quantiles estimated.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        bucket = bisect.bisect_left(BUCKET_BOUNDS, seconds)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.sum += seconds
+            self.min = min(self.min, seconds)
+            self.max = max(self.max, seconds)
+
+    def cumulative_counts(self):
+        """(upper bound, observations at or below it) per bucket, ending with (inf, count)."""
+        with self.lock:
+            counts = list(self.counts)
+        cumulative, total = [], 0
+        for bound, bucket_count in zip(BUCKET_BOUNDS + (math.inf,), counts):
+            total += bucket_count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def quantile(self, quantile, counts, count, low, high):
+        # Nearest rank, interpolated linearly within its bucket and clamped to the observed range
+        rank = max(1, math.ceil(quantile * count))
+        below = 0
+        for bucket, bucket_count in enumerate(counts):
+            if below + bucket_count >= rank:
+                lower = BUCKET_BOUNDS[bucket - 1] if bucket else 0.0
+                upper = BUCKET_BOUNDS[bucket] if bucket < len(BUCKET_BOUNDS) else high
+                estimate = lower + (upper - lower) * (rank - below) / bucket_count
+                return min(max(estimate, low), high)
+            below += bucket_count
+        return high
+
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            count, total, low, high = self.count, self.sum, self.min, self.max
+        if not count:
+            return {'count': 0}
+        snapshot = {'count': count, 'sum': total, 'max': high}
+        for quantile in QUANTILES:
+            snapshot[f"p{int(quantile * 100)}"] = self.quantile(quantile, counts, count, low, high)
+        return snapshot
+
+class PipelineMetrics:
+    """
+    Stage wall times and latency distributions for one run of a job. Latencies are
+    recorded per operation: 'tiktok_api', 'firestore_read' and 'firestore_write',
+    plus the run and queue wait times of the tasks submitted with submit_timed().
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.histograms = {}
+
+    def observe(self, operation, seconds):
+        histogram = self.histograms.get(operation)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(operation, LatencyHistogram())
+        histogram.observe(seconds)
+
+    def record_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def summary(self):
+        with self.lock:
+            stages = dict(self.stages)
+            histograms = dict(self.histograms)
+        latencies = {}
+        for operation, histogram in sorted(histograms.items()):
+            snapshot = histogram.snapshot()
+            latencies[operation] = {key: round(value, 4) if isinstance(value, float) else value for key, value in snapshot.items()}
+        return {
+            'event': 'pipeline_metrics',
+            'job': self.job,
+            'stages': {stage: round(seconds, 3) for stage, seconds in stages.items()},
+            'latencies': latencies
+        }
+
+    def prometheus_text(self):
+        summary = self.summary()
+        lines = [
+            f"# HELP {PROMETHEUS_PREFIX}_stage_duration_seconds Wall time of each stage in the last run.",
+            f"# TYPE {PROMETHEUS_PREFIX}_stage_duration_seconds gauge"
+        ]
+        for stage, seconds in summary['stages'].items():
+            lines.append(f'{PROMETHEUS_PREFIX}_stage_duration_seconds{{job="{self.job}",stage="{stage}"}} {seconds}')
+
+        lines += [
+            f"# HELP {PROMETHEUS_PREFIX}_operation_latency_seconds Latency of TikTok API calls, Firestore RPCs and tasks in the last run.",
+            f"# TYPE {PROMETHEUS_PREFIX}_operation_latency_seconds histogram"
+        ]
+        with self.lock:
+            histograms = dict(self.histograms)
+        for operation, snapshot in summary['latencies'].items():
+            labels = f'job="{self.job}",operation="{operation}"'
+            for bound, count in histograms[operation].cumulative_counts():
+                le = '+Inf' if bound == math.inf else repr(bound)
+                lines.append(f'{PROMETHEUS_PREFIX}_operation_latency_seconds_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(f'{PROMETHEUS_PREFIX}_operation_latency_seconds_sum{{{labels}}} {snapshot.get("sum", 0)}')
+            lines.append(f'{PROMETHEUS_PREFIX}_operation_latency_seconds_count{{{labels}}} {snapshot["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # Written then renamed so a node_exporter textfile collector never reads a partial file
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+    def report(self):
+        """Logs the summary as one JSON line and writes it to PIPELINE_METRICS_PROMETHEUS_FILE when set."""
+        summary = self.summary()
+        logging.info(json.dumps(summary))
+        prometheus_path = os.getenv('PIPELINE_METRICS_PROMETHEUS_FILE')
+        if prometheus_path:
+            try:
+                self.write_prometheus(prometheus_path)
+            except OSError as e:
+                logging.error(f"Failed to write pipeline metrics to {prometheus_path}: {e}")
+        return summary
+
+def observe(operation, seconds):
+    if _active_run is not None:
+        _active_run.observe(operation, seconds)
+
+def record_stage(stage, seconds):
+    if _active_run is not None:
+        _active_run.record_stage(stage, seconds)
+
+def observe_firestore(kind, seconds):
+    observe(f"firestore_{kind}", seconds)
+
+def observe_tiktok_response(response, *args, **kwargs):
+    """requests response hook recording how long TikTok took to answer."""
+    observe('tiktok_api', response.elapsed.total_seconds())
+
+@contextmanager
+def stage_timer(stage):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started_at)
+
+def submit_timed(executor, task, fn, *args):
+    """
+    Submits fn(*args) to executor, recording how long it waited for a worker as
+    '<task>_queue_wait' and how long it ran as '<task>'. Long queue waits with short
+    API and Firestore latencies point at too few workers rather than slow backends.
+    """
+    submitted_at = time.perf_counter()
+
+    def timed():
+        started_at = time.perf_counter()
+        observe(f"{task}_queue_wait", started_at - submitted_at)
+        try:
+            return fn(*args)
+        finally:
+            observe(task, time.perf_counter() - started_at)
+
+    return executor.submit(timed)
+
+def start_run(job, db):
+    """Starts recording timings for a new run of job, including the Firestore RPCs made through db."""
+    global _active_run
+    instrument(db)
+    add_latency_listener(observe_firestore)
+    _active_run = PipelineMetrics(job)
+    return _active_run
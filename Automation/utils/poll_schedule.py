@@ -0,0 +1,102 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+# Field of each Videos document holding the video's next poll time
+VIDEO_NEXT_POLL_FIELD = 'next_poll_at'
+
+def as_utc(value):
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+class PollScheduler:
+    """
+    Decides when each tracked video is next worth polling, from its age and view
+    velocity (views per hour since its previous sample). A video is polled about when
+    it is expected to have gained target_views views, within the bounds its age
+    allows: uploads under a day old every 15 to 30 minutes, uploads under a week old
+    at least every 6 hours, everything else at least daily.
+
+    Each video's next poll time is kept on its Videos document (VIDEO_NEXT_POLL_FIELD),
+    which the scraper reads along with the tracked video IDs. The Account document
+    keeps poll_schedule.next_poll_at, the earliest of them, so accounts that are not
+    due are skipped without reading their videos. An account is due at least every
+    account_interval, so new uploads are still picked up from the video list when
+    none of its tracked videos are due.
+
+    Accounts scheduled before the times moved to the Videos documents have them in
+    poll_schedule.videos; those entries are used until each video is polled again.
+    """
+
+    def __init__(self, db, target_views=500, min_interval=timedelta(minutes=15),
+                 fresh_age=timedelta(hours=24), fresh_max_interval=timedelta(minutes=30),
+                 recent_age=timedelta(days=7), recent_max_interval=timedelta(hours=6),
+                 max_interval=timedelta(days=1), account_interval=timedelta(hours=1),
+                 tolerance=timedelta(minutes=5)):
+        self.db = db
+        self.target_views = target_views
+        self.min_interval = min_interval
+        self.fresh_age = fresh_age
+        self.fresh_max_interval = fresh_max_interval
+        self.recent_age = recent_age
+        self.recent_max_interval = recent_max_interval
+        self.max_interval = max_interval
+        self.account_interval = account_interval
+        # Items due within this long are polled now rather than on the next tick
+        self.tolerance = tolerance
+
+    def get_account_ref(self, user_id, account_username):
+        return self.db.collection('users').document(user_id).collection('SocialMediaPlatforms').document('TikTok').collection('Accounts').document(account_username)
+
+    def interval(self, age, velocity):
+        """Time until the next poll of a video age old gaining velocity views per hour."""
+        if age is not None and age < self.fresh_age:
+            max_interval = self.fresh_max_interval
+        elif age is not None and age < self.recent_age:
+            max_interval = self.recent_max_interval
+        else:
+            max_interval = self.max_interval
+        if not velocity or velocity <= 0:
+            return max_interval
+        return min(max_interval, max(self.min_interval, timedelta(hours=self.target_views / velocity)))
+
+    def next_poll_at(self, create_time, velocity, now):
+        """create_time is the upload time as a Unix timestamp, as TikTok reports it."""
+        age = now - datetime.fromtimestamp(create_time, timezone.utc) if isinstance(create_time, (int, float)) else None
+        return now + self.interval(age, velocity)
+
+    def is_due(self, next_poll_at, now):
+        return next_poll_at is None or as_utc(next_poll_at) <= now + self.tolerance
+
+    def is_account_due(self, account_data, now=None):
+        schedule = account_data.get('poll_schedule') or {}
+        return self.is_due(schedule.get('next_poll_at'), now or datetime.now(timezone.utc))
+
+    def video_next_polls(self, account_data, next_polls):
+        """next_polls (video ID -> stored next poll time or None), with the older per-account entries filled in."""
+        legacy = (account_data.get('poll_schedule') or {}).get('videos') or {}
+        return {video_id: next_poll_at if next_poll_at is not None else legacy.get(video_id) for video_id, next_poll_at in next_polls.items()}
+
+    def due_video_ids(self, account_data, next_polls, now):
+        """The videos of next_polls (video ID -> stored next poll time or None) that are due."""
+        return [video_id for video_id, next_poll_at in self.video_next_polls(account_data, next_polls).items() if self.is_due(next_poll_at, now)]
+
+    def record(self, user_id, account_data, next_polls, polled, now):
+        """
+        Stores the account's next poll after a poll. next_polls maps every video still
+        tracked to its stored next poll time (or None); polled maps the videos polled in
+        this run, which have stored their new one. Older per-account entries are kept only
+        for videos that haven't been polled since.
+        """
+        legacy = (account_data.get('poll_schedule') or {}).get('videos') or {}
+        videos = self.video_next_polls(account_data, next_polls)
+        videos.update(polled)
+        next_poll_at = min([as_utc(value) for value in videos.values() if value is not None] + [now + self.account_interval])
+        schedule = {'next_poll_at': next_poll_at, 'updated_at': now}
+        remaining = {video_id: legacy[video_id] for video_id, value in next_polls.items()
+                     if value is None and video_id in legacy and video_id not in polled}
+        if remaining:
+            schedule['videos'] = remaining
+        self.get_account_ref(user_id, account_data['username']).update({'poll_schedule': schedule})
+        account_data['poll_schedule'] = schedule
+        logging.info(f"Next poll for user {user_id}, account {account_data['username']} at {next_poll_at} ({len(polled)} of {len(videos)} videos polled)")
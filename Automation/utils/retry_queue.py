@@ -0,0 +1,78 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+class RetryPolicy:
+    """Backoff settings for work that is retried through a DelayedRetryQueue."""
+
+    def __init__(self, max_attempts=3, base_delay=2, max_delay=30, deadline=300, jitter=0.25):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # Seconds after a task's first attempt past which it is not retried
+        self.deadline = deadline
+        self.jitter = jitter
+
+    def next_delay(self, attempt):
+        """Delay in seconds before the given attempt (attempt 2 is the first retry)."""
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempt - 2)))
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+class DelayedRetryQueue:
+    """
+    Holds failed tasks until their backoff has elapsed, so the thread pool keeps
+    serving other work instead of sleeping. Tasks are popped by the thread that
+    owns the executor and resubmitted to it.
+    """
+
+    def __init__(self, policy, clock=time.monotonic):
+        self.policy = policy
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def schedule(self, task, attempt, first_attempt_at):
+        """
+        Queues task for the given attempt number. first_attempt_at is the clock() time
+        of its first attempt. Returns False when the task is out of attempts or would
+        only become ready after its deadline.
+        """
+        if attempt > self.policy.max_attempts:
+            return False
+        ready_at = self.clock() + self.policy.next_delay(attempt)
+        if self.policy.deadline is not None and ready_at > first_attempt_at + self.policy.deadline:
+            return False
+        with self._lock:
+            heapq.heappush(self._heap, (ready_at, next(self._counter), task, attempt, first_attempt_at))
+        return True
+
+    def pop_ready(self):
+        """Returns the (task, attempt, first_attempt_at) entries whose backoff has elapsed."""
+        now = self.clock()
+        ready = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, task, attempt, first_attempt_at = heapq.heappop(self._heap)
+                ready.append((task, attempt, first_attempt_at))
+        return ready
+
+    def next_ready_in(self):
+        """Seconds until the next task is ready, or None when the queue is empty."""
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(0, self._heap[0][0] - self.clock())
+
+    def drain(self):
+        """Removes and returns every queued (task, attempt, first_attempt_at) entry, ready or not."""
+        with self._lock:
+            drained = [(task, attempt, first_attempt_at) for _, _, task, attempt, first_attempt_at in sorted(self._heap)]
+            self._heap = []
+        return drained
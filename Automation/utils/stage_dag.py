@@ -0,0 +1,218 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from utils.firestore_accounting import call_in_tenant, stage_scope
+from utils.pipeline_metrics import record_stage, stage_timer, submit_timed
+
+def account_key(user_id, account_username):
+    return ('account', user_id, account_username)
+
+def video_account_key(video_ref):
+    """The account key of a users/{user}/SocialMediaPlatforms/TikTok/Accounts/{account}/Videos/{video} reference."""
+    parts = video_ref.path.split('/')
+    if len(parts) < 6 or parts[0] != 'users' or parts[4] != 'Accounts':
+        return None
+    return account_key(parts[1], parts[5])
+
+class DependencyScheduler:
+    """
+    Runs each task on executor as soon as every key it depends on is done. A key is
+    either another task, done once it finishes (whether or not it raised), or an
+    external event reported with done(), such as an account finishing its scrape.
+    Tasks that become ready after the deadline are not run but listed in skipped.
+
+    Tasks of a stage interleave with each other and with the scrape, so a stage's
+    wall time is recorded by record_stages() as the span from its first task's start
+    to its last task's finish.
+    """
+
+    def __init__(self, executor, deadline=None):
+        self.executor = executor
+        self.deadline = deadline
+        self.skipped = []
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        # task key -> (task, fn, args, stage, keys it still waits for)
+        self.waiting = {}
+        # key -> task keys waiting for it
+        self.dependents = defaultdict(list)
+        self.completed = set()
+        self.tasks = set()
+        self.running = 0
+        # stage -> [first task start, last task finish], in perf_counter seconds
+        self.spans = {}
+
+    def add(self, key, task, fn, *args, depends_on=(), stage=None):
+        """Schedules fn(*args) to run once every key in depends_on is done."""
+        with self.lock:
+            self.tasks.add(key)
+            remaining = {dependency for dependency in depends_on if dependency not in self.completed}
+            if remaining:
+                self.waiting[key] = (task, fn, args, stage, remaining)
+                for dependency in remaining:
+                    self.dependents[dependency].append(key)
+                return
+            self.running += 1
+        self._submit(key, task, fn, args, stage)
+
+    def done(self, key):
+        """Marks key done and starts the tasks that were only waiting for it."""
+        ready = []
+        with self.lock:
+            if key in self.completed:
+                return
+            self.completed.add(key)
+            for dependent in self.dependents.pop(key, ()):
+                task, fn, args, stage, remaining = self.waiting[dependent]
+                remaining.discard(key)
+                if not remaining:
+                    del self.waiting[dependent]
+                    self.running += 1
+                    ready.append((dependent, task, fn, args, stage))
+        for entry in ready:
+            self._submit(*entry)
+
+    def release(self):
+        """
+        Marks every external key still waited for as done, once no more will be
+        reported (e.g. accounts that were skipped, or not found by the scrape).
+        """
+        with self.lock:
+            external = [key for key in self.dependents if key not in self.tasks]
+        for key in external:
+            self.done(key)
+
+    def wait(self):
+        """Blocks until every task that can run has finished, including tasks started meanwhile."""
+        with self.finished:
+            while self.running:
+                self.finished.wait()
+            if self.waiting:
+                logging.warning(f"{len(self.waiting)} tasks never became ready")
+
+    def record_stages(self):
+        """Records the span of every stage that ran a task with the active pipeline metrics."""
+        with self.lock:
+            spans = {stage: finished_at - started_at for stage, (started_at, finished_at) in self.spans.items()}
+        for stage, seconds in spans.items():
+            record_stage(stage, seconds)
+
+    def _submit(self, key, task, fn, args, stage):
+        if self.deadline is not None and self.deadline.reached():
+            # Dependents are released (and skipped in turn) before this task stops counting as running
+            self.done(key)
+            with self.finished:
+                self.skipped.append(key)
+                self.running -= 1
+                self.finished.notify_all()
+            return
+        submit_timed(self.executor, task, self._run, key, task, fn, args, stage)
+
+    def _run(self, key, task, fn, args, stage):
+        if stage is not None:
+            with self.lock:
+                self.spans.setdefault(stage, [time.perf_counter(), None])
+        try:
+            if stage is None:
+                fn(*args)
+            else:
+                with stage_scope(stage, default=False):
+                    fn(*args)
+        except Exception as e:
+            logging.error(f"An error occurred while running {task} {key[1:]}: {e}")
+        finally:
+            if stage is not None:
+                with self.lock:
+                    self.spans[stage][1] = time.perf_counter()
+            self.done(key)
+            with self.finished:
+                self.running -= 1
+                self.finished.notify_all()
+
+def iter_org_ids(orgs_ref, first=()):
+    """Yields the organization IDs in first, then every other organization's."""
+    yield from first
+    for org in orgs_ref.select([]).stream():
+        if org.id not in first:
+            yield org.id
+
+def register_aggregations(scheduler, db, plan_aggregator, org_aggregator, first_org_ids=()):
+    """
+    Adds one task per active content plan, waiting for the accounts its videos belong
+    to, and one per organization, waiting for its plans. The organizations in
+    first_org_ids (e.g. those a previous run didn't finish) are registered first.
+    """
+    with stage_scope('content_plan_aggregation', default=False):
+        orgs_ref = db.collection('organizations')
+        for org_id in iter_org_ids(orgs_ref, first_org_ids):
+            if scheduler.deadline is not None and scheduler.deadline.reached():
+                # Anything registered now would only be skipped
+                return
+            plan_keys = []
+            plans_ref = orgs_ref.document(org_id).collection('contentPlans')
+            for plan in plans_ref.where('status', '==', 'active').stream():
+                accounts = set()
+                for video in plans_ref.document(plan.id).collection('videos').select(['originalVideoRef']).stream():
+                    video_ref = video.to_dict().get('originalVideoRef')
+                    key = video_account_key(video_ref) if video_ref is not None else None
+                    if key is not None:
+                        accounts.add(key)
+                plan_key = ('plan', org_id, plan.id)
+                plan_keys.append(plan_key)
+                scheduler.add(plan_key, 'content_plan', call_in_tenant, org_id, plan_aggregator.process_content_plan, org_id, plan.id, plan.to_dict(),
+                              depends_on=accounts, stage='content_plan_aggregation')
+            scheduler.add(('organization', org_id), 'organization', call_in_tenant, org_id, org_aggregator.aggregate_content_plan_metrics, org_id,
+                          depends_on=plan_keys, stage='organization_aggregation')
+
+def run_pipeline(scraper, plan_aggregator, org_aggregator, max_workers=10, deadline=None, checkpoints=None):
+    """
+    Scrapes every account with scraper and overlaps the aggregations with it: a plan
+    is aggregated as soon as the accounts feeding it have been scraped, and an
+    organization as soon as its plans are done, instead of each stage waiting for
+    the previous one to finish entirely.
+
+    With a deadline, no account or aggregation is started once it is reached. What
+    was left is saved to checkpoints (a CheckpointStore), and the next run resumes
+    with those accounts and organizations first.
+    """
+    checkpoint = checkpoints.load() if checkpoints is not None else None
+    scraper.deadline = deadline
+    scraper.resume_from = checkpoint
+
+    with stage_timer('pipeline'), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        scheduler = DependencyScheduler(executor, deadline)
+
+        def register():
+            try:
+                first_org_ids = (checkpoint or {}).get('pending_organizations') or ()
+                register_aggregations(scheduler, plan_aggregator.get_db(), plan_aggregator, org_aggregator, first_org_ids)
+            except Exception as e:
+                logging.error(f"Failed to list content plans and organizations to aggregate: {e}")
+
+        # Listing plans and their accounts runs alongside the scrape
+        registration = threading.Thread(target=register, name='aggregation-registration', daemon=True)
+        registration.start()
+        scraper.on_account_done = lambda user_id, account_username: scheduler.done(account_key(user_id, account_username))
+        try:
+            with stage_scope('scrape'):
+                scraper.run()
+        finally:
+            registration.join()
+            # Accounts the scrape never reported no longer hold up their plans
+            scheduler.release()
+            scheduler.wait()
+            scheduler.record_stages()
+
+    if checkpoints is None:
+        return
+    state = scraper.checkpoint_state()
+    if state is not None or scheduler.skipped:
+        # Resuming registers all of a skipped task's organization again, plans included
+        checkpoints.save(dict(
+            state or {'pending_accounts': [], 'resume_after_user': None},
+            pending_organizations=sorted({key[1] for key in scheduler.skipped})
+        ))
+    elif checkpoint is not None:
+        checkpoints.clear()
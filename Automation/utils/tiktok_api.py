@@ -1,40 +1,132 @@
 import logging
 import os
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlencode
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential
+from utils.tiktok_fixtures import configure_session
+
+VIDEO_FIELDS = 'cover_image_url,id,title,video_description,duration,embed_link,like_count,comment_count,share_count,view_count,create_time'
+# The video query endpoint accepts at most 20 IDs per request
+MAX_QUERY_VIDEO_IDS = 20
+
+def is_retryable_error(exception):
+    """Client errors other than rate limiting (e.g. an expired token) will not succeed on retry."""
+    if isinstance(exception, requests.exceptions.HTTPError) and exception.response is not None:
+        status_code = exception.response.status_code
+        return status_code == 429 or status_code >= 500
+    return True
+
+def collect_videos_since(pages, cutoff):
+    """
+    Collects pages from fetch_video_list until a page reaches a video created before
+    cutoff (Unix seconds). Pages after that one are never requested.
+    """
+    videos = []
+    for page in pages:
+        videos.extend(page)
+        if any(isinstance(video.get('create_time'), int) and video['create_time'] < cutoff for video in page):
+            break
+    return videos
 
 class TikTokAPI:
-    def __init__(self):
+    def __init__(self, pool_size=10, max_attempts=3):
         self.platform_name = 'TikTok'
         self.client_key = os.getenv('TIKTOK_CLIENT_KEY')
         self.client_secret = os.getenv('TIKTOK_CLIENT_SECRET')
-        self.video_list_url = "https://open.tiktokapis.com/v2/video/list/"
+        # Overridden to point at a local fake server for offline benchmarks
+        self.base_url = os.getenv('TIKTOK_API_BASE_URL', 'https://open.tiktokapis.com').rstrip('/')
+        self.video_list_url = f"{self.base_url}/v2/video/list/"
+        self.video_query_url = f"{self.base_url}/v2/video/query/"
+        self.token_url = f"{self.base_url}/v2/oauth/token/"
+        # Callers that schedule their own retries pass max_attempts=1 so workers never sleep here
+        self.max_attempts = max_attempts
 
-    def fetch_video_list(self, access_token, open_id):
+        # Shared by every thread using this client so connections are reused
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount(self.base_url, adapter)
+        # TIKTOK_API_MODE=record|replay captures responses to fixtures or serves them offline
+        configure_session(self.session, self.base_url)
+
+    def fetch_video_list(self, access_token, open_id, max_count=20):
+        """
+        Yields the account's videos one page (list) at a time, newest first, following
+        the endpoint's cursor while has_more is set. Each page is only requested when
+        the consumer asks for it, so stopping early saves the remaining requests.
+        """
         headers = {
             'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json'
         }
         params = {
-            'fields': 'cover_image_url,id,title,video_description,duration,embed_link,like_count,comment_count,share_count,view_count,create_time'
+            'fields': VIDEO_FIELDS
+        }
+        url = self.video_list_url + '?' + urlencode(params)
+        cursor = None
+        while True:
+            data = {
+                'open_id': open_id,
+                'max_count': max_count
+            }
+            if cursor is not None:
+                data['cursor'] = cursor
+            response = self.make_request('POST', url, headers=headers, data=data)
+            page = response.json().get('data', {})
+            logging.info("Video list page fetched successfully")
+            yield page.get('videos', [])
+
+            cursor = page.get('cursor')
+            if not page.get('has_more') or cursor is None:
+                return
+
+    def query_videos(self, access_token, video_ids):
+        """Fetches specific videos by ID, MAX_QUERY_VIDEO_IDS per request. Deleted or private videos are omitted."""
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
         }
+        url = self.video_query_url + '?' + urlencode({'fields': VIDEO_FIELDS})
+        videos = []
+        for start in range(0, len(video_ids), MAX_QUERY_VIDEO_IDS):
+            data = {
+                'filters': {
+                    'video_ids': video_ids[start:start + MAX_QUERY_VIDEO_IDS]
+                }
+            }
+            response = self.make_request('POST', url, headers=headers, data=data)
+            videos.extend(response.json().get('data', {}).get('videos', []))
+        logging.info(f"Queried {len(video_ids)} videos, {len(videos)} returned")
+        return videos
+
+    def refresh_access_token(self, refresh_token):
+        if not self.client_key or not self.client_secret:
+            raise ValueError("TIKTOK_CLIENT_KEY and TIKTOK_CLIENT_SECRET must be set")
+
         data = {
-            'open_id': open_id,
-            'max_count': 20
+            'client_key': self.client_key,
+            'client_secret': self.client_secret,
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token
         }
-        url = self.video_list_url + '?' + urlencode(params)
-        response = self.make_request('POST', url, headers=headers, data=data)
-        logging.info("Video list fetched successfully")
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Cache-Control': 'no-cache'
+        }
+        response = self.session.post(self.token_url, data=urlencode(data), headers=headers)
+        response.raise_for_status()
         return response.json()
 
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10))
     def make_request(self, method, url, headers=None, params=None, data=None):
+        retrying = Retrying(stop=stop_after_attempt(self.max_attempts), wait=wait_exponential(multiplier=1, min=2, max=10),
+                            retry=retry_if_exception(is_retryable_error), reraise=True)
+        return retrying(self.send_request, method, url, headers=headers, params=params, data=data)
+
+    def send_request(self, method, url, headers=None, params=None, data=None):
         try:
-            response = requests.request(method, url, headers=headers, params=params, json=data)
+            response = self.session.request(method, url, headers=headers, params=params, json=data)
             response.raise_for_status()
             return response
         except requests.exceptions.HTTPError as e:
             logging.error(f"HTTPError: {e.response.status_code} - {e.response.text}")
             raise
-
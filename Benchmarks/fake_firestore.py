@@ -0,0 +1,509 @@
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.api_core import exceptions
+from google.auth.credentials import AnonymousCredentials
+from google.cloud.firestore_v1.field_path import parse_field_path
+from google.cloud.firestore_v1.types import document as document_types
+from google.cloud.firestore_v1.types import firestore as firestore_types
+from google.cloud.firestore_v1.types import query as query_types
+from google.cloud.firestore_v1.types import write as write_types
+from google.protobuf import timestamp_pb2
+from google.rpc import status_pb2
+
+PROJECT_ID = 'benchmark'
+DOCUMENTS_ROOT = f"projects/{PROJECT_ID}/databases/(default)/documents"
+
+Value = document_types.Value.pb()
+MapValue = document_types.MapValue.pb()
+Document = document_types.Document.pb()
+WriteResult = write_types.WriteResult.pb()
+Operator = query_types.StructuredQuery.FieldFilter.Operator
+CompositeOperator = query_types.StructuredQuery.CompositeFilter.Operator
+UnaryOperator = query_types.StructuredQuery.UnaryFilter.Operator
+Direction = query_types.StructuredQuery.Direction
+
+class LatencyModel:
+    """Per-call latency injected into every fake RPC, in seconds, with +/- jitter as a fraction."""
+
+    def __init__(self, read_seconds=0.0, write_seconds=0.0, jitter=0.0):
+        self.read_seconds = read_seconds
+        self.write_seconds = write_seconds
+        self.jitter = jitter
+        self.enabled = True
+
+    def wait(self, kind):
+        seconds = self.read_seconds if kind == 'read' else self.write_seconds
+        if self.enabled and seconds > 0:
+            time.sleep(seconds * (1 + random.uniform(-self.jitter, self.jitter)))
+
+def value_key(value):
+    """Sort key following Firestore's cross-type value ordering."""
+    kind = value.WhichOneof('value_type')
+    if kind == 'null_value' or kind is None:
+        return (0, 0)
+    if kind == 'boolean_value':
+        return (1, value.boolean_value)
+    if kind == 'integer_value':
+        return (2, value.integer_value)
+    if kind == 'double_value':
+        return (2, value.double_value)
+    if kind == 'timestamp_value':
+        return (3, (value.timestamp_value.seconds, value.timestamp_value.nanos))
+    if kind == 'string_value':
+        return (4, value.string_value)
+    if kind == 'bytes_value':
+        return (5, value.bytes_value)
+    if kind == 'reference_value':
+        return (6, tuple(value.reference_value.split('/')))
+    if kind == 'geo_point_value':
+        return (7, (value.geo_point_value.latitude, value.geo_point_value.longitude))
+    if kind == 'array_value':
+        return (8, tuple(value_key(item) for item in value.array_value.values))
+    return (9, tuple(sorted((key, value_key(item)) for key, item in value.map_value.fields.items())))
+
+def get_path(fields, parts):
+    """Returns the Value at parts inside a map field container, or None."""
+    for index, part in enumerate(parts):
+        if part not in fields:
+            return None
+        value = fields[part]
+        if index == len(parts) - 1:
+            return value
+        if value.WhichOneof('value_type') != 'map_value':
+            return None
+        fields = value.map_value.fields
+    return None
+
+def set_path(fields, parts, value):
+    for part in parts[:-1]:
+        child = fields[part]
+        if child.WhichOneof('value_type') != 'map_value':
+            child.Clear()
+            child.map_value.SetInParent()
+        fields = child.map_value.fields
+    fields[parts[-1]].CopyFrom(value)
+
+def delete_path(fields, parts):
+    for part in parts[:-1]:
+        if part not in fields or fields[part].WhichOneof('value_type') != 'map_value':
+            return
+        fields = fields[part].map_value.fields
+    if parts[-1] in fields:
+        del fields[parts[-1]]
+
+def numeric(value):
+    kind = value.WhichOneof('value_type')
+    if kind == 'integer_value':
+        return value.integer_value
+    if kind == 'double_value':
+        return value.double_value
+    return None
+
+def numeric_value(number):
+    value = Value()
+    if isinstance(number, int):
+        value.integer_value = number
+    else:
+        value.double_value = number
+    return value
+
+class StoredDocument:
+    __slots__ = ('fields', 'create_time', 'update_time')
+
+    def __init__(self, fields, create_time, update_time):
+        # A MapValue that is replaced, never mutated, once stored
+        self.fields = fields
+        self.create_time = create_time
+        self.update_time = update_time
+
+class FakeFirestoreAPI:
+    """
+    In-memory stand-in for the Firestore GAPIC client that google.cloud.firestore.Client
+    calls into, so the real client library (references, queries, batches, BulkWriter,
+    transforms, cursors, transactions) runs unchanged on top of it. Implements commit,
+    batch_write, batch_get_documents, run_query and begin_transaction/rollback, with
+    latency injected per call and every document read, write, delete and query
+    counted in stats.
+    """
+
+    def __init__(self, latency=None):
+        self.latency = latency or LatencyModel()
+        self.lock = threading.RLock()
+        # collection path -> {document id: StoredDocument}
+        self.collections = defaultdict(dict)
+        # collection id -> collection paths, for collection group queries
+        self.collection_groups = defaultdict(set)
+        self.stats = Counter()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = Counter()
+
+    def count(self, **counts):
+        with self.lock:
+            self.stats.update(counts)
+
+    # Paths
+
+    @staticmethod
+    def relative_path(name):
+        if name == DOCUMENTS_ROOT:
+            return ''
+        prefix = DOCUMENTS_ROOT + '/'
+        if not name.startswith(prefix):
+            raise exceptions.InvalidArgument(f"Unexpected resource name {name}")
+        return name[len(prefix):]
+
+    def split_document(self, name):
+        path = self.relative_path(name)
+        collection_path, _, document_id = path.rpartition('/')
+        return collection_path, document_id
+
+    def lookup(self, name):
+        collection_path, document_id = self.split_document(name)
+        return self.collections.get(collection_path, {}).get(document_id)
+
+    def to_document_pb(self, name, stored, mask=None):
+        document_pb = Document(name=name, create_time=stored.create_time, update_time=stored.update_time)
+        if mask is None:
+            document_pb.fields.MergeFrom(stored.fields.fields)
+        else:
+            for field_path in mask:
+                parts = parse_field_path(field_path)
+                value = get_path(stored.fields.fields, parts)
+                if value is not None:
+                    set_path(document_pb.fields, parts, value)
+        return document_pb
+
+    # Writes
+
+    def apply_transform(self, fields, transform, commit_time):
+        parts = parse_field_path(transform.field_path)
+        current = get_path(fields, parts)
+        kind = transform.WhichOneof('transform_type')
+        if kind == 'set_to_server_value':
+            result = Value(timestamp_value=commit_time)
+        elif kind in ('increment', 'maximum', 'minimum'):
+            operand = numeric(getattr(transform, kind))
+            base = numeric(current) if current is not None else None
+            if kind == 'increment':
+                result = numeric_value((base or 0) + operand)
+            elif base is None:
+                result = numeric_value(operand)
+            else:
+                result = numeric_value(max(base, operand) if kind == 'maximum' else min(base, operand))
+        elif kind == 'append_missing_elements':
+            result = Value()
+            result.array_value.SetInParent()
+            if current is not None and current.WhichOneof('value_type') == 'array_value':
+                result.array_value.values.extend(current.array_value.values)
+            keys = {value_key(item) for item in result.array_value.values}
+            for item in transform.append_missing_elements.values:
+                if value_key(item) not in keys:
+                    keys.add(value_key(item))
+                    result.array_value.values.append(item)
+        elif kind == 'remove_all_from_array':
+            removed = {value_key(item) for item in transform.remove_all_from_array.values}
+            result = Value()
+            result.array_value.SetInParent()
+            if current is not None and current.WhichOneof('value_type') == 'array_value':
+                result.array_value.values.extend(item for item in current.array_value.values if value_key(item) not in removed)
+        else:
+            raise exceptions.InvalidArgument(f"Unsupported transform {kind}")
+        set_path(fields, parts, result)
+        return result
+
+    def apply_write(self, write_pb, commit_time):
+        kind = write_pb.WhichOneof('operation')
+        name = write_pb.delete if kind == 'delete' else write_pb.update.name
+        collection_path, document_id = self.split_document(name)
+        existing = self.collections.get(collection_path, {}).get(document_id)
+
+        if write_pb.HasField('current_document'):
+            condition = write_pb.current_document
+            if condition.WhichOneof('condition_type') == 'exists':
+                if condition.exists and existing is None:
+                    raise exceptions.NotFound(f"No document to update: {name}")
+                if not condition.exists and existing is not None:
+                    raise exceptions.Conflict(f"Document already exists: {name}")
+
+        if kind == 'delete':
+            if existing is not None:
+                del self.collections[collection_path][document_id]
+            self.stats['deletes'] += 1
+            return WriteResult(update_time=commit_time)
+
+        fields = MapValue()
+        if write_pb.HasField('update_mask'):
+            if existing is not None:
+                fields.CopyFrom(existing.fields)
+            for field_path in write_pb.update_mask.field_paths:
+                parts = parse_field_path(field_path)
+                value = get_path(write_pb.update.fields, parts)
+                if value is None:
+                    delete_path(fields.fields, parts)
+                else:
+                    set_path(fields.fields, parts, value)
+        else:
+            fields.fields.MergeFrom(write_pb.update.fields)
+
+        transform_results = [self.apply_transform(fields.fields, transform, commit_time) for transform in write_pb.update_transforms]
+
+        create_time = existing.create_time if existing is not None else commit_time
+        self.collections[collection_path][document_id] = StoredDocument(fields, create_time, commit_time)
+        self.collection_groups[collection_path.rpartition('/')[2]].add(collection_path)
+        self.stats['writes'] += 1
+        return WriteResult(update_time=commit_time, transform_results=transform_results)
+
+    def commit_time(self):
+        commit_time = timestamp_pb2.Timestamp()
+        commit_time.GetCurrentTime()
+        return commit_time
+
+    def commit(self, request, metadata=None, **kwargs):
+        self.latency.wait('write')
+        writes = [getattr(write, '_pb', write) for write in request['writes']]
+        with self.lock:
+            self.stats['rpc_commit'] += 1
+            commit_time = self.commit_time()
+            # Commits are atomic, so every precondition is checked before anything is applied
+            snapshot = {path: dict(documents) for path, documents in self.collections.items()}
+            try:
+                results = [self.apply_write(write_pb, commit_time) for write_pb in writes]
+            except exceptions.GoogleAPICallError:
+                self.collections = defaultdict(dict, snapshot)
+                raise
+        response = firestore_types.CommitResponse.pb()(write_results=results, commit_time=commit_time)
+        return firestore_types.CommitResponse.wrap(response)
+
+    def batch_write(self, request, metadata=None, **kwargs):
+        self.latency.wait('write')
+        results, statuses = [], []
+        with self.lock:
+            self.stats['rpc_batch_write'] += 1
+            commit_time = self.commit_time()
+            # Unlike commits, each write in a batch_write succeeds or fails on its own
+            for write in request['writes']:
+                try:
+                    results.append(self.apply_write(getattr(write, '_pb', write), commit_time))
+                    statuses.append(status_pb2.Status(code=0))
+                except exceptions.GoogleAPICallError as e:
+                    results.append(WriteResult())
+                    statuses.append(status_pb2.Status(code=e.grpc_status_code.value[0], message=e.message))
+        response = firestore_types.BatchWriteResponse.pb()(write_results=results, status=statuses)
+        return firestore_types.BatchWriteResponse.wrap(response)
+
+    def begin_transaction(self, request, metadata=None, **kwargs):
+        # Transactions only get an ID: their reads hold no locks, and their commit is
+        # applied like any other, so contention between them isn't modeled
+        with self.lock:
+            self.stats['rpc_begin_transaction'] += 1
+            transaction_id = self.stats['rpc_begin_transaction'].to_bytes(8, 'big')
+        response = firestore_types.BeginTransactionResponse.pb()(transaction=transaction_id)
+        return firestore_types.BeginTransactionResponse.wrap(response)
+
+    def rollback(self, request, metadata=None, **kwargs):
+        with self.lock:
+            self.stats['rpc_rollback'] += 1
+
+    # Reads
+
+    def batch_get_documents(self, request, metadata=None, **kwargs):
+        self.latency.wait('read')
+        mask = list(request['mask'].field_paths) if request.get('mask') else None
+        response_class = firestore_types.BatchGetDocumentsResponse.pb()
+        responses = []
+        with self.lock:
+            self.stats['rpc_batch_get_documents'] += 1
+            read_time = self.commit_time()
+            for name in request['documents']:
+                stored = self.lookup(name)
+                if stored is None:
+                    responses.append(response_class(missing=name, read_time=read_time))
+                else:
+                    responses.append(response_class(found=self.to_document_pb(name, stored, mask), read_time=read_time))
+            self.stats['reads'] += len(responses)
+        return iter([firestore_types.BatchGetDocumentsResponse.wrap(response) for response in responses])
+
+    def field_value(self, name, stored, field_path):
+        if field_path == '__name__':
+            return Value(reference_value=name)
+        return get_path(stored.fields.fields, parse_field_path(field_path))
+
+    def matches(self, filter_pb, name, stored):
+        kind = filter_pb.WhichOneof('filter_type')
+        if kind == 'composite_filter':
+            results = (self.matches(child, name, stored) for child in filter_pb.composite_filter.filters)
+            return any(results) if filter_pb.composite_filter.op == CompositeOperator.OR else all(results)
+
+        if kind == 'unary_filter':
+            value = self.field_value(name, stored, filter_pb.unary_filter.field.field_path)
+            op = filter_pb.unary_filter.op
+            if value is None:
+                return False
+            is_null = value.WhichOneof('value_type') == 'null_value'
+            is_nan = value.WhichOneof('value_type') == 'double_value' and value.double_value != value.double_value
+            return {UnaryOperator.IS_NULL: is_null, UnaryOperator.IS_NOT_NULL: not is_null,
+                    UnaryOperator.IS_NAN: is_nan, UnaryOperator.IS_NOT_NAN: not is_nan}[op]
+
+        field_filter = filter_pb.field_filter
+        value = self.field_value(name, stored, field_filter.field.field_path)
+        op = field_filter.op
+        if value is None:
+            return False
+        key, operand = value_key(value), field_filter.value
+        if op == Operator.EQUAL:
+            return key == value_key(operand)
+        if op == Operator.NOT_EQUAL:
+            return key != value_key(operand) and key[0] != 0
+        if op == Operator.IN:
+            return key in {value_key(item) for item in operand.array_value.values}
+        if op == Operator.NOT_IN:
+            return key[0] != 0 and key not in {value_key(item) for item in operand.array_value.values}
+        if op in (Operator.ARRAY_CONTAINS, Operator.ARRAY_CONTAINS_ANY):
+            if value.WhichOneof('value_type') != 'array_value':
+                return False
+            wanted = [operand] if op == Operator.ARRAY_CONTAINS else list(operand.array_value.values)
+            elements = {value_key(item) for item in value.array_value.values}
+            return any(value_key(item) in elements for item in wanted)
+        operand_key = value_key(operand)
+        # Range filters only match values of the same type
+        if key[0] != operand_key[0]:
+            return False
+        if op == Operator.LESS_THAN:
+            return key < operand_key
+        if op == Operator.LESS_THAN_OR_EQUAL:
+            return key <= operand_key
+        if op == Operator.GREATER_THAN:
+            return key > operand_key
+        if op == Operator.GREATER_THAN_OR_EQUAL:
+            return key >= operand_key
+        raise exceptions.InvalidArgument(f"Unsupported operator {op}")
+
+    @staticmethod
+    def compare_to_cursor(document_keys, cursor, directions):
+        for index, value in enumerate(cursor.values):
+            left, right = document_keys[index], value_key(value)
+            if left != right:
+                result = -1 if left < right else 1
+                return -result if directions[index] == Direction.DESCENDING else result
+        return 0
+
+    def run_query(self, request, metadata=None, **kwargs):
+        self.latency.wait('read')
+        structured_query = getattr(request['structured_query'], '_pb', request['structured_query'])
+        parent = self.relative_path(request['parent'])
+        selector = structured_query.from_[0]
+
+        with self.lock:
+            self.stats['rpc_run_query'] += 1
+            self.stats['queries'] += 1
+            if selector.all_descendants:
+                collection_paths = [
+                    path for path in self.collection_groups.get(selector.collection_id, ())
+                    if not parent or path.startswith(parent + '/')
+                ]
+            else:
+                collection_paths = [f"{parent}/{selector.collection_id}" if parent else selector.collection_id]
+            candidates = [
+                (f"{DOCUMENTS_ROOT}/{path}/{document_id}", stored)
+                for path in collection_paths
+                for document_id, stored in self.collections.get(path, {}).items()
+            ]
+
+        if structured_query.HasField('where'):
+            candidates = [(name, stored) for name, stored in candidates if self.matches(structured_query.where, name, stored)]
+
+        orders = [(order.field.field_path, order.direction) for order in structured_query.order_by]
+        if not orders or orders[-1][0] != '__name__':
+            orders.append(('__name__', orders[-1][1] if orders else Direction.ASCENDING))
+        directions = [direction for _, direction in orders]
+
+        rows = []
+        for name, stored in candidates:
+            values = [self.field_value(name, stored, field_path) for field_path, _ in orders]
+            # Documents missing an ordered field are left out, as in Firestore
+            if any(value is None for value in values):
+                continue
+            rows.append(([value_key(value) for value in values], name, stored))
+        for index in reversed(range(len(orders))):
+            rows.sort(key=lambda row: row[0][index], reverse=directions[index] == Direction.DESCENDING)
+
+        if structured_query.HasField('start_at'):
+            cursor = structured_query.start_at
+            rows = [row for row in rows if (self.compare_to_cursor(row[0], cursor, directions) >= 0 if cursor.before else self.compare_to_cursor(row[0], cursor, directions) > 0)]
+        if structured_query.HasField('end_at'):
+            cursor = structured_query.end_at
+            rows = [row for row in rows if (self.compare_to_cursor(row[0], cursor, directions) < 0 if cursor.before else self.compare_to_cursor(row[0], cursor, directions) <= 0)]
+        rows = rows[structured_query.offset:]
+        if structured_query.HasField('limit'):
+            rows = rows[:structured_query.limit.value]
+
+        mask = [field.field_path for field in structured_query.select.fields] if structured_query.HasField('select') else None
+        response_class = firestore_types.RunQueryResponse.pb()
+        read_time = self.commit_time()
+        responses = [response_class(document=self.to_document_pb(name, stored, mask), read_time=read_time) for _, name, stored in rows]
+        if not responses:
+            # Empty results still carry a read time, and are billed one read
+            responses.append(response_class(read_time=read_time))
+        self.count(reads=len(responses))
+        return iter([firestore_types.RunQueryResponse.wrap(response) for response in responses])
+
+    def run_aggregation_query(self, request, metadata=None, **kwargs):
+        raise exceptions.Unimplemented("Aggregation queries are not supported by the fake")
+
+class FakeChannel:
+    """
+    One client's connection to a FakeFirestoreAPI. Like the single HTTP/2 connection
+    behind a real gRPC channel, at most max_concurrent_streams RPCs are in flight at
+    once; the rest wait for a free stream.
+    """
+
+    def __init__(self, api, max_concurrent_streams=100):
+        self.api = api
+        self.streams = threading.BoundedSemaphore(max_concurrent_streams)
+
+    def call(self, method, request, **kwargs):
+        with self.streams:
+            return getattr(self.api, method)(request, **kwargs)
+
+    def commit(self, request, metadata=None, **kwargs):
+        return self.call('commit', request, metadata=metadata, **kwargs)
+
+    def batch_write(self, request, metadata=None, **kwargs):
+        return self.call('batch_write', request, metadata=metadata, **kwargs)
+
+    def begin_transaction(self, request, metadata=None, **kwargs):
+        return self.call('begin_transaction', request, metadata=metadata, **kwargs)
+
+    def rollback(self, request, metadata=None, **kwargs):
+        return self.call('rollback', request, metadata=metadata, **kwargs)
+
+    def batch_get_documents(self, request, metadata=None, **kwargs):
+        return self.call('batch_get_documents', request, metadata=metadata, **kwargs)
+
+    def run_query(self, request, metadata=None, **kwargs):
+        return self.call('run_query', request, metadata=metadata, **kwargs)
+
+    def run_aggregation_query(self, request, metadata=None, **kwargs):
+        return self.call('run_aggregation_query', request, metadata=metadata, **kwargs)
+
+class BenchmarkCredential(credentials.Base):
+    def get_credential(self):
+        return AnonymousCredentials()
+
+def install_fake_firestore(api, max_concurrent_streams=100):
+    """
+    Initializes the default Firebase app for the benchmark project and routes the
+    RPCs of its Firestore client (the one firestore.client() returns everywhere)
+    to api over one FakeChannel. Returns the client.
+    """
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(BenchmarkCredential(), options={'projectId': PROJECT_ID})
+    client = firestore.client()
+    client._firestore_api_internal = FakeChannel(api, max_concurrent_streams)
+    return client
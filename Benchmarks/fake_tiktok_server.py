@@ -0,0 +1,199 @@
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ACCESS_TOKEN_TTL_SECONDS = 86400
+REFRESH_TOKEN_TTL_SECONDS = 365 * 86400
+
+class VideoCatalog:
+    """
+    The videos every synthetic account has, generated on demand. Video i of an account
+    is f"{open_id}-{i}", uploaded i * upload_interval seconds before anchor, and its
+    counters grow with time so consecutive scrapes see new views.
+    """
+
+    def __init__(self, videos_per_account, upload_interval=6 * 3600, anchor=None):
+        self.videos_per_account = videos_per_account
+        self.upload_interval = upload_interval
+        self.anchor = int(anchor if anchor is not None else time.time())
+
+    @staticmethod
+    def video_id(open_id, index):
+        return f"{open_id}-{index}"
+
+    def parse_video_id(self, video_id):
+        open_id, _, index = video_id.rpartition('-')
+        if not open_id or not index.isdigit() or int(index) >= self.videos_per_account:
+            return None
+        return open_id, int(index)
+
+    def create_time(self, index):
+        return self.anchor - index * self.upload_interval
+
+    def video(self, open_id, index, now=None):
+        video_id = self.video_id(open_id, index)
+        age_minutes = max(0, int(((now or time.time()) - self.create_time(index)) // 60))
+        base = zlib.crc32(video_id.encode())
+        view_count = base % 100000 + age_minutes * (base % 7 + 1)
+        return {
+            'id': video_id,
+            'title': f"Video {index} of {open_id}",
+            'video_description': f"Synthetic video {index}",
+            'duration': 15 + base % 45,
+            'cover_image_url': f"https://example.com/covers/{video_id}.jpg",
+            'embed_link': f"https://www.tiktok.com/embed/{video_id}",
+            'create_time': self.create_time(index),
+            'view_count': view_count,
+            'like_count': view_count // 10,
+            'comment_count': view_count // 100,
+            'share_count': view_count // 200
+        }
+
+class FakeTikTokHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so connection pooling behaves as it does against TikTok
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode() if length else ''
+
+    def access_token_open_id(self):
+        # Access tokens are access-<open_id>-<generation>, the synthetic dataset seeding generation 0
+        authorization = self.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer access-'):
+            return None
+        return authorization[len('Bearer access-'):].rpartition('-')[0] or None
+
+    def handle_request(self):
+        server = self.server
+        path = urlparse(self.path).path
+        body = self.read_body()
+        server.simulate_latency()
+        server.count(path)
+
+        if path == '/v2/oauth/token/':
+            form = {key: values[0] for key, values in parse_qs(body).items()}
+            self.send_json(200, server.issue_tokens(form.get('refresh_token', '')))
+            return
+
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.send_json(401, {'error': {'code': 'access_token_invalid', 'message': 'Missing access token'}})
+            return
+
+        if path == '/v2/user/info/':
+            open_id = self.access_token_open_id() or 'unknown'
+            self.send_json(200, {'data': {'user': {
+                'display_name': f"Creator {open_id}",
+                'avatar_url': f"https://example.com/avatars/{open_id}.jpg",
+                'follower_count': zlib.crc32(open_id.encode()) % 1000000
+            }}, 'error': {'code': 'ok'}})
+        elif path == '/v2/video/list/':
+            request = json.loads(body or '{}')
+            self.send_json(200, {'data': server.list_videos(request.get('open_id', ''), request.get('cursor') or 0, request.get('max_count', 20)), 'error': {'code': 'ok'}})
+        elif path == '/v2/video/query/':
+            request = json.loads(body or '{}')
+            video_ids = request.get('filters', {}).get('video_ids', [])
+            self.send_json(200, {'data': {'videos': server.query_videos(video_ids)}, 'error': {'code': 'ok'}})
+        else:
+            self.send_json(404, {'error': {'code': 'not_found', 'message': path}})
+
+    do_GET = handle_request
+    do_POST = handle_request
+
+class FakeTikTokServer(ThreadingHTTPServer):
+    """
+    Local HTTP server answering the TikTok v2 endpoints the functions call (video list
+    and query, OAuth token refresh and user info) from a VideoCatalog, with a fixed
+    per-request latency (seconds, +/- jitter as a fraction). Requests are counted per path.
+    """
+    daemon_threads = True
+
+    def __init__(self, catalog, latency=0.0, jitter=0.0, host='127.0.0.1', port=0):
+        super().__init__((host, port), FakeTikTokHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.token_generations = Counter()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='fake-tiktok', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def simulate_latency(self):
+        if self.latency > 0:
+            time.sleep(self.latency * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def count(self, path):
+        with self.lock:
+            self.stats[path] += 1
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = Counter()
+
+    def issue_tokens(self, refresh_token):
+        # Refresh tokens handed out by the synthetic dataset are refresh-<open_id>
+        if not refresh_token.startswith('refresh-'):
+            return {'error': 'invalid_grant', 'error_description': 'Refresh token is invalid or expired.'}
+        open_id = refresh_token[len('refresh-'):]
+        with self.lock:
+            self.token_generations[open_id] += 1
+            generation = self.token_generations[open_id]
+        return {
+            'open_id': open_id,
+            'access_token': f"access-{open_id}-{generation}",
+            'refresh_token': refresh_token,
+            'expires_in': ACCESS_TOKEN_TTL_SECONDS,
+            'refresh_expires_in': REFRESH_TOKEN_TTL_SECONDS,
+            'scope': 'user.info.basic,video.list',
+            'token_type': 'Bearer'
+        }
+
+    def list_videos(self, open_id, cursor, max_count):
+        # The cursor is the index of the next video, newest first
+        start = int(cursor)
+        end = min(start + min(int(max_count), 20), self.catalog.videos_per_account)
+        now = time.time()
+        return {
+            'videos': [self.catalog.video(open_id, index, now) for index in range(start, end)],
+            'cursor': end,
+            'has_more': end < self.catalog.videos_per_account
+        }
+
+    def query_videos(self, video_ids):
+        now = time.time()
+        videos = []
+        for video_id in video_ids[:20]:
+            parsed = self.catalog.parse_video_id(video_id)
+            if parsed is not None:
+                videos.append(self.catalog.video(*parsed, now=now))
+        return videos
@@ -0,0 +1,209 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import time
+import warnings
+from datetime import timedelta
+from fake_firestore import FakeChannel, FakeFirestoreAPI, LatencyModel, install_fake_firestore
+from fake_tiktok_server import FakeTikTokServer, VideoCatalog
+from synthetic import DatasetSpec, seed
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def benchmark_scraper(workers):
+    from utils.metrics_scraper import MetricsScraper
+    from utils.poll_schedule import PollScheduler
+    from utils.storage import PooledClient
+    # Every account and video is due in every run, so repeated runs do the same work
+    return MetricsScraper(max_workers=workers, poll_scheduler=PollScheduler(PooledClient(), tolerance=timedelta(days=3650)))
+
+def run_metrics_scraper(workers):
+    benchmark_scraper(workers).run()
+
+def run_metrics_pipeline(workers):
+    from utils.content_plan_aggregation import ContentPlanAggregator
+    from utils.organization_aggregation import OrganizationMetricsAggregator
+    from utils.stage_dag import run_pipeline
+    run_pipeline(benchmark_scraper(workers), ContentPlanAggregator(max_workers=workers), OrganizationMetricsAggregator(max_workers=workers), max_workers=workers)
+
+def run_content_plan_aggregation(workers):
+    from utils.content_plan_aggregation import ContentPlanAggregator
+    ContentPlanAggregator(max_workers=workers).run()
+
+def run_organization_aggregation(workers):
+    from utils.organization_aggregation import OrganizationMetricsAggregator
+    OrganizationMetricsAggregator(max_workers=workers).run()
+
+def run_token_refresher(workers):
+    from utils.token_refresher import TokenRefresher
+    TokenRefresher(max_workers=workers).run()
+
+def run_historical_content_plan(workers):
+    import main
+    main.process_historical_content_plan()
+
+# (job, function directory, runner, what one unit of work is, units in the dataset)
+JOBS = [
+    ('metrics_scraper', 'Automation', run_metrics_scraper, 'accounts', lambda spec: spec.accounts),
+    ('content_plan_aggregation', 'Automation', run_content_plan_aggregation, 'plans', lambda spec: spec.plans),
+    ('organization_aggregation', 'Automation', run_organization_aggregation, 'organizations', lambda spec: spec.orgs),
+    ('token_refresher', 'TokenRefresh', run_token_refresher, 'accounts', lambda spec: spec.expiring_accounts),
+    ('historical_content_plan', 'ContentPlanHistory', run_historical_content_plan, 'plans', lambda spec: spec.plans),
+    # The scrape and both aggregations overlapped, as metrics_scraper_http runs them
+    ('metrics_pipeline', 'Automation', run_metrics_pipeline, 'accounts', lambda spec: spec.accounts),
+]
+
+def use_function_dir(function_name):
+    """
+    Makes `import main` and `import utils...` resolve to the given function's modules.
+    Every function has its own utils package, so the previous one is unloaded first.
+    """
+    for name in list(sys.modules):
+        if name in ('main', 'utils') or name.startswith('utils.'):
+            del sys.modules[name]
+    for job in JOBS:
+        function_dir = os.path.join(REPO_ROOT, job[1])
+        while function_dir in sys.path:
+            sys.path.remove(function_dir)
+    sys.path.insert(0, os.path.join(REPO_ROOT, function_name))
+
+def run_job(job, function_name, runner, unit, units, workers, pool_size, args, firestore_api, tiktok_server):
+    use_function_dir(function_name)
+    # Each job gets a fresh client pool (its utils package was just reloaded), routed to the fake
+    os.environ['FIRESTORE_POOL_SIZE'] = str(pool_size)
+    from utils import storage
+    # Only the functions whose workers use pooled clients have a pool
+    if hasattr(storage, 'set_firestore_api_factory'):
+        storage.set_firestore_api_factory(lambda client, channel_options: FakeChannel(firestore_api, args.max_concurrent_streams))
+    firestore_api.reset_stats()
+    tiktok_server.reset_stats()
+
+    error = None
+    started_at = time.perf_counter()
+    try:
+        # ContentPlanHistory prints every plan it moves
+        with contextlib.redirect_stdout(io.StringIO()):
+            runner(workers)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    wall_seconds = time.perf_counter() - started_at
+
+    firestore_ops = dict(firestore_api.stats)
+    return {
+        'job': job,
+        'workers': workers,
+        'firestore_pool_size': pool_size,
+        'wall_seconds': round(wall_seconds, 3),
+        'unit': unit,
+        'units': units,
+        'units_per_second': round(units / wall_seconds, 2) if wall_seconds else None,
+        'firestore': {operation: firestore_ops.get(operation, 0) for operation in ('reads', 'writes', 'deletes', 'queries')},
+        'firestore_rpcs': {name[len('rpc_'):]: count for name, count in sorted(firestore_ops.items()) if name.startswith('rpc_')},
+        'tiktok_requests': dict(tiktok_server.stats),
+        'error': error
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the scrape, aggregation, token refresh and content plan history jobs offline against synthetic tenants.")
+    parser.add_argument('--users', type=int, default=50, help="Users with linked TikTok accounts")
+    parser.add_argument('--accounts-per-user', type=int, default=1)
+    parser.add_argument('--videos-per-account', type=int, default=30)
+    parser.add_argument('--orgs', type=int, default=10, help="Organizations")
+    parser.add_argument('--plans-per-org', type=int, default=3, help="Active content plans per organization")
+    parser.add_argument('--videos-per-plan', type=int, default=5)
+    parser.add_argument('--metric-history-hours', type=int, default=6, help="Hourly metrics already stored per video, plan and organization")
+    parser.add_argument('--firestore-read-ms', type=float, default=5.0, help="Latency added to every Firestore read RPC")
+    parser.add_argument('--firestore-write-ms', type=float, default=10.0, help="Latency added to every Firestore commit")
+    parser.add_argument('--tiktok-ms', type=float, default=150.0, help="Latency added to every TikTok API request")
+    parser.add_argument('--jitter', type=float, default=0.2, help="Latency jitter as a fraction (0.2 = +/-20%%)")
+    parser.add_argument('--replay-fixtures', help="Serve TikTok responses recorded with TIKTOK_API_MODE=record from this directory instead of the fake server")
+    parser.add_argument('--replay-latency-scale', type=float, default=1.0, help="Multiplier applied to recorded TikTok latencies when replaying")
+    parser.add_argument('--sqlite', metavar='PATH', help="Run the jobs against a SQLite database at PATH (recreated) instead of the Firestore fake")
+    parser.add_argument('--workers', type=int, nargs='+', default=[10], help="max_workers passed to each job; every job runs once per value, e.g. --workers 10 50 200")
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[4], help="FIRESTORE_POOL_SIZE values to run every job with, e.g. --pool-sizes 1 4 8")
+    parser.add_argument('--max-concurrent-streams', type=int, default=100, help="Concurrent RPCs each fake Firestore channel allows, like one HTTP/2 connection")
+    parser.add_argument('--jobs', nargs='*', help="Only run these jobs (in the default order)")
+    parser.add_argument('--verbose', action='store_true', help="Show the jobs' own logging")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR)
+    # The jobs still use positional where() filters
+    warnings.filterwarnings('ignore', message='Detected filter using positional arguments')
+    spec = DatasetSpec(
+        users=args.users,
+        accounts_per_user=args.accounts_per_user,
+        orgs=args.orgs,
+        plans_per_org=args.plans_per_org,
+        videos_per_plan=args.videos_per_plan,
+        metric_history_hours=args.metric_history_hours
+    )
+    catalog = VideoCatalog(args.videos_per_account)
+    tiktok_server = FakeTikTokServer(catalog, latency=args.tiktok_ms / 1000, jitter=args.jitter).start()
+    firestore_api = FakeFirestoreAPI(LatencyModel(args.firestore_read_ms / 1000, args.firestore_write_ms / 1000, args.jitter))
+
+    # Read by TikTokAPI when each job builds its client
+    os.environ['TIKTOK_API_BASE_URL'] = tiktok_server.base_url
+    os.environ.setdefault('TIKTOK_CLIENT_KEY', 'benchmark')
+    os.environ.setdefault('TIKTOK_CLIENT_SECRET', 'benchmark')
+    if args.replay_fixtures:
+        os.environ['TIKTOK_API_MODE'] = 'replay'
+        os.environ['TIKTOK_API_FIXTURES_DIR'] = args.replay_fixtures
+        os.environ['TIKTOK_API_REPLAY_LATENCY_SCALE'] = str(args.replay_latency_scale)
+
+    if args.sqlite:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.sqlite + suffix):
+                os.remove(args.sqlite + suffix)
+        # Read by utils.storage.get_client() in every job; Firestore op counts stay at zero
+        os.environ['STORAGE_BACKEND'] = 'sqlite'
+        os.environ['SQLITE_DATABASE_PATH'] = args.sqlite
+        use_function_dir('Automation')
+        from utils.storage import get_client
+        db = get_client()
+    else:
+        db = install_fake_firestore(firestore_api, args.max_concurrent_streams)
+    firestore_api.latency.enabled = False
+    seeded_at = time.perf_counter()
+    documents = seed(db, spec, catalog)
+    seed_seconds = time.perf_counter() - seeded_at
+    firestore_api.latency.enabled = True
+
+    results = []
+    try:
+        for workers in args.workers:
+            for pool_size in args.pool_sizes:
+                for job, function_name, runner, unit, units in JOBS:
+                    if args.jobs and job not in args.jobs:
+                        continue
+                    results.append(run_job(job, function_name, runner, unit, units(spec), workers, pool_size, args, firestore_api, tiktok_server))
+    finally:
+        tiktok_server.stop()
+
+    report = {
+        'dataset': dict(spec.as_dict(), videos_per_account=args.videos_per_account, documents=documents, seed_seconds=round(seed_seconds, 2)),
+        'latency_ms': {'firestore_read': args.firestore_read_ms, 'firestore_write': args.firestore_write_ms, 'tiktok': args.tiktok_ms, 'jitter': args.jitter},
+        'storage': 'sqlite' if args.sqlite else 'firestore_fake',
+        'results': results
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"Dataset: {spec.users} users, {spec.accounts} accounts, {args.videos_per_account} videos per account, "
+          f"{spec.orgs} organizations, {spec.plans} plans ({documents} documents seeded in {seed_seconds:.1f}s)")
+    print(f"{'job':<26} {'workers':>7} {'pool':>4} {'wall':>9} {'throughput':>24} {'reads':>8} {'writes':>8} {'deletes':>8} {'queries':>8} {'tiktok':>7}")
+    for result in results:
+        firestore_ops = result['firestore']
+        throughput = f"{result['units_per_second']}/s {result['unit']}"
+        print(f"{result['job']:<26} {result['workers']:>7} {result['firestore_pool_size']:>4} {result['wall_seconds']:>8.2f}s {throughput:>24} {firestore_ops['reads']:>8} {firestore_ops['writes']:>8} "
+              f"{firestore_ops['deletes']:>8} {firestore_ops['queries']:>8} {sum(result['tiktok_requests'].values()):>7}")
+        if result['error']:
+            print(f"    error: {result['error']}")
+
+if __name__ == '__main__':
+    main()
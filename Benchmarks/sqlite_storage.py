@@ -0,0 +1,607 @@
+"""
+SQLite backend for utils/storage.py, selected with STORAGE_BACKEND=sqlite. It emulates
+the subset of the Firestore client API the jobs use, for benchmarks, local development
+and backfills. It is not deployed with the functions: put this directory on PYTHONPATH
+to use it, e.g. PYTHONPATH=../Benchmarks STORAGE_BACKEND=sqlite python main.py.
+"""
+import base64
+import json
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timezone
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.field_path import parse_field_path, render_field_path
+
+# SQLite clients are shared per database file, like Firestore clients per app
+_sqlite_clients = {}
+_sqlite_clients_lock = threading.Lock()
+
+def get_sqlite_client(path):
+    with _sqlite_clients_lock:
+        if path not in _sqlite_clients:
+            _sqlite_clients[path] = SqliteClient(path)
+        return _sqlite_clients[path]
+
+# Values are stored as JSON with tagged timestamps, references and bytes, and indexed
+# as (rank, num, txt) so SQLite orders them the way Firestore does across types.
+
+def encode(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            # Firestore treats naive datetimes as UTC
+            value = value.replace(tzinfo=timezone.utc)
+        return {'__timestamp__': value.astimezone(timezone.utc).isoformat()}
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    if hasattr(value, 'path') and hasattr(value, 'collection'):
+        return {'__reference__': value.path}
+    return value
+
+def decode(value, client):
+    if isinstance(value, dict):
+        if '__timestamp__' in value:
+            return datetime.fromisoformat(value['__timestamp__'])
+        if '__reference__' in value:
+            return client.document(value['__reference__'])
+        if '__bytes__' in value:
+            return base64.b64decode(value['__bytes__'])
+        return {key: decode(item, client) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode(item, client) for item in value]
+    return value
+
+def index_value(value):
+    if value is None:
+        return 0, 0, ''
+    if isinstance(value, bool):
+        return 1, int(value), ''
+    if isinstance(value, (int, float)):
+        return 2, value, ''
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return 3, value.timestamp(), ''
+    if isinstance(value, str):
+        return 4, 0, value
+    if isinstance(value, bytes):
+        return 5, 0, base64.b64encode(value).decode('ascii')
+    if hasattr(value, 'path') and hasattr(value, 'collection'):
+        return 6, 0, value.path
+    raise TypeError(f"Cannot index value of type {type(value).__name__}")
+
+def index_entries(fields, prefix=()):
+    """Yields (field, element, rank, num, txt) for every scalar in fields, and for each element of arrays."""
+    for key, value in fields.items():
+        parts = prefix + (key,)
+        if isinstance(value, dict):
+            yield from index_entries(value, parts)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                if not isinstance(item, (dict, list, tuple)):
+                    yield (render_field_path(parts), 1) + index_value(item)
+        else:
+            yield (render_field_path(parts), 0) + index_value(value)
+
+def get_field(data, field_path):
+    for part in parse_field_path(field_path):
+        if not isinstance(data, dict) or part not in data:
+            raise KeyError(field_path)
+        data = data[part]
+    return data
+
+def resolve_transform(value, current, now):
+    """Applies a Firestore sentinel or transform to the field's current value."""
+    if value is transforms.SERVER_TIMESTAMP:
+        return now
+    if isinstance(value, transforms.Increment):
+        return (current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0) + value.value
+    if isinstance(value, transforms.Maximum):
+        return value.value if not isinstance(current, (int, float)) else max(current, value.value)
+    if isinstance(value, transforms.Minimum):
+        return value.value if not isinstance(current, (int, float)) else min(current, value.value)
+    if isinstance(value, transforms.ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        result.extend(item for item in value.values if item not in result)
+        return result
+    if isinstance(value, transforms.ArrayRemove):
+        return [item for item in current if item not in value.values] if isinstance(current, list) else []
+    if isinstance(value, dict):
+        current = current if isinstance(current, dict) else {}
+        return {key: resolve_transform(item, current.get(key), now) for key, item in value.items() if item is not transforms.DELETE_FIELD}
+    return value
+
+def merge_fields(existing, data, now):
+    """set(merge=True): nested maps are merged, DELETE_FIELD removes a field."""
+    merged = dict(existing)
+    for key, value in data.items():
+        if value is transforms.DELETE_FIELD:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_fields(merged[key], value, now)
+        else:
+            merged[key] = resolve_transform(value, merged.get(key), now)
+    return merged
+
+def update_fields(existing, field_updates, now):
+    """update(): keys are field paths, and only the named fields are replaced."""
+    updated = _copy(existing)
+    for field_path, value in field_updates.items():
+        parts = parse_field_path(field_path)
+        container = updated
+        for part in parts[:-1]:
+            if not isinstance(container.get(part), dict):
+                container[part] = {}
+            container = container[part]
+        if value is transforms.DELETE_FIELD:
+            container.pop(parts[-1], None)
+        else:
+            container[parts[-1]] = resolve_transform(value, container.get(parts[-1]), now)
+    return updated
+
+def _copy(fields):
+    return {key: _copy(value) if isinstance(value, dict) else value for key, value in fields.items()}
+
+class SqliteDocumentSnapshot:
+    def __init__(self, reference, data, create_time=None, update_time=None):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return _copy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return get_field(self._data or {}, field_path)
+
+class SqliteDocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+
+    @property
+    def id(self):
+        return self.path.rpartition('/')[2]
+
+    @property
+    def parent(self):
+        return SqliteCollectionReference(self._client, self.path.rpartition('/')[0])
+
+    def collection(self, collection_id):
+        return SqliteCollectionReference(self._client, f"{self.path}/{collection_id}")
+
+    def get(self, field_paths=None):
+        return next(self._client.get_all([self], field_paths=field_paths))
+
+    def set(self, document_data, merge=False):
+        self._client.commit([('set', self.path, document_data, merge)])
+
+    def update(self, field_updates):
+        self._client.commit([('update', self.path, field_updates, None)])
+
+    def create(self, document_data):
+        self._client.commit([('create', self.path, document_data, None)])
+
+    def delete(self):
+        self._client.commit([('delete', self.path, None, None)])
+
+    def __eq__(self, other):
+        return isinstance(other, SqliteDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return f"SqliteDocumentReference({self.path!r})"
+
+class SqliteQuery:
+    """
+    Firestore-style query over one collection (or a collection group) translated to
+    SQL. Filters and orderings join the field index, so equality, range and ordered
+    limit queries are answered from SQLite indexes rather than by scanning documents.
+    """
+    OPERATORS = {'==': '=', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+    def __init__(self, client, collection_path=None, collection_id=None, filters=(), orders=(), limit=None, offset=None,
+                 projection=None, start=None, end=None):
+        self._client = client
+        self._collection_path = collection_path
+        self._collection_id = collection_id
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._offset = offset
+        self._projection = projection
+        self._start = start
+        self._end = end
+
+    def _copy(self, **changes):
+        state = {
+            'collection_path': self._collection_path, 'collection_id': self._collection_id, 'filters': self._filters,
+            'orders': self._orders, 'limit': self._limit, 'offset': self._offset, 'projection': self._projection,
+            'start': self._start, 'end': self._end
+        }
+        state.update(changes)
+        return SqliteQuery(self._client, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            if not hasattr(filter, 'op_string'):
+                raise NotImplementedError("Composite filters are not supported by the SQLite backend")
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def offset(self, num_to_skip):
+        return self._copy(offset=num_to_skip)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def start_at(self, document_fields_or_snapshot):
+        return self._copy(start=(document_fields_or_snapshot, True))
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(start=(document_fields_or_snapshot, False))
+
+    def end_before(self, document_fields_or_snapshot):
+        return self._copy(end=(document_fields_or_snapshot, False))
+
+    def end_at(self, document_fields_or_snapshot):
+        return self._copy(end=(document_fields_or_snapshot, True))
+
+    def _document_path(self, value):
+        if isinstance(value, SqliteDocumentReference):
+            return value.path
+        # Document IDs are relative to the queried collection
+        return value if '/' in value else f"{self._collection_path}/{value}"
+
+    def _value_condition(self, alias, op, value, params):
+        if op in ('in', 'not-in', 'array_contains_any'):
+            conditions = []
+            for item in value:
+                conditions.append(f"({alias}.rank = ? AND {alias}.num = ? AND {alias}.txt = ?)")
+                params.extend(index_value(item))
+            condition = '(' + (' OR '.join(conditions) or '0') + ')'
+            return f"NOT {condition} AND {alias}.rank != 0" if op == 'not-in' else condition
+        rank, num, txt = index_value(value)
+        if op in ('==', 'array_contains'):
+            params.extend((rank, num, txt))
+            return f"{alias}.rank = ? AND {alias}.num = ? AND {alias}.txt = ?"
+        if op == '!=':
+            params.extend((rank, num, txt))
+            return f"NOT ({alias}.rank = ? AND {alias}.num = ? AND {alias}.txt = ?) AND {alias}.rank != 0"
+        if op not in self.OPERATORS:
+            raise NotImplementedError(f"Operator {op} is not supported by the SQLite backend")
+        # Range filters only match values of the same type
+        params.extend((rank, num, txt))
+        return f"{alias}.rank = ? AND ({alias}.num, {alias}.txt) {self.OPERATORS[op]} (?, ?)"
+
+    def _cursor_values(self, cursor, orders):
+        if isinstance(cursor, SqliteDocumentSnapshot):
+            values = [cursor.reference.path if field == '__name__' else cursor.get(field) for field, _ in orders]
+        else:
+            values = [self._document_path(cursor[field]) if field == '__name__' else cursor[field] for field, _ in orders if field in cursor]
+        return values
+
+    def _cursor_condition(self, cursor, inclusive, after, orders, columns, params):
+        """Lexicographic comparison of the ordered columns with the cursor's values."""
+        values = self._cursor_values(cursor, orders)
+        terms = []
+        for index, value in enumerate(values):
+            term_params = []
+            term = []
+            for column, previous in zip(columns[:index], values[:index]):
+                term.append(self._column_equals(column, previous, term_params))
+            descending = orders[index][1] == 'DESCENDING'
+            op = '>' if descending != after else '<'
+            term.append(self._column_compare(columns[index], op, value, term_params))
+            terms.append('(' + ' AND '.join(term) + ')')
+            params.extend(term_params)
+        if inclusive:
+            term_params = []
+            terms.append('(' + ' AND '.join(self._column_equals(column, value, term_params) for column, value in zip(columns, values)) + ')')
+            params.extend(term_params)
+        return '(' + ' OR '.join(terms) + ')'
+
+    @staticmethod
+    def _column_equals(column, value, params):
+        if column == 'd.path':
+            params.append(value)
+            return 'd.path = ?'
+        params.extend(index_value(value))
+        return f"({column}.rank, {column}.num, {column}.txt) = (?, ?, ?)"
+
+    @staticmethod
+    def _column_compare(column, op, value, params):
+        if column == 'd.path':
+            params.append(value)
+            return f"d.path {op} ?"
+        params.extend(index_value(value))
+        return f"({column}.rank, {column}.num, {column}.txt) {op} (?, ?, ?)"
+
+    def _sql(self):
+        scope_column = 'collection_id' if self._collection_id else 'parent'
+        scope_value = self._collection_id or self._collection_path
+        joins, join_params, conditions, params = [], [], [f"d.{scope_column} = ?"], [scope_value]
+
+        for index, (field_path, op, value) in enumerate(self._filters):
+            field = render_field_path(parse_field_path(field_path))
+            if field == '__name__':
+                if op in ('in', 'not-in'):
+                    placeholders = ', '.join('?' for _ in value)
+                    conditions.append(f"d.path {'NOT IN' if op == 'not-in' else 'IN'} ({placeholders})")
+                    params.extend(self._document_path(item) for item in value)
+                else:
+                    conditions.append(f"d.path {self.OPERATORS.get(op, op)} ?")
+                    params.append(self._document_path(value))
+            elif op in ('array_contains', 'array_contains_any'):
+                condition_params = [field]
+                condition = self._value_condition('a', op, value, condition_params)
+                conditions.append(f"EXISTS (SELECT 1 FROM field_index a WHERE a.path = d.path AND a.field = ? AND a.element = 1 AND {condition})")
+                params.extend(condition_params)
+            else:
+                alias = f"w{index}"
+                condition_params = []
+                condition = self._value_condition(alias, op, value, condition_params)
+                joins.append(f"JOIN field_index {alias} ON {alias}.path = d.path AND {alias}.{scope_column} = ? AND {alias}.field = ? AND {alias}.element = 0 AND {condition}")
+                join_params.extend([scope_value, field] + condition_params)
+
+        orders = [(field_path if field_path == '__name__' else render_field_path(parse_field_path(field_path)), direction) for field_path, direction in self._orders]
+        if not orders or orders[-1][0] != '__name__':
+            orders.append(('__name__', orders[-1][1] if orders else 'ASCENDING'))
+        columns, order_terms = [], []
+        for index, (field, direction) in enumerate(orders):
+            sql_direction = 'DESC' if direction == 'DESCENDING' else 'ASC'
+            if field == '__name__':
+                columns.append('d.path')
+                order_terms.append(f"d.path {sql_direction}")
+                continue
+            # Documents without the ordered field are left out, as in Firestore
+            alias = f"o{index}"
+            joins.append(f"JOIN field_index {alias} ON {alias}.path = d.path AND {alias}.field = ? AND {alias}.element = 0")
+            join_params.append(field)
+            columns.append(alias)
+            order_terms.extend(f"{alias}.{column} {sql_direction}" for column in ('rank', 'num', 'txt'))
+
+        for cursor, after in ((self._start, True), (self._end, False)):
+            if cursor is not None:
+                values, inclusive = cursor
+                conditions.append(self._cursor_condition(values, inclusive, after, orders, columns, params))
+
+        sql = f"SELECT d.path, d.data, d.create_time, d.update_time FROM documents d {' '.join(joins)} WHERE {' AND '.join(conditions)} ORDER BY {', '.join(order_terms)}"
+        if self._limit is not None or self._offset:
+            sql += f" LIMIT {int(self._limit) if self._limit is not None else -1} OFFSET {int(self._offset or 0)}"
+        return sql, join_params + params
+
+    def stream(self):
+        sql, params = self._sql()
+        for row in self._client.execute(sql, params):
+            snapshot = self._client.snapshot(*row)
+            if self._projection is not None:
+                data = {}
+                for field_path in self._projection:
+                    try:
+                        value = snapshot.get(field_path)
+                    except KeyError:
+                        continue
+                    container = data
+                    parts = parse_field_path(field_path)
+                    for part in parts[:-1]:
+                        container = container.setdefault(part, {})
+                    container[parts[-1]] = value
+                snapshot = SqliteDocumentSnapshot(snapshot.reference, data, snapshot.create_time, snapshot.update_time)
+            yield snapshot
+
+    def get(self):
+        return list(self.stream())
+
+class SqliteCollectionReference(SqliteQuery):
+    def __init__(self, client, path):
+        super().__init__(client, collection_path=path)
+        self.path = path
+
+    @property
+    def id(self):
+        return self.path.rpartition('/')[2]
+
+    @property
+    def parent(self):
+        parent_path = self.path.rpartition('/')[0]
+        return SqliteDocumentReference(self._client, parent_path) if parent_path else None
+
+    def document(self, document_id=None):
+        return SqliteDocumentReference(self._client, f"{self.path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, document_data, document_id=None):
+        reference = self.document(document_id)
+        reference.create(document_data)
+        return datetime.now(timezone.utc), reference
+
+    def list_documents(self):
+        return [SqliteDocumentReference(self._client, path) for (path,) in self._client.execute(
+            "SELECT path FROM documents WHERE parent = ? ORDER BY path", [self.path])]
+
+class SqliteWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference.path, document_data, merge))
+
+    def update(self, reference, field_updates):
+        self._writes.append(('update', reference.path, field_updates, None))
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference.path, document_data, None))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference.path, None, None))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        self._client.commit(writes)
+        return writes
+
+    def __len__(self):
+        return len(self._writes)
+
+class SqliteClient:
+    """
+    Local stand-in for the Firestore client, covering what the jobs use: document and
+    collection references, get/get_all, filtered and ordered queries with limits and
+    cursors, collection group queries, batched writes, deletes and the SERVER_TIMESTAMP,
+    DELETE_FIELD, Increment and ArrayUnion/ArrayRemove transforms. Documents are JSON
+    rows, and every scalar field is also written to an index table queries join on.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # One connection shared by all worker threads, serialized by the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.RLock()
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT NOT NULL,
+                    collection_id TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    create_time REAL NOT NULL,
+                    update_time REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS documents_by_parent ON documents (parent, path);
+                CREATE INDEX IF NOT EXISTS documents_by_collection_id ON documents (collection_id, path);
+                CREATE TABLE IF NOT EXISTS field_index (
+                    path TEXT NOT NULL,
+                    parent TEXT NOT NULL,
+                    collection_id TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    element INTEGER NOT NULL,
+                    rank INTEGER NOT NULL,
+                    num REAL NOT NULL,
+                    txt TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS field_index_by_parent ON field_index (parent, field, element, rank, num, txt);
+                CREATE INDEX IF NOT EXISTS field_index_by_collection_id ON field_index (collection_id, field, element, rank, num, txt);
+                CREATE INDEX IF NOT EXISTS field_index_by_path ON field_index (path, field);
+            """)
+
+    def collection(self, *collection_path):
+        return SqliteCollectionReference(self, '/'.join(collection_path))
+
+    def document(self, *document_path):
+        return SqliteDocumentReference(self, '/'.join(document_path))
+
+    def collection_group(self, collection_id):
+        return SqliteQuery(self, collection_id=collection_id)
+
+    def batch(self):
+        return SqliteWriteBatch(self)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    def snapshot(self, path, data, create_time, update_time):
+        return SqliteDocumentSnapshot(
+            SqliteDocumentReference(self, path),
+            decode(json.loads(data), self),
+            datetime.fromtimestamp(create_time, timezone.utc),
+            datetime.fromtimestamp(update_time, timezone.utc)
+        )
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        rows = {}
+        paths = [reference.path for reference in references]
+        # Stay well under SQLite's bound parameter limit
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            placeholders = ', '.join('?' for _ in chunk)
+            for row in self.execute(f"SELECT path, data, create_time, update_time FROM documents WHERE path IN ({placeholders})", chunk):
+                rows[row[0]] = row
+        for reference in references:
+            row = rows.get(reference.path)
+            if row is None:
+                yield SqliteDocumentSnapshot(SqliteDocumentReference(self, reference.path), None)
+                continue
+            snapshot = self.snapshot(*row)
+            if field_paths is not None:
+                snapshot = SqliteDocumentSnapshot(snapshot.reference, {key: value for key, value in snapshot.to_dict().items() if key in field_paths},
+                                                  snapshot.create_time, snapshot.update_time)
+            yield snapshot
+
+    def _load(self, cursor, path):
+        row = cursor.execute("SELECT data, create_time FROM documents WHERE path = ?", [path]).fetchone()
+        if row is None:
+            return None, None
+        return decode(json.loads(row[0]), self), row[1]
+
+    def _store(self, cursor, path, fields, create_time, now):
+        parent, _, _ = path.rpartition('/')
+        collection_id = parent.rpartition('/')[2]
+        cursor.execute(
+            "INSERT OR REPLACE INTO documents (path, parent, collection_id, data, create_time, update_time) VALUES (?, ?, ?, ?, ?, ?)",
+            [path, parent, collection_id, json.dumps(encode(fields)), create_time or now.timestamp(), now.timestamp()]
+        )
+        cursor.execute("DELETE FROM field_index WHERE path = ?", [path])
+        cursor.executemany(
+            "INSERT INTO field_index (path, parent, collection_id, field, element, rank, num, txt) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(path, parent, collection_id) + entry for entry in index_entries(fields)]
+        )
+
+    def commit(self, writes):
+        """Applies (operation, path, data, merge) writes atomically, like a Firestore commit."""
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for operation, path, data, merge in writes:
+                    existing, create_time = self._load(cursor, path)
+                    if operation == 'delete':
+                        cursor.execute("DELETE FROM documents WHERE path = ?", [path])
+                        cursor.execute("DELETE FROM field_index WHERE path = ?", [path])
+                    elif operation == 'update':
+                        if existing is None:
+                            raise exceptions.NotFound(f"No document to update: {path}")
+                        self._store(cursor, path, update_fields(existing, data, now), create_time, now)
+                    elif operation == 'create':
+                        if existing is not None:
+                            raise exceptions.Conflict(f"Document already exists: {path}")
+                        self._store(cursor, path, resolve_transform(data, None, now), None, now)
+                    elif merge and existing is not None:
+                        self._store(cursor, path, merge_fields(existing, data, now), create_time, now)
+                    else:
+                        self._store(cursor, path, resolve_transform(data, None, now), create_time, now)
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
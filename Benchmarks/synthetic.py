@@ -0,0 +1,192 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+# Firestore rejects batches with more than 500 writes
+MAX_BATCH_SIZE = 500
+
+class DatasetSpec:
+    """Size of the synthetic tenants a benchmark runs against."""
+
+    def __init__(self, users=50, accounts_per_user=1, orgs=10, plans_per_org=3, videos_per_plan=5,
+                 metric_history_hours=6, expiring_token_fraction=0.2, expired_plan_fraction=0.1):
+        self.users = users
+        self.accounts_per_user = accounts_per_user
+        self.orgs = orgs
+        self.plans_per_org = plans_per_org
+        self.videos_per_plan = videos_per_plan
+        # Hourly Metrics entries already stored for every video
+        self.metric_history_hours = metric_history_hours
+        # Accounts whose access token expires within the token refresher's horizon
+        self.expiring_token_fraction = expiring_token_fraction
+        # Active plans that have already run past their end date
+        self.expired_plan_fraction = expired_plan_fraction
+
+    @property
+    def accounts(self):
+        return self.users * self.accounts_per_user
+
+    @property
+    def expiring_accounts(self):
+        return int(self.accounts * self.expiring_token_fraction)
+
+    @property
+    def plans(self):
+        return self.orgs * self.plans_per_org
+
+    @property
+    def expired_plans(self):
+        return int(self.plans * self.expired_plan_fraction)
+
+    def as_dict(self):
+        return dict(vars(self), accounts=self.accounts, plans=self.plans)
+
+class BatchWriter:
+    """Queues sets into WriteBatches of MAX_BATCH_SIZE and commits each one as it fills up."""
+
+    def __init__(self, db):
+        self.db = db
+        self.batch = db.batch()
+        self.pending = 0
+        self.written = 0
+
+    def set(self, reference, data):
+        self.batch.set(reference, data)
+        self.pending += 1
+        if self.pending == MAX_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.batch.commit()
+            self.written += self.pending
+            self.batch = self.db.batch()
+            self.pending = 0
+
+def metric_entry(video, hours_ago, now):
+    # Counters as they were hours_ago, assuming the video gains a view per minute
+    view_count = max(0, video['view_count'] - hours_ago * 60)
+    return {
+        'comment_count': view_count // 100,
+        'like_count': view_count // 10,
+        'view_count': view_count,
+        'share_count': view_count // 200,
+        'new_view_count': 60 if hours_ago < 24 else 0,
+        'timestamp': now - timedelta(hours=hours_ago)
+    }
+
+def aggregate_entry(view_count, timestamp):
+    return {
+        'comment_count': view_count // 100,
+        'like_count': view_count // 10,
+        'view_count': view_count,
+        'share_count': view_count // 200,
+        'new_view_count': 0,
+        'timestamp': timestamp
+    }
+
+def seed_metrics_history(writer, metrics_ref, hours, now, view_count):
+    """Hourly entries for the last hours plus daily entries for the last week, as the aggregators store them."""
+    hourly_ref = metrics_ref.document('hourly').collection('data')
+    for hours_ago in range(hours):
+        timestamp = now - timedelta(hours=hours_ago)
+        writer.set(hourly_ref.document(timestamp.strftime('%Y%m%d-%H%M')), aggregate_entry(max(0, view_count - hours_ago * 100), timestamp))
+    daily_ref = metrics_ref.document('daily').collection('data')
+    for days_ago in range(1, 8):
+        timestamp = now - timedelta(days=days_ago)
+        writer.set(daily_ref.document(timestamp.strftime('%Y%m%d')), aggregate_entry(max(0, view_count - days_ago * 2400), timestamp))
+
+def seed(db, spec, catalog):
+    """
+    Writes users with linked TikTok accounts (tokens, videos from catalog and their
+    Metrics history) and organizations with content plans that reference those
+    videos. Returns the number of documents written.
+    """
+    now = datetime.now(timezone.utc)
+    writer = BatchWriter(db)
+    account_videos = []
+
+    for user_index in range(spec.users):
+        user_id = f"user{user_index:05d}"
+        user_ref = db.collection('users').document(user_id)
+        writer.set(user_ref, {'name': f"User {user_index}", 'email': f"{user_id}@example.com"})
+        platform_ref = user_ref.collection('SocialMediaPlatforms').document('TikTok')
+        writer.set(platform_ref, {'platform': 'TikTok'})
+
+        for account_index in range(spec.accounts_per_user):
+            open_id = f"open{user_index:05d}x{account_index}"
+            username = f"creator{user_index:05d}x{account_index}"
+            expiring = len(account_videos) < spec.expiring_accounts
+            account_ref = platform_ref.collection('Accounts').document(username)
+            writer.set(account_ref, {
+                'username': username,
+                'display_name': f"Creator {open_id}",
+                'follower_count': 1000,
+                'tokens': {
+                    'open_id': open_id,
+                    'access_token': f"access-{open_id}-0",
+                    'refresh_token': f"refresh-{open_id}",
+                    'expires_in': 86400,
+                    'refresh_expires_in': 365 * 86400
+                },
+                'access_expires_at': now + (timedelta(hours=1) if expiring else timedelta(hours=20)),
+                'refresh_expires_at': now + timedelta(days=300),
+                'updatedAt': now.strftime('%Y-%m-%d %H:%M:%S')
+            })
+
+            video_refs = []
+            for index in range(catalog.videos_per_account):
+                video = catalog.video(open_id, index, now.timestamp())
+                video_ref = account_ref.collection('Videos').document(video['id'])
+                writer.set(video_ref, {
+                    'title': video['title'],
+                    'description': video['video_description'],
+                    'create_time': video['create_time'],
+                    'share_url': video['embed_link'],
+                    'thumbnail_url': video['cover_image_url'],
+                    'is_up': True,
+                    'is_tracked': True,
+                    'is_in_plan': False
+                })
+                for hours_ago in range(spec.metric_history_hours):
+                    timestamp = now - timedelta(hours=hours_ago)
+                    writer.set(video_ref.collection('Metrics').document(timestamp.strftime('%Y%m%d-%H%M')), metric_entry(video, hours_ago, now))
+                video_refs.append((video_ref, video))
+            account_videos.append((user_id, video_refs))
+
+    plan_count = 0
+    for org_index in range(spec.orgs):
+        org_id = f"org{org_index:04d}"
+        org_ref = db.collection('organizations').document(org_id)
+        writer.set(org_ref, {'name': f"Organization {org_index}"})
+        seed_metrics_history(writer, org_ref.collection('metrics'), spec.metric_history_hours, now, 100000)
+
+        for plan_index in range(spec.plans_per_org):
+            plan_id = f"plan{org_index:04d}x{plan_index}"
+            expired = plan_count < spec.expired_plans
+            user_id, video_refs = account_videos[plan_count % len(account_videos)] if account_videos else (None, [])
+            plan_count += 1
+            start_date = now - timedelta(days=35 if expired else 5)
+            plan_ref = org_ref.collection('contentPlans').document(plan_id)
+            writer.set(plan_ref, {
+                'status': 'active',
+                'brand': f"Brand {plan_index}",
+                'userId': user_id,
+                'managerId': f"manager{org_index:04d}",
+                'startDate': start_date,
+                'dateCreated': start_date,
+                'numberOfDays': 30,
+                'numberOfVideos': spec.videos_per_plan,
+                'retainerAmount': 500,
+                'requireW9': False
+            })
+            seed_metrics_history(writer, plan_ref.collection('metrics'), spec.metric_history_hours, now, 10000)
+
+            for video_ref, video in video_refs[:spec.videos_per_plan]:
+                writer.set(plan_ref.collection('videos').document(video_ref.id), {
+                    'originalVideoRef': video_ref,
+                    'create_time': datetime.fromtimestamp(video['create_time'], timezone.utc)
+                })
+
+    writer.flush()
+    logging.info(f"Seeded {writer.written} documents")
+    return writer.written
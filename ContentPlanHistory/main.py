@@ -1,14 +1,12 @@
 import os
 import json
 import logging
+import threading
 from datetime import datetime, timedelta
-from google.cloud import firestore
-import firebase_admin
-from firebase_admin import credentials, firestore
 from dotenv import load_dotenv
-from pytz import UTC  # Ensure UTC handling for datetime
-from datetime import datetime
 from google.protobuf.timestamp_pb2 import Timestamp  # Correct import for Firestore Timestamp
+from utils.firestore_accounting import iter_tenants, start_run, stage_scope
+from utils.profiling import profiled
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,8 +14,18 @@ load_dotenv()
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
-# Initialize Firebase
+# Firebase is initialized on first use rather than at import, so cold starts don't
+# pay for loading credentials and building the gRPC client before they need it.
+_db = None
+_db_lock = threading.Lock()
+
 def initialize_firebase():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    if firebase_admin._apps:
+        return firestore.client()
+
     firebase_creds_path = os.getenv('FIREBASE_CREDENTIALS_JSON')
     logging.info(f"Firebase Credentials Path: {firebase_creds_path}")
 
@@ -32,16 +40,25 @@ def initialize_firebase():
     logging.info("Firebase initialized successfully")
     return firestore.client()
 
-# Firebase client
-db = initialize_firebase()
+def get_db():
+    """Returns the storage client, initializing Firebase on first use unless STORAGE_BACKEND selects another backend."""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                from utils.storage import get_client, storage_backend
+                _db = initialize_firebase() if storage_backend() == 'firestore' else get_client()
+    return _db
 
 def get_organization_name(org_id):
     # Fetch organization name
-    org_ref = db.collection('organizations').document(org_id)
+    org_ref = get_db().collection('organizations').document(org_id)
     org_data = org_ref.get().to_dict()
     return org_data.get('name', 'Unknown Organization')
 
 def move_to_historical_content_plan(ref_id, plan_id, plan_data, ref_type, additional_field, completion_percentage, metrics):
+    from firebase_admin import firestore
+
     print(additional_field)
     # Remove new_view_count and retain other fields
     if 'new_view_count' in plan_data:
@@ -66,11 +83,11 @@ def move_to_historical_content_plan(ref_id, plan_id, plan_data, ref_type, additi
     if ref_type == 'organization':
         print(f"Moving content plan {plan_id} to organization's historicalContentPlans.")
         retained_fields['userId'] = additional_field  # Add userId for organization entry
-        historical_ref = db.collection('organizations').document(ref_id).collection('historicalContentPlans')
+        historical_ref = get_db().collection('organizations').document(ref_id).collection('historicalContentPlans')
     elif ref_type == 'user':
         print(f"Moving content plan {plan_id} to user's historicalContentPlans.")
         retained_fields['organizationName'] = additional_field  # Add organization name for user entry
-        historical_ref = db.collection('users').document(ref_id).collection('historicalContentPlans')
+        historical_ref = get_db().collection('users').document(ref_id).collection('historicalContentPlans')
 
     # Convert any Firestore timestamp objects to ISO format
     for key, value in retained_fields.items():
@@ -89,10 +106,10 @@ def process_historical_content_plan():
     current_date = datetime.utcnow().date()
 
     # Fetch all organizations
-    organizations_ref = db.collection('organizations')
+    organizations_ref = get_db().collection('organizations')
     organizations = organizations_ref.stream()
 
-    for org in organizations:
+    for org in iter_tenants(organizations, lambda org: org.id):
         org_id = org.id
         org_name = get_organization_name(org_id)
         content_plans_ref = organizations_ref.document(org_id).collection('contentPlans')
@@ -130,8 +147,10 @@ def process_historical_content_plan():
                 content_plans_ref.document(plan_id).delete()
 
 def fetch_latest_metrics(org_id, plan_id):
+    from firebase_admin import firestore
+
     # Fetch the most recent daily entry and remove unwanted fields (timestamp and new_view_count)
-    metrics_ref = db.collection('organizations').document(org_id).collection('contentPlans').document(plan_id).collection('metrics').document('daily').collection('data')
+    metrics_ref = get_db().collection('organizations').document(org_id).collection('contentPlans').document(plan_id).collection('metrics').document('daily').collection('data')
     latest_daily_entry = metrics_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).get()
     
     if latest_daily_entry:
@@ -146,7 +165,7 @@ def fetch_latest_metrics(org_id, plan_id):
 
 def calculate_unique_post_days(org_id, plan_id, start_date, end_date):
     # Count unique days for video posts using 'create_time'
-    videos_ref = db.collection('organizations').document(org_id).collection('contentPlans').document(plan_id).collection('videos')
+    videos_ref = get_db().collection('organizations').document(org_id).collection('contentPlans').document(plan_id).collection('videos')
     videos = videos_ref.stream()
 
     unique_days = set()
@@ -182,8 +201,14 @@ def calculate_unique_post_days(org_id, plan_id, start_date, end_date):
     print(f"\nUnique Days Set: {unique_days}")
     return len(unique_days)
 
+@profiled('historical_content_plan')
 def historical_content_plan_http(request):
-    process_historical_content_plan()
+    accounting = start_run('historical_content_plan', get_db())
+    try:
+        with stage_scope('historical_content_plans'):
+            process_historical_content_plan()
+    finally:
+        accounting.log_summary()
 
 if __name__ == "__main__":
     historical_content_plan_http(None)
@@ -0,0 +1,305 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+OPERATIONS = ('reads', 'writes', 'deletes', 'queries')
+# Methods of the GAPIC Firestore client that instrument() wraps
+INSTRUMENTED_METHODS = ('commit', 'batch_write', 'run_query', 'run_aggregation_query', 'batch_get_documents')
+
+# Stage and tenant of the work running on the current thread
+_local = threading.local()
+# Stage entered most recently on any thread, used by worker threads that didn't enter one
+_default_stage = None
+# Run that operations are currently counted against
+_active_run = None
+# Callables notified with ('read' or 'write', seconds) after every RPC
+_latency_listeners = []
+
+@contextmanager
+def stage_scope(name, default=True):
+    """
+    Attributes Firestore operations to the given stage until the block exits. With
+    default=False only this thread's operations are, for stages that run alongside
+    another one whose workers rely on the default.
+    """
+    global _default_stage
+    previous_stage, previous_default = getattr(_local, 'stage', None), _default_stage
+    _local.stage = name
+    if default:
+        _default_stage = name
+    try:
+        yield
+    finally:
+        _local.stage = previous_stage
+        if default:
+            _default_stage = previous_default
+
+@contextmanager
+def tenant_scope(tenant_id):
+    """Attributes Firestore operations made on this thread to the given user or organization."""
+    previous_tenant = getattr(_local, 'tenant', None)
+    _local.tenant = tenant_id
+    try:
+        yield
+    finally:
+        _local.tenant = previous_tenant
+
+def call_in_tenant(tenant_id, fn, *args):
+    """Calls fn(*args) in tenant_scope(tenant_id), e.g. as a task submitted to a worker pool."""
+    with tenant_scope(tenant_id):
+        return fn(*args)
+
+def iter_tenants(items, tenant_of):
+    """
+    Yields items, attributing the operations made on this thread while each one is
+    being processed to tenant_of(item), for loops that serve one tenant per item.
+    """
+    for item in items:
+        with tenant_scope(tenant_of(item)):
+            yield item
+
+def add_latency_listener(listener):
+    """Calls listener(kind, seconds) after every Firestore RPC on instrumented clients, kind being 'read' or 'write'."""
+    if listener not in _latency_listeners:
+        _latency_listeners.append(listener)
+
+def _notify_latency(kind, seconds):
+    for listener in _latency_listeners:
+        listener(kind, seconds)
+
+def load_budgets():
+    """
+    Reads budgets from FIRESTORE_BUDGET_<OPERATION> (per run) and
+    FIRESTORE_TENANT_BUDGET_<OPERATION> (per tenant), e.g. FIRESTORE_BUDGET_READS=50000.
+    """
+    budgets = {'run': {}, 'tenant': {}}
+    for operation in OPERATIONS:
+        for scope, prefix in (('run', 'FIRESTORE_BUDGET_'), ('tenant', 'FIRESTORE_TENANT_BUDGET_')):
+            value = os.getenv(prefix + operation.upper())
+            if value:
+                budgets[scope][operation] = int(value)
+    return budgets
+
+class FirestoreAccounting:
+    """
+    Counts the document reads, writes and deletes and the queries a job issues, per
+    stage and per tenant. Reads are counted the way Firestore bills them: one per
+    document returned, and one for a query that returns nothing.
+    """
+
+    def __init__(self, job, budgets=None, top_tenants=None):
+        self.job = job
+        self.budgets = budgets if budgets is not None else load_budgets()
+        self.top_tenants = top_tenants if top_tenants is not None else int(os.getenv('FIRESTORE_ACCOUNTING_TOP_TENANTS', '20'))
+        self.lock = threading.Lock()
+        self.by_stage = defaultdict(Counter)
+        self.by_tenant = defaultdict(Counter)
+        self.totals = Counter()
+        self.exceeded = set()
+        self.started_at = time.monotonic()
+
+    def record(self, operation, count=1):
+        stage = getattr(_local, 'stage', None) or _default_stage or 'unscoped'
+        tenant = getattr(_local, 'tenant', None)
+        with self.lock:
+            self.totals[operation] += count
+            self.by_stage[stage][operation] += count
+            if tenant is not None:
+                self.by_tenant[tenant][operation] += count
+            run_total = self.totals[operation]
+            tenant_total = self.by_tenant[tenant][operation] if tenant is not None else 0
+
+        # Warn as soon as a budget is crossed, so runs killed by a timeout still report it
+        run_budget = self.budgets['run'].get(operation)
+        if run_budget is not None and run_total > run_budget:
+            self.warn_once(('run', operation), f"Firestore {operation} budget of {run_budget} exceeded by job {self.job} (stage {stage})")
+        tenant_budget = self.budgets['tenant'].get(operation)
+        if tenant_budget is not None and tenant_total > tenant_budget:
+            self.warn_once((tenant, operation), f"Firestore {operation} budget of {tenant_budget} per tenant exceeded by {tenant} in job {self.job}")
+
+    def warn_once(self, key, message):
+        with self.lock:
+            if key in self.exceeded:
+                return
+            self.exceeded.add(key)
+        logging.warning(message)
+
+    def tenant_counts(self, tenant_id):
+        with self.lock:
+            return Counter(self.by_tenant.get(tenant_id, {}))
+
+    def summary(self):
+        with self.lock:
+            tenants = sorted(self.by_tenant.items(), key=lambda item: sum(item[1].values()), reverse=True)
+            return {
+                'event': 'firestore_accounting',
+                'job': self.job,
+                'elapsed_seconds': round(time.monotonic() - self.started_at, 2),
+                'totals': {operation: self.totals[operation] for operation in OPERATIONS},
+                'stages': {stage: {operation: counts[operation] for operation in OPERATIONS} for stage, counts in self.by_stage.items()},
+                'tenant_count': len(tenants),
+                'top_tenants': {str(tenant): {operation: counts[operation] for operation in OPERATIONS} for tenant, counts in tenants[:self.top_tenants]},
+                'budgets_exceeded': sorted(f"{scope}:{operation}" for scope, operation in self.exceeded)
+            }
+
+    def log_summary(self):
+        summary = self.summary()
+        logging.info(json.dumps(summary, default=str))
+        return summary
+
+    def log_tenant_summary(self, tenant_id, baseline, budgets=None):
+        """
+        Logs the operations made for tenant_id since baseline (an earlier tenant_counts()),
+        for long-lived runs that serve one tenant per request. budgets are per-tenant limits
+        checked against those operations only.
+        """
+        counts = self.tenant_counts(tenant_id)
+        counts.subtract(baseline)
+        exceeded = sorted(operation for operation, budget in (budgets or {}).items() if counts[operation] > budget)
+        for operation in exceeded:
+            logging.warning(f"Firestore {operation} budget of {budgets[operation]} per tenant exceeded by {tenant_id} in job {self.job}")
+        summary = {
+            'event': 'firestore_accounting',
+            'job': self.job,
+            'tenant': str(tenant_id),
+            'totals': {operation: counts[operation] for operation in OPERATIONS},
+            'budgets_exceeded': [f"tenant:{operation}" for operation in exceeded]
+        }
+        logging.info(json.dumps(summary))
+        return summary
+
+def _operation_kind(write):
+    return getattr(write, '_pb', write).WhichOneof('operation')
+
+def _request_writes(kwargs):
+    request = kwargs.get('request')
+    if isinstance(request, dict):
+        return request.get('writes') or []
+    return getattr(request, 'writes', None) or []
+
+def _count_writes(writes):
+    run = _active_run
+    if run is None:
+        return
+    deletes = sum(1 for write in writes if _operation_kind(write) == 'delete')
+    if deletes:
+        run.record('deletes', deletes)
+    if len(writes) - deletes:
+        run.record('writes', len(writes) - deletes)
+
+def _timed_stream(responses, call_seconds):
+    """
+    Yields responses, then reports the time spent waiting on the stream. Time the
+    caller spends between responses (e.g. on nested reads) is not counted.
+    """
+    waited = call_seconds
+    iterator = iter(responses)
+    try:
+        while True:
+            started_at = time.perf_counter()
+            try:
+                response = next(iterator)
+            finally:
+                waited += time.perf_counter() - started_at
+            yield response
+    except StopIteration:
+        return
+    finally:
+        # Single document gets stop after the first response, which closes the stream
+        _notify_latency('read', waited)
+
+def _count_query_stream(responses):
+    run = _active_run
+    if run is not None:
+        run.record('queries')
+    documents = 0
+    try:
+        for response in responses:
+            if run is not None and getattr(response, '_pb', response).HasField('document'):
+                documents += 1
+                run.record('reads')
+            yield response
+    finally:
+        # A query is billed one read even when it matches nothing
+        if run is not None and not documents:
+            run.record('reads')
+
+def _count_get_stream(responses):
+    run = _active_run
+    for response in responses:
+        response_pb = getattr(response, '_pb', response)
+        if run is not None and (response_pb.HasField('found') or response_pb.HasField('missing')):
+            run.record('reads')
+        yield response
+
+def instrument(db):
+    """
+    Wraps the RPC methods of db's underlying Firestore API client so every read,
+    write, delete and query goes through the active run's counters and the latency
+    listeners. Clients are shared per app, so this only needs to happen once per client.
+    """
+    # The GAPIC client is where every document, query, batch and BulkWriter call ends up.
+    # Other storage backends (see utils/storage.py) have no RPCs to count.
+    # This relies on private parts of google-cloud-firestore, verified against the 2.34.1
+    # pinned in requirements.txt: Client._firestore_api, and the GAPIC client's
+    # INSTRUMENTED_METHODS being called with a request= keyword argument. Check both
+    # before upgrading the library.
+    api = getattr(db, '_firestore_api', None)
+    if api is None or getattr(api, '_accounting_instrumented', False):
+        return db
+    missing = [name for name in INSTRUMENTED_METHODS if not callable(getattr(api, name, None))]
+    if missing:
+        logging.warning(f"Firestore operations are not counted: the client's API has no {', '.join(missing)}")
+        return db
+
+    commit, batch_write = api.commit, api.batch_write
+    run_query, run_aggregation_query = api.run_query, api.run_aggregation_query
+    batch_get_documents = api.batch_get_documents
+
+    def timed_call(kind, method, *args, **kwargs):
+        started_at = time.perf_counter()
+        response = method(*args, **kwargs)
+        elapsed = time.perf_counter() - started_at
+        if kind == 'write':
+            _notify_latency(kind, elapsed)
+            return response
+        return _timed_stream(response, elapsed)
+
+    def counted_commit(*args, **kwargs):
+        writes = _request_writes(kwargs)
+        response = timed_call('write', commit, *args, **kwargs)
+        _count_writes(writes)
+        return response
+
+    def counted_batch_write(*args, **kwargs):
+        writes = _request_writes(kwargs)
+        response = timed_call('write', batch_write, *args, **kwargs)
+        _count_writes(writes)
+        return response
+
+    def counted_run_aggregation_query(*args, **kwargs):
+        response = timed_call('read', run_aggregation_query, *args, **kwargs)
+        if _active_run is not None:
+            # Aggregations are billed one read per batch of up to 1000 index entries
+            _active_run.record('queries')
+            _active_run.record('reads')
+        return response
+
+    api.commit = counted_commit
+    api.batch_write = counted_batch_write
+    api.run_query = lambda *args, **kwargs: _count_query_stream(timed_call('read', run_query, *args, **kwargs))
+    api.run_aggregation_query = counted_run_aggregation_query
+    api.batch_get_documents = lambda *args, **kwargs: _count_get_stream(timed_call('read', batch_get_documents, *args, **kwargs))
+    api._accounting_instrumented = True
+    return db
+
+def start_run(job, db, budgets=None):
+    """Instruments db and starts counting its operations for a new run of job."""
+    global _active_run
+    instrument(db)
+    _active_run = FirestoreAccounting(job, budgets=budgets)
+    return _active_run
@@ -1,12 +1,12 @@
 import os
 import logging
 import json
+import threading
 from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import credentials, firestore
-from google.cloud.firestore_v1 import SERVER_TIMESTAMP
 from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from utils.firestore_accounting import iter_tenants, start_run, stage_scope
+from utils.storage import PooledClient, get_pooled_client
+from utils.profiling import profiled
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,7 +14,18 @@ load_dotenv()
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
+# Firebase is initialized on first use rather than at import, so cold starts don't
+# pay for loading credentials and building the gRPC client before they need it.
+_db = None
+_db_lock = threading.Lock()
+
 def initialize_firebase():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    if firebase_admin._apps:
+        return firestore.client()
+
     firebase_creds_path = os.getenv('FIREBASE_CREDENTIALS_JSON')
     logging.info(f"Firebase Credentials Path: {firebase_creds_path}")
 
@@ -29,27 +40,34 @@ def initialize_firebase():
     logging.info("Firebase initialized successfully")
     return firestore.client()
 
-# Initialize Firebase
-db = initialize_firebase()
+def get_db():
+    """Returns the storage client, initializing Firebase on first use unless STORAGE_BACKEND selects another backend."""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                from utils.storage import get_client, storage_backend
+                _db = initialize_firebase() if storage_backend() == 'firestore' else get_client()
+    return _db
 
 class DailyUpdater:
     def __init__(self, max_workers=10):
-        self.db = firestore.client()
+        # Worker threads each use their own pooled client, whichever of these they call
+        self.db = PooledClient()
         self.max_workers = max_workers
-        self.thread_local = threading.local()
 
     def get_db(self):
-        if not hasattr(self.thread_local, "db"):
-            self.thread_local.db = firestore.client()
-        return self.thread_local.db
+        return get_pooled_client()
 
     def update_user_account_count(self):
         """Updates each user's SocialMediaPlatforms with the count of accounts inside the Accounts collection."""
+        from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+
         db = self.get_db()
         users_ref = db.collection('users')
         users = users_ref.stream()
 
-        for user in users:
+        for user in iter_tenants(users, lambda user: user.id):
             logging.info(f"Checking accounts for user: {user.id}")
             platforms_ref = user.reference.collection('SocialMediaPlatforms').document('TikTok')
             accounts_ref = platforms_ref.collection('Accounts')
@@ -86,10 +104,17 @@ class DailyUpdater:
 
         logging.info("Daily updates completed for all users.")
 
+@profiled('document_filler')
 def document_filler_http(request):
     logging.info("Starting Document Filler...")
-    updater = DailyUpdater()
-    updater.run()
+    # DailyUpdater's pooled clients are counted along with the default app's client
+    accounting = start_run('document_filler', get_db())
+    try:
+        with stage_scope('account_counts'):
+            updater = DailyUpdater()
+            updater.run()
+    finally:
+        accounting.log_summary()
 
     return "Document filler completed successfully."
 
@@ -0,0 +1,136 @@
+import itertools
+import logging
+import os
+import threading
+
+DEFAULT_SQLITE_PATH = 'ovrsee.sqlite3'
+
+def storage_backend():
+    """'firestore' (the default) or 'sqlite', from STORAGE_BACKEND."""
+    return os.getenv('STORAGE_BACKEND', 'firestore').lower()
+
+def get_client():
+    """
+    Returns the client for the configured backend. Both expose the same document,
+    collection, query and batch API, so jobs don't need to know which one they use.
+    With Firestore, the default Firebase app must already be initialized.
+    """
+    if storage_backend() == 'sqlite':
+        # The SQLite backend lives in Benchmarks/sqlite_storage.py and is not deployed with the functions
+        try:
+            from sqlite_storage import get_sqlite_client
+        except ImportError as e:
+            raise ValueError("STORAGE_BACKEND=sqlite needs the Benchmarks directory on PYTHONPATH") from e
+        return get_sqlite_client(os.getenv('SQLITE_DATABASE_PATH', DEFAULT_SQLITE_PATH))
+    from firebase_admin import firestore
+    return firestore.client()
+
+# Firestore client pool. One client multiplexes every RPC over a single gRPC channel,
+# i.e. one HTTP/2 connection capped at 100 concurrent streams, which is what limits
+# how far max_workers can usefully go. Worker threads are spread over several clients
+# instead, each with its own channel and connection.
+
+_client_pool = None
+_client_pool_lock = threading.Lock()
+_firestore_api_factory = None
+
+def firestore_channel_options():
+    """gRPC channel options for pooled clients, from the FIRESTORE_KEEPALIVE_* settings."""
+    return [
+        ('grpc.keepalive_time_ms', int(os.getenv('FIRESTORE_KEEPALIVE_TIME_MS', '30000'))),
+        ('grpc.keepalive_timeout_ms', int(os.getenv('FIRESTORE_KEEPALIVE_TIMEOUT_MS', '10000'))),
+        ('grpc.keepalive_permit_without_calls', int(os.getenv('FIRESTORE_KEEPALIVE_PERMIT_WITHOUT_CALLS', '1'))),
+        ('grpc.http2.max_pings_without_data', 0),
+        # Channels with identical options otherwise share subchannels, i.e. one connection
+        ('grpc.use_local_subchannel_pool', 1),
+        ('grpc.max_send_message_length', -1),
+        ('grpc.max_receive_message_length', -1),
+    ]
+
+# google.cloud.firestore.Client takes no transport or channel options, so the pool sets
+# them through private attributes: Client._target, _credentials, _database,
+# _client_options, _emulator_host and _firestore_api_internal, and the GAPIC transport's
+# create_channel(). They were verified against google-cloud-firestore 2.34.1, which
+# requirements.txt pins; check them before upgrading. Without them, pooled clients
+# fall back to the channel each client creates itself.
+POOL_CLIENT_ATTRIBUTES = ('_target', '_credentials', '_database', '_client_options', '_emulator_host', '_firestore_api_internal')
+
+def create_firestore_api(client, channel_options):
+    """The GAPIC client for client, on a new channel built with channel_options."""
+    from google.cloud.firestore_v1.services.firestore import client as firestore_client
+    from google.cloud.firestore_v1.services.firestore.transports import grpc as firestore_grpc_transport
+
+    transport_class = firestore_grpc_transport.FirestoreGrpcTransport
+    channel = transport_class.create_channel(client._target, credentials=client._credentials, options=channel_options)
+    client._transport = transport_class(host=client._target, channel=channel)
+    return firestore_client.FirestoreClient(transport=client._transport, client_options=client._client_options)
+
+def set_firestore_api_factory(factory):
+    """
+    Replaces create_firestore_api(client, channel_options) for clients the pool creates
+    from then on (the benchmarks route them to their in-memory Firestore).
+    """
+    global _firestore_api_factory
+    _firestore_api_factory = factory
+
+class FirestoreClientPool:
+    """
+    size Firestore clients for the default app's project and credentials, each on its
+    own channel. Each thread is given one client, round-robin, and keeps it.
+    """
+
+    def __init__(self, base_client, size, channel_options=None):
+        from google.cloud import firestore
+        from utils.firestore_accounting import instrument
+
+        self.size = max(1, size)
+        self.channel_options = channel_options or firestore_channel_options()
+        api_factory = _firestore_api_factory or create_firestore_api
+        self.clients = []
+        for _ in range(self.size):
+            client = firestore.Client(project=base_client.project, credentials=getattr(base_client, '_credentials', None),
+                                      database=getattr(base_client, '_database', None))
+            if not all(hasattr(client, name) for name in POOL_CLIENT_ATTRIBUTES):
+                logging.warning("Firestore client internals changed, pooled clients use their default channel options")
+            # The emulator needs its insecure channel, which the client creates itself
+            elif client._emulator_host is None:
+                client._firestore_api_internal = api_factory(client, self.channel_options)
+            # Runs count the default client's RPCs; pooled clients must be counted too
+            self.clients.append(instrument(client))
+        self._next = itertools.count()
+        self._thread_local = threading.local()
+
+    def client(self):
+        """The calling thread's client."""
+        client = getattr(self._thread_local, 'client', None)
+        if client is None:
+            client = self.clients[next(self._next) % self.size]
+            self._thread_local.client = client
+        return client
+
+def get_client_pool():
+    """The process-wide FirestoreClientPool, FIRESTORE_POOL_SIZE clients (default 4)."""
+    global _client_pool
+    if _client_pool is None:
+        with _client_pool_lock:
+            if _client_pool is None:
+                _client_pool = FirestoreClientPool(get_client(), int(os.getenv('FIRESTORE_POOL_SIZE', '4')))
+    return _client_pool
+
+def get_pooled_client():
+    """
+    The storage client for the calling thread: its pooled Firestore client, or with
+    SQLite, the shared client (SQLite serializes writers on one connection anyway).
+    """
+    if storage_backend() != 'firestore':
+        return get_client()
+    return get_client_pool().client()
+
+class PooledClient:
+    """
+    Stand-in for a client that forwards every call to the calling thread's pooled
+    client, for objects created on one thread and used from the workers.
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_pooled_client(), name)
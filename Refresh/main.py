@@ -1,14 +1,14 @@
 import os
 import logging
 import json
+import threading
+import functools
+import time
 from dotenv import load_dotenv
-import firebase_admin
 import pytz
 from datetime import datetime, timedelta
-from firebase_admin import credentials, firestore
-from utils.tiktok_api import TikTokAPI
-from concurrent.futures import ThreadPoolExecutor
-from google.cloud import functions_v1
+from concurrent.futures import ThreadPoolExecutor, Future
+from utils.profiling import profiled
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,7 +16,18 @@ load_dotenv()
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
+# Firebase and the TikTok clients are created on first use rather than at import,
+# so cold starts (and CORS preflights) don't pay for loading credentials and gRPC.
+_db = None
+_db_lock = threading.Lock()
+
 def initialize_firebase():
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    if firebase_admin._apps:
+        return firestore.client()
+
     firebase_creds_path = os.getenv('FIREBASE_CREDENTIALS_JSON')
     logging.info(f"Firebase Credentials Path: {firebase_creds_path}")
 
@@ -31,62 +42,192 @@ def initialize_firebase():
     logging.info("Firebase initialized successfully")
     return firestore.client()
 
-# Initialize Firebase
-db = initialize_firebase()
+def get_db():
+    """Returns the storage client, initializing Firebase on first use unless STORAGE_BACKEND selects another backend."""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                from utils.storage import get_client, storage_backend
+                _db = initialize_firebase() if storage_backend() == 'firestore' else get_client()
+    return _db
+
+# Memoized per instance so cached tokens survive across warm invocations
+@functools.lru_cache(maxsize=None)
+def get_platform_api():
+    from utils.tiktok_api import TikTokAPI
+    return TikTokAPI()
+
+@functools.lru_cache(maxsize=None)
+def get_token_provider():
+    from utils.token_provider import TokenProvider
+    return TokenProvider(get_db(), get_platform_api())
+
+@functools.lru_cache(maxsize=None)
+def get_circuit_breaker():
+    from utils.circuit_breaker import AccountCircuitBreaker
+    return AccountCircuitBreaker(get_db())
+
+@functools.lru_cache(maxsize=None)
+def get_accounting():
+    # One run per instance, since requests for different users are served concurrently;
+    # each scan logs its own user's operations and checks them against the per-user budgets.
+    from utils.firestore_accounting import start_run
+    return start_run('video_refresh', get_db(), budgets={'run': {}, 'tenant': {}})
 
 def process_account(user_id, account_data):
     """
-    Process a single TikTok account for a given user.
+    Process a single TikTok account for a given user. Returns the account's result.
     """
+    from utils.token_provider import TokenRefreshError
+    from utils.tiktok_api import collect_videos_since
+
     logging.info(f"Processing account {account_data['username']} for user {user_id}")
-    
-    platform_api = TikTokAPI()
-    access_token = account_data['tokens']['access_token']
+    db = get_db()
+    platform_api = get_platform_api()
+    token_provider = get_token_provider()
+    circuit_breaker = get_circuit_breaker()
+
     open_id = account_data['tokens'].get('open_id')
-    
+
     if not open_id:
         logging.error(f"open_id not found for TikTok user {user_id}, account: {account_data['username']}")
-        return
+        return {'account': account_data['username'], 'status': 'error', 'error': 'open_id not found'}
 
     account_username = account_data['username']
 
-    # Fetch video list using TikTok API
+    # Fetch video list using TikTok API, only as far back as the 24 hour window
+    cutoff = int((datetime.now(pytz.utc) - timedelta(hours=24)).timestamp())
     try:
-        video_list = platform_api.fetch_video_list(access_token, open_id)
-        logging.info(f"Fetched video list for user {user_id}, account {account_username}")
-        store_new_videos(db, platform_api, user_id, 'TikTok', account_username, video_list)
+        video_list = token_provider.call_with_token(
+            user_id, account_data, lambda access_token: collect_videos_since(platform_api.fetch_video_list(access_token, open_id), cutoff)
+        )
+    except TokenRefreshError as e:
+        logging.error(f"Failed to refresh token for user {user_id}, account {account_username}: {e}")
+        circuit_breaker.record_failure(user_id, account_data, e, error_class='auth')
+        return {'account': account_username, 'status': 'reauth_required', 'error': str(e)}
     except Exception as e:
         logging.error(f"Failed to fetch video list for user {user_id}, account {account_username}: {e}")
+        circuit_breaker.record_failure(user_id, account_data, e)
+        return {'account': account_username, 'status': 'error', 'error': str(e)}
+
+    logging.info(f"Fetched video list for user {user_id}, account {account_username}")
+    circuit_breaker.record_success(user_id, account_data)
+    store_new_videos(db, platform_api, user_id, 'TikTok', account_username, video_list)
+    return {'account': account_username, 'status': 'ok'}
 
-def check_new_videos(uid):
+def check_new_videos(uid, job=None):
     """
     Function to check for new videos for all TikTok accounts
     of a specific user and update Firestore with new videos.
+    Returns a summary with one result per account, which is also
+    reported to the VideoRefreshJob when one is given.
     """
+    from utils.firestore_accounting import call_in_tenant
+
     logging.info(f"Starting video check for user {uid}")
-    
+    db = get_db()
+    circuit_breaker = get_circuit_breaker()
+
     # Get the TikTok account details for the user
     accounts_ref = db.collection('users').document(uid).collection('SocialMediaPlatforms').document('TikTok').collection('Accounts')
     accounts = [acc.to_dict() for acc in accounts_ref.stream()]
 
+    results = []
     if not accounts:
         logging.error(f"No TikTok accounts found for user {uid}")
-        return
+        return {'uid': uid, 'accounts': results}
+
+    # Accounts with revoked or repeatedly failing tokens wait out their cool-down
+    eligible_accounts = []
+    for account in accounts:
+        if circuit_breaker.is_open(account):
+            results.append({'account': account.get('username'), 'status': 'skipped', 'error': 'circuit breaker open'})
+        else:
+            eligible_accounts.append(account)
+    if len(eligible_accounts) < len(accounts):
+        logging.info(f"Skipping {len(accounts) - len(eligible_accounts)} accounts with an open circuit breaker for user {uid}")
+    accounts = eligible_accounts
+
+    if job:
+        job.accounts_loaded(len(results) + len(accounts))
+        for result in results:
+            job.account_done(result)
 
     # Use ThreadPoolExecutor to process all accounts concurrently
     with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_account, uid, account) for account in accounts]
-        for future in futures:
+        futures = [(account, executor.submit(call_in_tenant, uid, process_account, uid, account)) for account in accounts]
+        for account, future in futures:
             try:
-                future.result()  # Wait for each thread to finish
+                result = future.result()  # Wait for each thread to finish
             except Exception as e:
                 logging.error(f"Error processing account: {str(e)}")
+                result = {'account': account.get('username'), 'status': 'error', 'error': str(e)}
+            results.append(result)
+            if job:
+                job.account_done(result)
 
     logging.info(f"Video scan completed for all accounts for user {uid}")
+    return {'uid': uid, 'accounts': results}
+
+# Scans in flight and recently finished scans per uid, shared by all requests
+# served by this instance
+_scan_lock = threading.Lock()
+_inflight_scans = {}
+_recent_scans = {}
+
+def refresh_videos_for_user(uid, force=False, job=None):
+    """
+    Runs check_new_videos for uid, coalescing concurrent requests for the same uid
+    into a single scan. A scan that finished within VIDEO_REFRESH_FRESHNESS_SECONDS
+    with at least one account refreshed is returned as is unless force is set.
+    Returns (result, source) where source is 'scan', 'coalesced' or 'cache'.
+    """
+    freshness_window = float(os.getenv('VIDEO_REFRESH_FRESHNESS_SECONDS', '60'))
+
+    with _scan_lock:
+        recent_scan = _recent_scans.get(uid)
+        if not force and recent_scan and time.monotonic() - recent_scan[0] < freshness_window:
+            return recent_scan[1], 'cache'
 
-def store_new_videos(db, platform_api, user_id, platform, account_username, media_list):
+        future = _inflight_scans.get(uid)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _inflight_scans[uid] = future
+
+    if not is_leader:
+        logging.info(f"Joining in-flight video scan for user {uid}")
+        return future.result(), 'coalesced'
+
+    from utils.firestore_accounting import load_budgets, tenant_scope
+    accounting = get_accounting()
+    baseline = accounting.tenant_counts(uid)
+    try:
+        with tenant_scope(uid):
+            result = check_new_videos(uid, job=job)
+    except Exception as e:
+        with _scan_lock:
+            del _inflight_scans[uid]
+        future.set_exception(e)
+        raise
+    finally:
+        accounting.log_tenant_summary(uid, baseline, budgets=load_budgets()['tenant'])
+
+    with _scan_lock:
+        finished_at = time.monotonic()
+        # Drop expired results so the cache stays bounded by recent traffic
+        for cached_uid in [key for key, (scanned_at, _) in _recent_scans.items() if finished_at - scanned_at >= freshness_window]:
+            del _recent_scans[cached_uid]
+        # A scan where every account failed or was skipped is retried by the next request
+        if any(account.get('status') == 'ok' for account in result['accounts']):
+            _recent_scans[uid] = (finished_at, result)
+        del _inflight_scans[uid]
+    future.set_result(result)
+    return result, 'scan'
+
+def store_new_videos(db, platform_api, user_id, platform, account_username, video_data_list):
     videos_ref = db.collection('users').document(user_id).collection('SocialMediaPlatforms').document(platform).collection('Accounts').document(account_username).collection('Videos')
-    video_data_list = media_list.get('data', {}).get('videos', [])
     fetched_video_ids = set()
     current_time = datetime.now(pytz.utc)  # This is a timezone-aware datetime
 
@@ -136,6 +277,7 @@ def store_new_videos(db, platform_api, user_id, platform, account_username, medi
 
     logging.info(f'Successfully stored new videos for user {user_id}, platform {platform}, and account {account_username}')
 
+@profiled('video_refresh')
 def video_refresh_http(request):
     """
     Cloud Function HTTP trigger. This function runs the TikTok video scan for all accounts of the user.
@@ -164,12 +306,81 @@ def video_refresh_http(request):
 
     uid = request_json['uid']
     try:
-        check_new_videos(uid)
-        return {'status': f'Video scan completed for all TikTok accounts of user {uid}'}, 200, headers
+        result, source = refresh_videos_for_user(uid, force=bool(request_json.get('force')))
+        return {
+            'status': f'Video scan completed for all TikTok accounts of user {uid}',
+            'source': source,
+            'accounts': result['accounts']
+        }, 200, headers
     except Exception as e:
         logging.error(f"Error during video scan: {str(e)}")
         return {'error': str(e)}, 500, headers
 
+# Background scans for asynchronous refresh jobs. Work continues after the 202
+# response, so the function needs CPU allocated outside of requests
+# (2nd gen with --no-cpu-throttling) for jobs to make progress promptly.
+_job_executor = ThreadPoolExecutor(max_workers=int(os.getenv('VIDEO_REFRESH_JOB_WORKERS', '4')))
+
+def run_refresh_job(job, uid, force):
+    try:
+        job.mark_running()
+        result, source = refresh_videos_for_user(uid, force=force, job=job)
+        job.complete(result, source)
+    except Exception as e:
+        job.fail(e)
+
+def video_refresh_async_http(request):
+    """
+    Cloud Function HTTP trigger for asynchronous video refreshes.
+    POST {"uid": ...} records a job and returns 202 with its id straight away; the
+    scan runs in the background. GET ?job_id=...&uid=... returns the status and
+    per-account results of that user's job. A job without progress for
+    VIDEO_REFRESH_JOB_STALE_SECONDS (default 600), e.g. because the instance running
+    it was shut down, is reported as failed.
+    """
+    from utils.refresh_jobs import VideoRefreshJob
+
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+    }
+
+    if request.method == 'GET':
+        job_id = request.args.get('job_id')
+        if not job_id:
+            return {'error': 'Job ID (job_id) not provided'}, 400, headers
+        uid = request.args.get('uid')
+        if not uid:
+            return {'error': 'User ID (uid) not provided'}, 400, headers
+        stale_after = timedelta(seconds=float(os.getenv('VIDEO_REFRESH_JOB_STALE_SECONDS', '600')))
+        # Other users' jobs are reported as missing
+        job_data = VideoRefreshJob.get(get_db(), job_id, uid, stale_after)
+        if job_data is None:
+            return {'error': f'Job {job_id} not found'}, 404, headers
+        return job_data, 200, headers
+
+    request_json = request.get_json(silent=True)
+    if not request_json or 'uid' not in request_json:
+        return {'error': 'User ID (uid) not provided'}, 400, headers
+
+    uid = request_json['uid']
+    try:
+        job = VideoRefreshJob.create(get_db(), uid)
+    except Exception as e:
+        logging.error(f"Error creating video refresh job: {str(e)}")
+        return {'error': str(e)}, 500, headers
+
+    _job_executor.submit(run_refresh_job, job, uid, bool(request_json.get('force')))
+    return {'job_id': job.job_id, 'status': 'queued'}, 202, headers
+
 # If executed as a standalone script
 if __name__ == '__main__':
     video_refresh_http(None)
\ No newline at end of file
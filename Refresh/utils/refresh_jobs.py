@@ -0,0 +1,100 @@
+import logging
+import uuid
+from datetime import datetime, timezone
+from google.api_core.exceptions import FailedPrecondition
+from firebase_admin import firestore
+
+JOBS_COLLECTION = 'videoRefreshJobs'
+STALE_ERROR = 'The job stopped making progress, most likely because its instance was shut down. Start a new one.'
+
+class VideoRefreshJob:
+    """
+    Progress record for an asynchronous video refresh, stored in videoRefreshJobs/{job_id}.
+
+    status moves from 'queued' to 'running' to 'completed' or 'failed'. Per-account
+    results are appended to 'results' as each account finishes, so clients can poll
+    the document for progress. Every update sets heartbeat_at; a job whose instance
+    went away stops updating it, and is marked failed by the next status request.
+    """
+
+    def __init__(self, db, job_id):
+        self.db = db
+        self.job_id = job_id
+        self.ref = db.collection(JOBS_COLLECTION).document(job_id)
+
+    @classmethod
+    def create(cls, db, uid):
+        job = cls(db, uuid.uuid4().hex)
+        job.ref.set({
+            'uid': uid,
+            'status': 'queued',
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'heartbeat_at': firestore.SERVER_TIMESTAMP,
+            'total_accounts': None,
+            'completed_accounts': 0,
+            'results': []
+        })
+        return job
+
+    @classmethod
+    def get(cls, db, job_id, uid, stale_after):
+        """
+        Returns uid's job as a dict, or None if it does not exist or belongs to another
+        user. A queued or running job without a heartbeat for stale_after is marked
+        failed first, unless it was updated meanwhile.
+        """
+        snapshot = db.collection(JOBS_COLLECTION).document(job_id).get()
+        if not snapshot.exists:
+            return None
+        job_data = snapshot.to_dict()
+        if job_data.get('uid') != uid:
+            return None
+        last_heartbeat = job_data.get('heartbeat_at') or job_data.get('created_at')
+        if job_data.get('status') in ('queued', 'running') and last_heartbeat is not None \
+                and last_heartbeat < datetime.now(timezone.utc) - stale_after:
+            job_data = cls(db, job_id).fail_stale(snapshot) or job_data
+        job_data.pop('uid', None)
+        job_data['job_id'] = job_id
+        return job_data
+
+    def fail_stale(self, snapshot):
+        """Marks the job failed if it is unchanged since snapshot. Returns the updated data, or None if it changed."""
+        failure = {'status': 'failed', 'error': STALE_ERROR, 'finished_at': datetime.now(timezone.utc)}
+        try:
+            self.ref.update(failure, option=self.db.write_option(last_update_time=snapshot.update_time))
+        except FailedPrecondition:
+            return None
+        logging.warning(f"Video refresh job {self.job_id} stopped making progress, marked failed")
+        return dict(snapshot.to_dict(), **failure)
+
+    def mark_running(self):
+        self.ref.update({'status': 'running', 'started_at': firestore.SERVER_TIMESTAMP, 'heartbeat_at': firestore.SERVER_TIMESTAMP})
+
+    def accounts_loaded(self, total_accounts):
+        self.ref.update({'total_accounts': total_accounts, 'heartbeat_at': firestore.SERVER_TIMESTAMP})
+
+    def account_done(self, result):
+        # Usernames may contain dots, so results are an array rather than a map keyed by username
+        self.ref.update({
+            'completed_accounts': firestore.Increment(1),
+            'results': firestore.ArrayUnion([result]),
+            'heartbeat_at': firestore.SERVER_TIMESTAMP
+        })
+
+    def complete(self, result, source):
+        self.ref.update({
+            'status': 'completed',
+            'source': source,
+            'total_accounts': len(result['accounts']),
+            'completed_accounts': len(result['accounts']),
+            'results': result['accounts'],
+            'finished_at': firestore.SERVER_TIMESTAMP
+        })
+
+    def fail(self, error):
+        logging.error(f"Video refresh job {self.job_id} failed: {error}")
+        self.ref.update({
+            'status': 'failed',
+            'error': str(error),
+            'finished_at': firestore.SERVER_TIMESTAMP
+        })
@@ -0,0 +1,23 @@
+import os
+
+DEFAULT_SQLITE_PATH = 'ovrsee.sqlite3'
+
+def storage_backend():
+    """'firestore' (the default) or 'sqlite', from STORAGE_BACKEND."""
+    return os.getenv('STORAGE_BACKEND', 'firestore').lower()
+
+def get_client():
+    """
+    Returns the client for the configured backend. Both expose the same document,
+    collection, query and batch API, so jobs don't need to know which one they use.
+    With Firestore, the default Firebase app must already be initialized.
+    """
+    if storage_backend() == 'sqlite':
+        # The SQLite backend lives in Benchmarks/sqlite_storage.py and is not deployed with the functions
+        try:
+            from sqlite_storage import get_sqlite_client
+        except ImportError as e:
+            raise ValueError("STORAGE_BACKEND=sqlite needs the Benchmarks directory on PYTHONPATH") from e
+        return get_sqlite_client(os.getenv('SQLITE_DATABASE_PATH', DEFAULT_SQLITE_PATH))
+    from firebase_admin import firestore
+    return firestore.client()
@@ -0,0 +1,161 @@
+import glob
+import gzip
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+REDACTED = 'REDACTED'
+# Request and response fields never written to a fixture
+SECRET_FIELDS = {'access_token', 'refresh_token', 'client_key', 'client_secret'}
+
+def redact(value):
+    """Returns value with every secret field, at any depth, replaced by REDACTED."""
+    if isinstance(value, dict):
+        return {key: REDACTED if key in SECRET_FIELDS else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+def redact_body(body, content_type):
+    """Redacts a JSON or form-encoded body, returned as text."""
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', errors='replace')
+    if 'application/x-www-form-urlencoded' in (content_type or ''):
+        return urlencode([(key, REDACTED if key in SECRET_FIELDS else value) for key, value in parse_qsl(body, keep_blank_values=True)])
+    try:
+        # Sorted keys, so the same request always redacts to the same text
+        return json.dumps(redact(json.loads(body)), sort_keys=True)
+    except ValueError:
+        return body
+
+def request_key(method, url, body, content_type):
+    """What a live request is matched on during replay: method, path and redacted body."""
+    return method.upper(), urlsplit(url).path, redact_body(body, content_type)
+
+class TrafficRecorder:
+    """
+    requests response hook appending every TikTok response, with tokens and client
+    credentials redacted, to a gzip-compressed JSON lines fixture file. Each record is
+    written as its own gzip member, so a run that is killed leaves a readable file.
+    """
+
+    def __init__(self, fixtures_dir):
+        os.makedirs(fixtures_dir, exist_ok=True)
+        self.path = os.path.join(fixtures_dir, f"tiktok-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.jsonl.gz")
+        self.lock = threading.Lock()
+
+    def __call__(self, response, *args, **kwargs):
+        request = response.request
+        request_content_type = request.headers.get('Content-Type')
+        method, path, request_body = request_key(request.method, request.url, request.body, request_content_type)
+        record = {
+            'method': method,
+            'path': path,
+            'query': urlsplit(request.url).query,
+            'request_content_type': request_content_type,
+            'request_body': request_body,
+            'status': response.status_code,
+            'reason': response.reason,
+            'content_type': response.headers.get('Content-Type'),
+            'body': redact_body(response.content, response.headers.get('Content-Type')),
+            'elapsed_seconds': response.elapsed.total_seconds()
+        }
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        try:
+            with self.lock, gzip.open(self.path, 'ab') as f:
+                f.write(line)
+        except OSError as e:
+            logging.error(f"Failed to record TikTok response to {self.path}: {e}")
+
+def load_fixtures(fixtures_dir):
+    """Reads every recorded interaction in fixtures_dir, oldest file first."""
+    records = []
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, '*.jsonl.gz'))):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter serving recorded TikTok responses instead of opening connections.
+
+    A request gets the responses recorded for the same method, path and redacted body,
+    in recording order. Requests that were never recorded (e.g. other account IDs in a
+    load test) get the responses recorded for the same method and path. Both cycle once
+    exhausted. Each response is delayed by its recorded latency times latency_scale.
+    """
+
+    def __init__(self, records, latency_scale=1.0):
+        super().__init__()
+        if not records:
+            raise ValueError("No TikTok fixtures to replay")
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        by_request, by_path = {}, {}
+        for record in records:
+            key = (record['method'], record['path'], record['request_body'])
+            by_request.setdefault(key, []).append(record)
+            by_path.setdefault(key[:2], []).append(record)
+        self.by_request = {key: itertools.cycle(group) for key, group in by_request.items()}
+        self.by_path = {key: itertools.cycle(group) for key, group in by_path.items()}
+
+    def next_record(self, request):
+        key = request_key(request.method, request.url, request.body, request.headers.get('Content-Type'))
+        with self.lock:
+            responses = self.by_request.get(key) or self.by_path.get(key[:2])
+            return next(responses) if responses is not None else None
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        record = self.next_record(request)
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        if record is None:
+            response.status_code = 404
+            response.reason = 'Not Recorded'
+            response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+            response._content = json.dumps({'error': {'code': 'not_recorded', 'message': f"No fixture for {request.method} {request.url}"}}).encode('utf-8')
+            return response
+
+        delay = record['elapsed_seconds'] * self.latency_scale
+        if delay > 0:
+            time.sleep(delay)
+        response.status_code = record['status']
+        response.reason = record.get('reason')
+        response.headers = CaseInsensitiveDict({'Content-Type': record.get('content_type') or 'application/json'})
+        response._content = (record.get('body') or '').encode('utf-8')
+        response.elapsed = timedelta(seconds=delay)
+        return response
+
+    def close(self):
+        pass
+
+def configure_session(session, base_url):
+    """
+    Applies TIKTOK_API_MODE to a TikTokAPI session. 'record' saves every response to
+    TIKTOK_API_FIXTURES_DIR; 'replay' serves the fixtures found there instead of calling
+    TikTok, scaling recorded latencies by TIKTOK_API_REPLAY_LATENCY_SCALE (0 disables
+    them). Any other value (the default, 'live') leaves the session unchanged.
+    """
+    mode = os.getenv('TIKTOK_API_MODE', 'live').lower()
+    fixtures_dir = os.getenv('TIKTOK_API_FIXTURES_DIR', 'tiktok_fixtures')
+    if mode == 'record':
+        recorder = TrafficRecorder(fixtures_dir)
+        session.hooks['response'].append(recorder)
+        logging.info(f"Recording TikTok API traffic to {recorder.path}")
+    elif mode == 'replay':
+        latency_scale = float(os.getenv('TIKTOK_API_REPLAY_LATENCY_SCALE', '1'))
+        session.mount(base_url, ReplayAdapter(load_fixtures(fixtures_dir), latency_scale))
+        logging.info(f"Replaying TikTok API traffic from {fixtures_dir} (latency x{latency_scale})")
+    return session
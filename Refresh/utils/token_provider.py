@@ -0,0 +1,195 @@
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+import requests
+from utils.circuit_breaker import is_invalid_grant
+from utils.storage import storage_backend
+
+class TokenRefreshError(Exception):
+    """Raised when an account's access token cannot be refreshed."""
+
+def compute_token_expiries(tokens, issued_at):
+    """Turns the relative expires_in/refresh_expires_in (seconds) into absolute UTC datetimes."""
+    expiries = {}
+    if tokens.get('expires_in') is not None:
+        expiries['access_expires_at'] = issued_at + timedelta(seconds=int(tokens['expires_in']))
+    if tokens.get('refresh_expires_in') is not None:
+        expiries['refresh_expires_at'] = issued_at + timedelta(seconds=int(tokens['refresh_expires_in']))
+    return expiries
+
+def as_utc(value):
+    # Firestore returns aware datetimes, while older docs may hold naive UTC ones
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+def store_if_unrotated(db, account_ref, refresh_token, write):
+    """
+    Calls write(writer) and commits its writes in a transaction if the account still
+    holds refresh_token, so that tokens refreshed elsewhere meanwhile aren't overwritten.
+    writer takes the same set/update calls as a batch. Returns None once written, or
+    the account's current data if its refresh token changed.
+    """
+    def rotated_data(snapshot):
+        current_data = snapshot.to_dict() if snapshot.exists else {}
+        if (current_data.get('tokens') or {}).get('refresh_token') != refresh_token:
+            return current_data
+        return None
+
+    def store(transaction):
+        current_data = rotated_data(account_ref.get(transaction=transaction))
+        if current_data is None:
+            write(transaction)
+        return current_data
+
+    if storage_backend() != 'firestore':
+        # The other backends are local to one process, where the refresh lock already serializes this
+        current_data = rotated_data(account_ref.get())
+        if current_data is None:
+            batch = db.batch()
+            write(batch)
+            batch.commit()
+        return current_data
+    from google.cloud.firestore_v1 import transactional
+    return transactional(store)(db.transaction())
+
+class TokenProvider:
+    """
+    Hands out TikTok access tokens for linked accounts and refreshes them just in time.
+
+    Tokens are cached in-process until shortly before they expire (or for max_ttl
+    when the expiry is unknown). Refreshes are single-flight per account, so
+    concurrent workers hitting the same expired token only refresh it once. Across
+    processes (another instance, or the TokenRefresh job), the refreshed tokens are
+    only stored if the account still holds the refresh token that was used: TikTok
+    rotates it, so a refresh that lost the race uses the tokens the winner stored.
+    """
+
+    def __init__(self, db, platform_api, refresh_margin=timedelta(minutes=5), max_ttl=timedelta(hours=1)):
+        self.db = db
+        self.platform_api = platform_api
+        self.refresh_margin = refresh_margin
+        self.max_ttl = max_ttl
+        self._cache = {}
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def get_account_ref(self, user_id, account_username):
+        return self.db.collection('users').document(user_id).collection('SocialMediaPlatforms').document('TikTok').collection('Accounts').document(account_username)
+
+    def _get_lock(self, key):
+        with self._locks_guard:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _is_fresh(self, expires_at, now):
+        expires_at = as_utc(expires_at)
+        return expires_at is None or expires_at - self.refresh_margin > now
+
+    def _cache_token(self, key, access_token, expires_at, now):
+        valid_until = now + self.max_ttl
+        expires_at = as_utc(expires_at)
+        if expires_at is not None:
+            valid_until = min(valid_until, expires_at - self.refresh_margin)
+        self._cache[key] = (access_token, valid_until)
+
+    def _get_cached(self, key, now):
+        cached = self._cache.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+        return None
+
+    def get_access_token(self, user_id, account_data):
+        """Returns a usable access token, refreshing it first if it is about to expire."""
+        key = (user_id, account_data['username'])
+        now = datetime.now(timezone.utc)
+
+        cached_token = self._get_cached(key, now)
+        if cached_token:
+            return cached_token
+
+        access_token = account_data.get('tokens', {}).get('access_token')
+        expires_at = account_data.get('access_expires_at')
+        if access_token and self._is_fresh(expires_at, now):
+            self._cache_token(key, access_token, expires_at, now)
+            return access_token
+
+        return self.refresh(user_id, account_data, stale_token=access_token)
+
+    def refresh(self, user_id, account_data, stale_token=None):
+        """
+        Refreshes the account's access token unless another thread (or the scheduled
+        refresh job) already replaced stale_token with a fresh one.
+        """
+        account_username = account_data['username']
+        key = (user_id, account_username)
+
+        with self._get_lock(key):
+            now = datetime.now(timezone.utc)
+            cached_token = self._get_cached(key, now)
+            if cached_token and cached_token != stale_token:
+                return cached_token
+
+            # Re-read the account, the refresh token may have been rotated since it was loaded
+            account_ref = self.get_account_ref(user_id, account_username)
+            snapshot = account_ref.get()
+            current_data = snapshot.to_dict() if snapshot.exists else account_data
+            current_tokens = current_data.get('tokens', {})
+
+            access_token = current_tokens.get('access_token')
+            expires_at = current_data.get('access_expires_at')
+            if access_token and access_token != stale_token and self._is_fresh(expires_at, now):
+                self._cache_token(key, access_token, expires_at, now)
+                return access_token
+
+            refresh_token = current_tokens.get('refresh_token')
+            if not refresh_token:
+                raise TokenRefreshError(f"No refresh token found for user {user_id}, TikTok account {account_username}")
+
+            try:
+                new_tokens = self.platform_api.refresh_access_token(refresh_token)
+            except requests.exceptions.HTTPError as e:
+                if is_invalid_grant(e.response):
+                    raise TokenRefreshError(f"Refresh token revoked or already used for user {user_id}, TikTok account {account_username}") from e
+                raise
+            if 'error' in new_tokens or not new_tokens.get('access_token'):
+                raise TokenRefreshError(f"Failed to refresh token for user {user_id}, TikTok account {account_username}: {new_tokens.get('error_description', new_tokens.get('error'))}")
+
+            expiries = compute_token_expiries(new_tokens, now)
+            account_update = {
+                'tokens': new_tokens,
+                'updatedAt': now.strftime('%Y-%m-%d %H:%M:%S'),
+                **expiries
+            }
+            stored_data = store_if_unrotated(self.db, account_ref, refresh_token,
+                                             lambda writer: writer.set(account_ref, account_update, merge=True))
+            if stored_data is not None:
+                # Another process refreshed first; its tokens are the ones TikTok still accepts
+                logging.info(f"Access token for user {user_id}, TikTok account {account_username} was refreshed elsewhere, using the stored one")
+                access_token = stored_data.get('tokens', {}).get('access_token')
+                expires_at = stored_data.get('access_expires_at')
+                if not access_token:
+                    raise TokenRefreshError(f"No access token stored for user {user_id}, TikTok account {account_username}")
+                self._cache_token(key, access_token, expires_at, now)
+                return access_token
+
+            self._cache_token(key, new_tokens['access_token'], expiries.get('access_expires_at'), now)
+            logging.info(f"Refreshed access token on demand for user {user_id}, TikTok account {account_username}")
+            return new_tokens['access_token']
+
+    def call_with_token(self, user_id, account_data, func):
+        """
+        Calls func(access_token). If TikTok rejects the token with a 401, the token
+        is refreshed and the call is retried once.
+        """
+        access_token = self.get_access_token(user_id, account_data)
+        try:
+            return func(access_token)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 401:
+                raise
+            logging.warning(f"Access token rejected for user {user_id}, account {account_data['username']}. Refreshing and retrying.")
+
+        access_token = self.refresh(user_id, account_data, stale_token=access_token)
+        return func(access_token)
@@ -1,7 +1,10 @@
 import os
 import logging
+from datetime import timedelta
 from dotenv import load_dotenv  # Import load_dotenv to load environment variables from .env file
 from utils.token_refresher import TokenRefresher
+from utils.firestore_accounting import start_run, stage_scope
+from utils.profiling import profiled
 
 # Load environment variables from .env file
 load_dotenv()
@@ -9,9 +12,21 @@ load_dotenv()
 # Initialize logging
 logging.basicConfig(level=logging.DEBUG)
 
+@profiled('token_refresher')
 def token_refresher_http(request):
-    refresher = TokenRefresher()
-    refresher.run()
+    max_workers = int(os.getenv('TOKEN_REFRESH_MAX_WORKERS', '10'))
+    horizon_hours = float(os.getenv('TOKEN_REFRESH_HORIZON_HOURS', '6'))
+    # Refreshes every account, not only the expiring ones. Not needed for the expiry
+    # backfill, which runs on its own until every account has the fields.
+    full_scan = os.getenv('TOKEN_REFRESH_FULL_SCAN', 'false').lower() == 'true'
+
+    refresher = TokenRefresher(max_workers=max_workers, refresh_horizon=timedelta(hours=horizon_hours))
+    accounting = start_run('token_refresher', refresher.db)
+    try:
+        with stage_scope('full_scan' if full_scan else 'refresh_accounts'):
+            refresher.run(full_scan=full_scan)
+    finally:
+        accounting.log_summary()
     return "Token refresh job completed successfully."
 
 if __name__ == '__main__':
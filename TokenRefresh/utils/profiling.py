@@ -0,0 +1,240 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+MODES = ('sampling', 'cprofile')
+# From 3.12, cProfile runs on sys.monitoring, where only one profiler can be active
+# per interpreter, so DeterministicProfiler can no longer keep one per thread
+PER_THREAD_CPROFILE = sys.version_info < (3, 12)
+
+def requested_mode(request):
+    """
+    The profiler to run for this invocation, or None. PROFILER=sampling|cprofile profiles
+    every invocation. With PROFILER_ALLOW_REQUEST_FLAG=true, a ?profile=sampling|cprofile
+    query parameter profiles one request (?profile=1 uses PROFILER's mode, or sampling).
+    The flag is ignored otherwise, since profiling slows every thread and writes files.
+    """
+    mode = os.getenv('PROFILER', '').lower()
+    args = getattr(request, 'args', None)
+    allow_flag = os.getenv('PROFILER_ALLOW_REQUEST_FLAG', 'false').lower() == 'true'
+    flag = args.get('profile', '').lower() if allow_flag and args is not None else ''
+    if flag in MODES:
+        return flag
+    if flag in ('1', 'true'):
+        return mode if mode in MODES else 'sampling'
+    return mode if mode in MODES else None
+
+def function_label(code):
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{code.co_name}:{code.co_firstlineno}"
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread (the jobs do their work on pools) every interval
+    seconds from a background thread. Overhead is low enough to leave on for a real run.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(function_label(frame.f_code))
+                frame = frame.f_back
+            # Pool threads share a root so their stacks merge in the flame graph
+            thread_name = names.get(thread_id, 'thread').rsplit('_', 1)[0]
+            self.stacks[';'.join([thread_name] + labels[::-1])] += 1
+        self.samples += 1
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """Stack counts in the collapsed format flamegraph.pl and speedscope read."""
+        return [f"{stack} {count}" for stack, count in self.stacks.most_common()]
+
+    def top_functions(self, top_n):
+        self_samples, total_samples = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')[1:]
+            if not frames:
+                continue
+            self_samples[frames[-1]] += count
+            # Recursive functions are counted once per stack
+            for label in set(frames):
+                total_samples[label] += count
+        return [
+            {'function': label, 'self_seconds': round(count * self.interval, 3), 'total_seconds': round(total_samples[label] * self.interval, 3)}
+            for label, count in self_samples.most_common(top_n)
+        ]
+
+class DeterministicProfiler:
+    """
+    cProfile on the calling thread and on every thread started while it runs, merged
+    into one set of stats. Exact call counts, at the cost of slowing the run down.
+    Threads that were already running (e.g. the workers of a pool kept across
+    invocations) are not profiled; a warning says how many. Python < 3.12 only.
+    """
+
+    def __init__(self, min_fraction=0.0005, max_depth=128):
+        self.min_fraction = min_fraction
+        self.max_depth = max_depth
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.main_profile = cProfile.Profile()
+
+    def start_thread_profile(self, *args):
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        # Replaces this bootstrap hook for the rest of the thread
+        profile.enable()
+
+    def start(self):
+        others = threading.active_count() - 1
+        if others:
+            logging.warning(f"cProfile won't see the threads that were already running ({others}); use the sampling profiler to include them")
+        threading.setprofile(self.start_thread_profile)
+        self.main_profile.enable()
+
+    def stop(self):
+        self.main_profile.disable()
+        threading.setprofile(None)
+
+    def stats(self):
+        stats = pstats.Stats(self.main_profile)
+        with self.lock:
+            for profile in self.profiles:
+                try:
+                    stats.add(profile)
+                except TypeError:
+                    # A thread that never returned to Python after starting has no stats
+                    continue
+        return stats
+
+    @staticmethod
+    def label(function):
+        filename, line, name = function
+        module = os.path.splitext(os.path.basename(filename))[0] if filename != '~' else 'builtins'
+        return f"{module}:{name}:{line}"
+
+    def collapsed(self, stats):
+        """
+        Approximate collapsed stacks built from the caller graph: each function's time is
+        split across the paths reaching it in proportion to the time of each call edge.
+        Paths worth less than min_fraction of the profiled time are dropped, which keeps
+        the number of paths manageable. Weights are microseconds.
+        """
+        callees = {}
+        for function, (_, _, _, _, callers) in stats.stats.items():
+            for caller, edge in callers.items():
+                callees.setdefault(caller, []).append((function, edge[3]))
+        roots = [function for function, entry in stats.stats.items() if not entry[4]]
+        min_seconds = sum(stats.stats[root][3] for root in roots) * self.min_fraction
+        lines = Counter()
+
+        def walk(function, path, seconds):
+            cumulative = stats.stats[function][3]
+            if cumulative <= 0 or seconds < min_seconds or len(path) >= self.max_depth:
+                return
+            share = seconds / cumulative
+            path = path + [self.label(function)]
+            lines[';'.join(path)] += int(stats.stats[function][2] * share * 1e6)
+            for callee, edge_seconds in callees.get(function, ()):
+                if self.label(callee) not in path:
+                    walk(callee, path, edge_seconds * share)
+
+        for root in roots:
+            walk(root, [], stats.stats[root][3])
+        return [f"{stack} {weight}" for stack, weight in lines.most_common() if weight > 0]
+
+    @staticmethod
+    def top_functions(stats, top_n):
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:top_n]
+        return [
+            {'function': DeterministicProfiler.label(function), 'calls': entry[1], 'self_seconds': round(entry[2], 4), 'total_seconds': round(entry[3], 4)}
+            for function, entry in rows
+        ]
+
+def write_lines(path, lines):
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+@contextmanager
+def profile_run(job, mode):
+    """
+    Profiles the block and writes <job>-<time>-<mode>.collapsed (flame graph input) and
+    <job>-<time>-<mode>.txt (top functions) to PROFILER_OUTPUT_DIR, plus the raw pstats
+    file (.prof) with cprofile. The top functions are also logged as one JSON line.
+    """
+    output_dir = os.getenv('PROFILER_OUTPUT_DIR', '/tmp/profiles')
+    top_n = int(os.getenv('PROFILER_TOP_N', '25'))
+    if mode == 'cprofile' and not PER_THREAD_CPROFILE:
+        logging.warning(f"cProfile can't profile each thread on Python {sys.version_info.major}.{sys.version_info.minor}, sampling instead")
+        mode = 'sampling'
+    profiler = DeterministicProfiler() if mode == 'cprofile' else SamplingProfiler(float(os.getenv('PROFILER_SAMPLE_INTERVAL_MS', '5')) / 1000)
+    started_at = time.perf_counter()
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        elapsed = time.perf_counter() - started_at
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            base_path = os.path.join(output_dir, f"{job}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-{mode}")
+            if mode == 'cprofile':
+                stats = profiler.stats()
+                stats.dump_stats(base_path + '.prof')
+                collapsed = profiler.collapsed(stats)
+                top = profiler.top_functions(stats, top_n)
+            else:
+                collapsed = profiler.collapsed()
+                top = profiler.top_functions(top_n)
+            write_lines(base_path + '.collapsed', collapsed)
+            write_lines(base_path + '.txt', [f"{entry['function']}  self={entry['self_seconds']}s  total={entry['total_seconds']}s" + (f"  calls={entry['calls']}" if 'calls' in entry else '') for entry in top])
+            logging.info(json.dumps({'event': 'profile', 'job': job, 'mode': mode, 'elapsed_seconds': round(elapsed, 3), 'output': base_path, 'top_functions': top}))
+        except Exception as e:
+            # A failed profile must never fail the job
+            logging.error(f"Failed to write {mode} profile for {job}: {e}")
+
+def profiled(job):
+    """Decorates an HTTP entry point so it runs under the profiler requested_mode() selects, if any."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(request):
+            mode = requested_mode(request)
+            if mode is None:
+                return handler(request)
+            with profile_run(job, mode):
+                return handler(request)
+        return wrapper
+    return decorator
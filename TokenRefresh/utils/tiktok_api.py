@@ -1,10 +1,12 @@
 import requests
+from requests.adapters import HTTPAdapter
 import logging
 from urllib.parse import urlencode
 import os
+from utils.tiktok_fixtures import configure_session
 
 class TikTokAPI:
-    def __init__(self):
+    def __init__(self, pool_size=10):
         self.client_key = os.getenv('TIKTOK_CLIENT_KEY')
         self.client_secret = os.getenv('TIKTOK_CLIENT_SECRET')
         
@@ -14,10 +16,19 @@ class TikTokAPI:
         logging.debug(f"TIKTOK_CLIENT_KEY: {self.client_key}")
         logging.debug(f"TIKTOK_CLIENT_SECRET: {self.client_secret}")
 
-        self.token_url = "https://open.tiktokapis.com/v2/oauth/token/"
-        self.user_info_url = "https://open.tiktokapis.com/v2/user/info/"
+        # Overridden to point at a local fake server for offline benchmarks
+        self.base_url = os.getenv('TIKTOK_API_BASE_URL', 'https://open.tiktokapis.com').rstrip('/')
+        self.token_url = f"{self.base_url}/v2/oauth/token/"
+        self.user_info_url = f"{self.base_url}/v2/user/info/"
         logging.debug(f"TikTokAPI initialized with token_url: {self.token_url}")
 
+        # One pooled session per client so concurrent refreshes reuse connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount(self.base_url, adapter)
+        # TIKTOK_API_MODE=record|replay captures responses to fixtures or serves them offline
+        configure_session(self.session, self.base_url)
+
     def refresh_access_token(self, refresh_token):
         data = {
             'client_key': self.client_key,
@@ -30,7 +41,7 @@ class TikTokAPI:
             'Cache-Control': 'no-cache'
         }
         logging.debug(f"Refreshing access token with refresh_token: {refresh_token}")
-        response = requests.post(self.token_url, data=urlencode(data), headers=headers)
+        response = self.session.post(self.token_url, data=urlencode(data), headers=headers)
         logging.debug(f"Response Status Code: {response.status_code}")
         logging.debug(f"Response Text: {response.text}")
         response.raise_for_status()
@@ -46,7 +57,7 @@ class TikTokAPI:
             'fields': 'display_name,avatar_url,follower_count'
         }
         logging.debug(f"Fetching user info with access token: {access_token}")
-        response = requests.get(self.user_info_url, headers=headers, params=params)
+        response = self.session.get(self.user_info_url, headers=headers, params=params)
         logging.debug(f"Response Status Code: {response.status_code}")
         logging.debug(f"Response Text: {response.text}")
         response.raise_for_status()
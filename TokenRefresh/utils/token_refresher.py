@@ -1,76 +1,287 @@
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials
 import requests
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from utils.tiktok_api import TikTokAPI
+from utils.circuit_breaker import AccountCircuitBreaker
+from utils.firestore_accounting import call_in_tenant
+from utils.storage import get_client, storage_backend
+from utils.token_provider import compute_token_expiries, store_if_unrotated
+
+# Attempts at storing an account's refreshed tokens, and the delay before the first retry
+STORE_ATTEMPTS = 5
+STORE_RETRY_DELAY = 1
+
+EXPIRY_FIELDS = ('access_expires_at', 'refresh_expires_at')
+
+# Records whether every account has its expiry fields, in Automation's checkpoint collection
+STATE_COLLECTION = 'jobCheckpoints'
+STATE_DOCUMENT = 'token_refresher'
+
+def has_expiry(account_data):
+    return any(account_data.get(field) is not None for field in EXPIRY_FIELDS)
+
+def as_naive_utc(value):
+    """Firestore returns timezone-aware datetimes; the cutoffs here are naive UTC."""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
 
 class TokenRefresher:
-    def __init__(self):
-        firebase_creds_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
-        if not firebase_creds_json:
-            raise ValueError("FIREBASE_CREDENTIALS_JSON environment variable not set or is empty.")
-        
-        cred = credentials.Certificate(firebase_creds_json)
-        firebase_admin.initialize_app(cred)
-        self.db = firestore.client()
+    def __init__(self, max_workers=10, refresh_horizon=timedelta(hours=6)):
+        # Warm instances reuse the app initialized by a previous invocation
+        if storage_backend() == 'firestore' and not firebase_admin._apps:
+            firebase_creds_json = os.getenv('FIREBASE_CREDENTIALS_JSON')
+            if not firebase_creds_json:
+                raise ValueError("FIREBASE_CREDENTIALS_JSON environment variable not set or is empty.")
+
+            cred = credentials.Certificate(firebase_creds_json)
+            firebase_admin.initialize_app(cred)
+        self.db = get_client()
+        self.max_workers = max_workers
+        # Tokens expiring within this window of the run are refreshed
+        self.refresh_horizon = refresh_horizon
+        # A single client shared by all workers, sized to the worker pool
+        self.tiktok_api = TikTokAPI(pool_size=max_workers)
+        self.circuit_breaker = AccountCircuitBreaker(self.db)
 
     def get_creator_user_ids(self):
         users_ref = self.db.collection('users')
         users_with_accounts = []
-        
+
         for user in users_ref.stream():
             # Query the Accounts subcollection directly under the 'TikTok' document
             accounts_ref = user.reference.collection('SocialMediaPlatforms').document('TikTok').collection('Accounts')
-            
+
             # Check if the Accounts subcollection contains any documents
             if accounts_ref.limit(1).get():
                 users_with_accounts.append(user.id)
-        
+
         return users_with_accounts
 
     def get_account_data(self, user_id):
         accounts_ref = self.db.collection('users').document(user_id).collection('SocialMediaPlatforms').document('TikTok').collection('Accounts')
         return [acc.to_dict() for acc in accounts_ref.stream()]
 
-    def store_tokens(self, user_id, account_username, tokens, user_info):
+    def get_expiring_accounts(self):
+        """
+        Yields (user_id, account_data) for TikTok accounts whose access or refresh
+        token expires within the refresh horizon. Uses the collection group indexes
+        on access_expires_at/refresh_expires_at (see firestore.indexes.json).
+        """
+        cutoff = datetime.utcnow() + self.refresh_horizon
+        seen = set()
+        for field in EXPIRY_FIELDS:
+            query = self.db.collection_group('Accounts').where(field, '<=', cutoff)
+            for acc in query.stream():
+                platform_ref = acc.reference.parent.parent
+                if platform_ref.id != 'TikTok' or acc.reference.path in seen:
+                    continue
+                seen.add(acc.reference.path)
+                yield platform_ref.parent.parent.id, acc.to_dict()
+
+    def get_all_accounts(self):
+        """Yields (user_id, account_data) for every linked TikTok account."""
+        for user_id in self.get_creator_user_ids():
+            for account_data in self.get_account_data(user_id):
+                yield user_id, account_data
+
+    def get_backfill_accounts(self):
+        """
+        Yields (user_id, account_data) for accounts linked before expiry fields were
+        stored, which the indexed queries can't find, and for accounts expiring within
+        the refresh horizon. Reads every account.
+        """
+        cutoff = datetime.utcnow() + self.refresh_horizon
+        for user_id, account_data in self.get_all_accounts():
+            expiries = [account_data[field] for field in EXPIRY_FIELDS if account_data.get(field) is not None]
+            if not expiries:
+                yield user_id, account_data
+            elif any(as_naive_utc(expiry) <= cutoff for expiry in expiries):
+                yield user_id, account_data
+
+    def get_state_ref(self):
+        return self.db.collection(STATE_COLLECTION).document(STATE_DOCUMENT)
+
+    def expiry_backfill_complete(self):
+        snapshot = self.get_state_ref().get()
+        return snapshot.exists and bool(snapshot.to_dict().get('expiry_backfill_complete'))
+
+    def store_sentinel_expiry(self, user_id, account_data):
+        """
+        Marks an account without expiry fields as expiring now, for accounts whose refresh
+        was skipped or failed, so the indexed queries pick it up from the next run on.
+        Returns whether it was stored.
+        """
+        try:
+            self.get_account_ref(user_id, account_data['username']).set({'access_expires_at': datetime.utcnow()}, merge=True)
+            return True
+        except Exception as e:
+            logging.error(f"Failed to store an expiry for user {user_id}, TikTok account {account_data.get('username')}: {e}")
+            return False
+
+    def backfill_account(self, user_id, account_data, skip=False):
+        """
+        Refreshes an account found without expiry fields, unless skip is set. Returns
+        whether it has expiry fields afterwards: its refreshed tokens', or a sentinel.
+        """
+        if not skip and self.refresh_token(user_id, account_data):
+            return True
+        return self.store_sentinel_expiry(user_id, account_data)
+
+    def get_account_ref(self, user_id, account_username):
+        return self.db.collection('users').document(user_id).collection('SocialMediaPlatforms').document('TikTok').collection('Accounts').document(account_username)
+
+    def build_account_data(self, account_username, tokens, user_info, issued_at=None):
+        issued_at = issued_at or datetime.utcnow()
         account_data = {
             'username': account_username,
-            'display_name': user_info.get('display_name'),  # Store `display_name`
-            'profileImage': user_info.get('profile_image'),  # Store profile image
-            'follower_count': user_info.get('follower_count'),  # Store follower count
             'tokens': tokens,
-            'updatedAt': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            'updatedAt': issued_at.strftime('%Y-%m-%d %H:%M:%S')
         }
-        doc_ref = self.db.collection('users').document(user_id).collection('SocialMediaPlatforms').document('TikTok').collection('Accounts').document(account_username)
+        # Without user info (its request failed), the stored profile fields are left as they are
+        if user_info is not None:
+            account_data.update({
+                'display_name': user_info.get('display_name'),  # Store `display_name`
+                'profileImage': user_info.get('profile_image'),  # Store profile image
+                'follower_count': user_info.get('follower_count'),  # Store follower count
+            })
+        # Absolute expiries drive which accounts the next run selects
+        account_data.update(compute_token_expiries(tokens, issued_at))
+        return account_data
+
+    def store_tokens(self, user_id, account_username, tokens, user_info, batch=None, issued_at=None):
+        account_data = self.build_account_data(account_username, tokens, user_info, issued_at)
+        doc_ref = self.get_account_ref(user_id, account_username)
+        if batch is not None:
+            batch.set(doc_ref, account_data, merge=True)
+            return
         doc_ref.set(account_data, merge=True)
         logging.info(f'Successfully stored data for user {user_id}, account {account_username}')
 
+    def store_refreshed_tokens(self, user_id, account_data, tokens, user_info, issued_at):
+        """
+        Stores the tokens of a refresh as soon as it returns. TikTok rotates the refresh
+        token, so the stored one stopped working when this one was issued: losing this
+        write means the account has to be linked again. The write is retried with
+        backoff, and a final failure is logged as critical. Returns whether it was stored.
+
+        The tokens are only stored if the account still holds the refresh token that
+        was used: otherwise an on-demand refresh elsewhere rotated it meanwhile, and
+        its tokens are the ones TikTok still accepts.
+        """
+        account_username = account_data['username']
+        account_ref = self.get_account_ref(user_id, account_username)
+
+        def write(batch):
+            # One document, written together with its circuit breaker reset
+            self.store_tokens(user_id, account_username, tokens, user_info, batch=batch, issued_at=issued_at)
+            self.circuit_breaker.record_success(user_id, account_data, batch=batch)
+
+        for attempt in range(1, STORE_ATTEMPTS + 1):
+            try:
+                rotated_data = store_if_unrotated(self.db, account_ref, account_data['tokens'].get('refresh_token'), write)
+                if rotated_data is not None:
+                    logging.info(f'Tokens for user {user_id}, account {account_username} were refreshed elsewhere meanwhile, keeping those')
+                else:
+                    logging.info(f'Successfully stored data for user {user_id}, account {account_username}')
+                return True
+            except Exception as e:
+                if attempt == STORE_ATTEMPTS:
+                    logging.critical(f"Failed to store the refreshed tokens for user {user_id}, TikTok account {account_username} after {attempt} attempts. "
+                                     f"Its previous refresh token is no longer valid, so the account must be linked again: {e}")
+                    return False
+                logging.warning(f"Failed to store the refreshed tokens for user {user_id}, TikTok account {account_username} (attempt {attempt}), retrying: {e}")
+                time.sleep(STORE_RETRY_DELAY * 2 ** (attempt - 1))
+
     def refresh_token(self, user_id, account_data):
+        """Fetches new tokens and account info, and stores them before returning. Returns whether they were stored."""
         refresh_token = account_data['tokens'].get('refresh_token')
         if refresh_token:
             try:
-                tiktok_api = TikTokAPI()
-                new_tokens = tiktok_api.refresh_access_token(refresh_token)
-                
+                issued_at = datetime.utcnow()
+                new_tokens = self.tiktok_api.refresh_access_token(refresh_token)
+
                 if 'error' in new_tokens:
                     logging.error(f"Failed to refresh token for user {user_id}, TikTok account {account_data['username']}: {new_tokens['error_description']}")
+                    self.circuit_breaker.record_failure(user_id, account_data, new_tokens['error_description'], error_class='auth')
                 else:
-                    user_info = tiktok_api.get_user_info(new_tokens['access_token'])
-                    self.store_tokens(user_id, account_data['username'], new_tokens, user_info)
-                    logging.info(f"Successfully refreshed token and account info for user {user_id}, TikTok account {account_data['username']}")
-                    
+                    try:
+                        user_info = self.tiktok_api.get_user_info(new_tokens['access_token'])
+                    except Exception as e:
+                        # The new tokens are stored regardless; the old refresh token is already spent
+                        logging.error(f"Failed to fetch account info for user {user_id}, TikTok account {account_data['username']}: {e}")
+                        user_info = None
+                    logging.info(f"Successfully refreshed token for user {user_id}, TikTok account {account_data['username']}")
+                    return self.store_refreshed_tokens(user_id, account_data, new_tokens, user_info, issued_at)
+
             except requests.exceptions.HTTPError as http_err:
                 logging.error(f"HTTP error occurred: {http_err.response.text}")
-                if http_err.response.status_code == 401: 
+                if http_err.response.status_code == 401:
                     logging.warning(f"Refresh token is invalid or expired for user {user_id}, TikTok account {account_data['username']}. Re-authentication required.")
+                self.circuit_breaker.record_failure(user_id, account_data, http_err)
             except Exception as e:
                 logging.error(f"Error refreshing token for user {user_id}, TikTok account {account_data['username']}: {e}")
+                self.circuit_breaker.record_failure(user_id, account_data, e)
         else:
             logging.warning(f"No refresh token found for user {user_id}, TikTok account {account_data['username']}")
+        return False
 
-    def run(self):
-        for user_id in self.get_creator_user_ids():
-            for account_data in self.get_account_data(user_id):
-                self.refresh_token(user_id, account_data)
+    def run(self, full_scan=False):
+        """
+        Refreshes tokens that expire within the refresh horizon. Until every account has
+        expiry fields, each run scans all accounts and also refreshes those without them,
+        which stores their expiries. Accounts whose refresh is skipped or fails get a
+        sentinel expiry instead, so the indexed queries retry them. Once no account is
+        left without, only the indexed queries run. A full scan refreshes every account.
+        """
+        backfill = not full_scan and not self.expiry_backfill_complete()
+        if full_scan:
+            accounts = self.get_all_accounts()
+        elif backfill:
+            accounts = self.get_backfill_accounts()
+        else:
+            accounts = self.get_expiring_accounts()
+
+        # Each worker stores its account's tokens as soon as they are refreshed
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = []
+            # Futures of accounts without expiry fields, which return whether they have them now
+            backfills = set()
+            for user_id, account_data in accounts:
+                skip = self.circuit_breaker.is_open(account_data)
+                if skip:
+                    logging.info(f"Skipping user {user_id}, TikTok account {account_data.get('username')}: circuit breaker open")
+                if backfill and not has_expiry(account_data):
+                    future = executor.submit(call_in_tenant, user_id, self.backfill_account, user_id, account_data, skip)
+                    backfills.add(future)
+                elif skip:
+                    continue
+                else:
+                    future = executor.submit(call_in_tenant, user_id, self.refresh_token, user_id, account_data)
+                futures.append(future)
+            logging.info(f"Refreshing tokens for {len(futures)} accounts (full_scan={full_scan}, backfill={backfill})")
+
+            unscheduled_accounts = 0
+            for future in as_completed(futures):
+                try:
+                    scheduled = future.result()
+                except Exception as e:
+                    logging.error(f"An error occurred while refreshing an account: {e}")
+                    scheduled = False
+                if future in backfills and not scheduled:
+                    unscheduled_accounts += 1
+
+        if backfill:
+            if unscheduled_accounts:
+                logging.warning(f"{unscheduled_accounts} accounts are still without expiry fields; the next run scans every account again")
+            else:
+                # Linking, refreshing and failed backfills all store the fields, so no account can lose them again
+                self.get_state_ref().set({'expiry_backfill_complete': True, 'completed_at': datetime.utcnow()}, merge=True)
+                logging.info("Every account has expiry fields; later runs only query the expiring ones")
+
+        logging.info("Token refresh completed for all accounts.")
@@ -1,6 +1,9 @@
-import os
+import argparse
 import json
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 import firebase_admin
 from firebase_admin import credentials, firestore
 
@@ -36,69 +39,205 @@ def get_creator_ids_by_emails(db, emails):
         print(f"Error retrieving creator IDs: {e}")
     return creator_ids
 
-def process_creator_videos(db, creator_id):
-    print(f"Processing creator: {creator_id}")
-    try:
-        platforms_ref = db.collection('users').document(creator_id).collection('SocialMediaPlatforms')
-        platforms = platforms_ref.get()
-        if not platforms:
-            print(f"No platforms found for creator: {creator_id}")
-            return
+def get_user_video_refs(db, user_id):
+    """Returns the video references of every account the user has linked, on any platform."""
+    video_refs = []
+    for platform in db.collection('users').document(user_id).collection('SocialMediaPlatforms').select([]).stream():
+        for account in platform.reference.collection('Accounts').select([]).stream():
+            video_refs.extend(video.reference for video in account.reference.collection('Videos').select([]).stream())
+    return video_refs
 
-        for platform in platforms:
-            print(f"  Processing platform: {platform.id}")
-            accounts_ref = platform.reference.collection('Accounts')
-            accounts = accounts_ref.get()
-            if not accounts:
-                print(f"  No accounts found for platform: {platform.id}")
-                continue
+def get_organization_video_refs(db, org_id):
+    """Returns the original video references of every video in the organization's content plans."""
+    video_refs = {}
+    for plan in db.collection('organizations').document(org_id).collection('contentPlans').select([]).stream():
+        for video in plan.reference.collection('videos').select(['originalVideoRef']).stream():
+            original_video_ref = video.to_dict().get('originalVideoRef')
+            if original_video_ref:
+                video_refs[original_video_ref.path] = original_video_ref
+    return list(video_refs.values())
+
+# Format of the timestamps older Metrics entries store as strings
+LEGACY_TIMESTAMP_FORMAT = '%Y%m%d-%H%M'
+# Start of the range when pruning every entry
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def partition_time_range(start, end, partitions):
+    """Splits [start, end) into equal, contiguous timestamp ranges."""
+    if partitions < 1:
+        raise ValueError(f"partitions must be at least 1, got {partitions}")
+    step = (end - start) / partitions
+    bounds = [start + step * i for i in range(partitions)] + [end]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+class MetricsPruner:
+    """
+    Deletes Metrics entries whose timestamp is not on one of keep_minutes, except
+    those taken within keep_fresh of the video's upload: the scraper polls videos
+    that young every 15 to 30 minutes (see Automation/utils/poll_schedule.py), and
+    that resolution is kept.
+
+    The timestamp range is split into partitions that are scanned in parallel, either
+    across every Metrics collection (collection group query) or across the Metrics of
+    a given set of videos. Deletes go through a BulkWriter, which batches them and
+    ramps up to Firestore's write limits.
 
-            for account in accounts:
-                print(f"    Processing account: {account.id}")
-                videos_ref = account.reference.collection('Videos')
-                videos = videos_ref.get()
-                if not videos:
-                    print(f"    No videos found for account: {account.id}")
+    Range filters only match values of their own type, so older entries that store
+    their timestamp as a LEGACY_TIMESTAMP_FORMAT string are scanned by a separate
+    string range query. Those sort chronologically as written.
+    """
+
+    def __init__(self, db, keep_minutes=(0,), keep_fresh=timedelta(hours=24), workers=8, dry_run=False):
+        self.db = db
+        self.keep_minutes = set(keep_minutes)
+        self.keep_fresh = keep_fresh
+        # video path -> end of its fresh window (None when its upload time is unknown)
+        self.fresh_until = {}
+        self.workers = workers
+        self.dry_run = dry_run
+        self.bulk_writer = db.bulk_writer()
+        self.lock = threading.Lock()
+        self.scanned = 0
+        self.deleted = 0
+
+    def prune_query(self, query, start, end):
+        """Prunes the entries with a timestamp in [start, end)."""
+        return self.prune(query.where('timestamp', '>=', start).where('timestamp', '<', end))
+
+    def prune_legacy_query(self, query, start, end):
+        """Prunes the entries with a string timestamp in [start, end)."""
+        return self.prune(query.where('timestamp', '>=', start.strftime(LEGACY_TIMESTAMP_FORMAT))
+                               .where('timestamp', '<', end.strftime(LEGACY_TIMESTAMP_FORMAT)))
+
+    def video_fresh_until(self, video_ref):
+        """When video_ref stopped being polled more often than hourly; read once per video."""
+        if video_ref.path not in self.fresh_until:
+            snapshot = video_ref.get()
+            create_time = snapshot.to_dict().get('create_time') if snapshot.exists else None
+            fresh_until = None
+            if isinstance(create_time, (int, float)):
+                fresh_until = datetime.fromtimestamp(create_time, timezone.utc) + self.keep_fresh
+            # Partition workers may both read it; either result is the same
+            self.fresh_until[video_ref.path] = fresh_until
+        return self.fresh_until[video_ref.path]
+
+    def prune(self, partition_query):
+        scanned = deleted = 0
+        for metric in partition_query.stream():
+            scanned += 1
+            timestamp = metric.to_dict().get('timestamp')
+            # String timestamps predate scheduled polls
+            scheduled = not isinstance(timestamp, str)
+            if isinstance(timestamp, str):
+                try:
+                    timestamp = datetime.strptime(timestamp, LEGACY_TIMESTAMP_FORMAT)
+                except ValueError:
+                    print(f"        Could not parse timestamp {timestamp} ({metric.reference.path})")
                     continue
+            if not isinstance(timestamp, datetime):
+                print(f"        Unexpected type for timestamp: {timestamp} ({metric.reference.path})")
+                continue
+            if timestamp.minute in self.keep_minutes:
+                continue
+            if scheduled and self.keep_fresh:
+                fresh_until = self.video_fresh_until(metric.reference.parent.parent)
+                if fresh_until is not None and timestamp < fresh_until:
+                    continue
+            deleted += 1
+            if not self.dry_run:
+                # BulkWriter is shared by every partition worker
+                with self.lock:
+                    self.bulk_writer.delete(metric.reference)
 
-                for video in videos:
-                    print(f"      Processing video: {video.id}")
-                    metrics_ref = video.reference.collection('Metrics')
-                    metrics = metrics_ref.get()
-                    if not metrics:
-                        print(f"      No metrics found for video: {video.id}")
-                        continue
-
-                    for metric in metrics:
-                        metric_data = metric.to_dict()
-                        timestamp = metric_data.get('timestamp')
-
-                        if isinstance(timestamp, datetime):
-                            timestamp_str = timestamp.strftime('%Y%m%d-%H%M')
-                        else:
-                            timestamp_str = timestamp
-
-                        try:
-                            # Parse the timestamp string
-                            timestamp = datetime.strptime(timestamp_str, '%Y%m%d-%H%M')
-
-                            # Keep only entries that are on the hour
-                            if timestamp.minute == 0:
-                                print(f"        Keeping metric with timestamp {timestamp_str} (on the hour)")
-                            else:
-                                print(f"        Deleting metric with timestamp {timestamp_str} (not on the hour)")
-                                metric.reference.delete()
-                        except ValueError:
-                            print(f"        Could not parse timestamp {timestamp_str} for metric {metric.id} in video {video.id}")
-                        except TypeError:
-                            print(f"        Unexpected type for timestamp: {timestamp}")
+        with self.lock:
+            self.scanned += scanned
+            self.deleted += deleted
+        return scanned, deleted
 
-    except Exception as e:
-        print(f"Error processing creator {creator_id}: {e}")
+    def earliest_timestamp(self, query):
+        """The earliest timestamp (not counting string ones) query matches, or None."""
+        first = query.where('timestamp', '>=', EPOCH).order_by('timestamp').limit(1).get()
+        return first[0].to_dict()['timestamp'] if first else None
+
+    def run(self, start, end, partitions, video_refs=None):
+        """
+        Prunes [start, end), or every entry up to end when start is None. Without
+        video_refs every Metrics collection is scanned, which needs the collection group
+        index on Metrics.timestamp; otherwise only the Metrics of those videos.
+        """
+        if video_refs is None:
+            queries = [self.db.collection_group('Metrics')]
+        else:
+            queries = [video_ref.collection('Metrics') for video_ref in video_refs]
+        # A single video's Metrics are small, so scoped runs parallelize across videos instead
+        partitions = partitions if video_refs is None else 1
+        legacy_start = start or EPOCH
+        if start is None:
+            # Partitions only split the range that holds entries
+            start = (self.earliest_timestamp(queries[0]) if partitions > 1 else None) or EPOCH
+        ranges = partition_time_range(min(start, end), end, partitions)
+        print(f"Pruning {len(queries)} Metrics queries over {len(ranges)} partitions from {start} to {end} (dry_run={self.dry_run})")
+
+        started_at = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(self.prune_query, query, range_start, range_end): (range_start, range_end)
+                for query in queries
+                for range_start, range_end in ranges
+            }
+            for query in queries:
+                futures[executor.submit(self.prune_legacy_query, query, legacy_start, end)] = ('legacy', 'string timestamps')
+            for future in as_completed(futures):
+                range_start, range_end = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error pruning partition {range_start} - {range_end}: {e}")
+
+        self.bulk_writer.close()
+        elapsed = time.monotonic() - started_at
+
+        summary = {
+            'scanned': self.scanned,
+            'deleted': self.deleted,
+            'elapsed_seconds': round(elapsed, 2),
+            'scanned_per_second': round(self.scanned / elapsed, 1) if elapsed else None,
+            'deleted_per_second': round(self.deleted / elapsed, 1) if elapsed else None,
+            'partitions': len(ranges),
+            'queries': len(queries),
+            'dry_run': self.dry_run
+        }
+        print(f"Throughput summary: {json.dumps(summary)}")
+        return summary
+
+def parse_datetime(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 def main():
+    parser = argparse.ArgumentParser(description="Deletes Metrics entries that are not on the hour, except those of a video's first day.")
+    scope = parser.add_mutually_exclusive_group(required=True)
+    scope.add_argument('--all', action='store_true', help="Prune every Metrics collection")
+    scope.add_argument('--user', action='append', help="Prune the videos of this user ID (repeatable)")
+    scope.add_argument('--email', action='append', help="Prune the videos of the user with this email (repeatable)")
+    scope.add_argument('--org', help="Prune the videos in this organization's content plans")
+    parser.add_argument('--days', type=float, help="Prune entries from this many days back (default: every entry)")
+    parser.add_argument('--since', type=parse_datetime, help="Start of the range (UTC ISO date), overrides --days")
+    parser.add_argument('--until', type=parse_datetime, help="End of the range (UTC ISO date, default now)")
+    parser.add_argument('--partitions', type=positive_int, default=24, help="Timestamp partitions to split the range into")
+    parser.add_argument('--workers', type=positive_int, default=8, help="Partitions scanned in parallel")
+    parser.add_argument('--keep-minutes', type=int, nargs='+', default=[0], help="Minutes past the hour to keep (default 0)")
+    parser.add_argument('--keep-fresh-hours', type=float, default=24, help="Keep every entry taken this many hours after the video's upload, "
+                                                                           "when it is polled more often than hourly (default 24, 0 to prune those too)")
+    parser.add_argument('--dry-run', action='store_true', help="Count what would be deleted without deleting it")
+    args = parser.parse_args()
+
     print("Script started")
-    print("Starting timestamp conversion process...")
 
     firebase_creds = load_firebase_credentials()
     if firebase_creds is None:
@@ -108,19 +247,22 @@ def main():
     if db is None:
         return
 
-    # List of emails to process
-    emails = [
-        'creator@gmail.com',
-        'jsphellis.2020@gmail.com'
-    ]
+    video_refs = None
+    if args.user or args.email:
+        user_ids = list(args.user or []) + get_creator_ids_by_emails(db, args.email or [])
+        if not user_ids:
+            print("No creators found for the provided emails.")
+            return
+        video_refs = [video_ref for user_id in user_ids for video_ref in get_user_video_refs(db, user_id)]
+    elif args.org:
+        video_refs = get_organization_video_refs(db, args.org)
 
-    creator_ids = get_creator_ids_by_emails(db, emails)
-    if not creator_ids:
-        print("No creators found for the provided emails.")
-        return
+    end = args.until or datetime.now(timezone.utc)
+    start = args.since or (end - timedelta(days=args.days) if args.days is not None else None)
 
-    for creator_id in creator_ids:
-        process_creator_videos(db, creator_id)
+    pruner = MetricsPruner(db, keep_minutes=args.keep_minutes, keep_fresh=timedelta(hours=args.keep_fresh_hours),
+                           workers=args.workers, dry_run=args.dry_run)
+    pruner.run(start, end, args.partitions, video_refs)
 
     print("Script finished")
 
@@ -1,97 +1,172 @@
+import argparse
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+import numpy as np
 import firebase_admin
 from firebase_admin import credentials, firestore
-from google.cloud.firestore_v1 import SERVER_TIMESTAMP
-import pytz
-
-# Initialize Firebase Admin SDK
-cred = credentials.Certificate("firebase_credentials.json")
-firebase_admin.initialize_app(cred)
-
-# Initialize Firestore client
-db = firestore.client()
 
 logging.basicConfig(level=logging.INFO)
 
-class MetricsFixer:
-    def __init__(self):
-        self.db = firestore.client()
-        self.eastern = pytz.timezone('America/New_York')
+# Firestore rejects batches with more than 500 writes
+MAX_BATCH_SIZE = 500
 
-    def fix_metrics_for_collection(self, collection_ref):
-        """Fix the metrics for a given collection, removing invalid entries and adjusting new_view_count."""
-        entries = collection_ref.order_by('timestamp').stream()
-        previous_entry_data = None
+def initialize_firestore(credentials_path="firebase_credentials.json"):
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(credentials_path)
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
 
-        for entry in entries:
-            entry_data = entry.to_dict()
-            timestamp = entry_data['timestamp']
-
-            # Convert timestamp if it's a DatetimeWithNanoseconds object
-            if hasattr(timestamp, 'to_pydatetime'):
-                timestamp = timestamp.to_pydatetime()
-            elif isinstance(timestamp, datetime):
-                pass  # It's already a datetime object
-            else:
-                logging.error(f"Unknown timestamp type: {type(timestamp)}")
-                continue
+def to_datetime(timestamp):
+    # DatetimeWithNanoseconds is a datetime subclass; anything else can't be placed on the grid
+    if hasattr(timestamp, 'to_pydatetime'):
+        return timestamp.to_pydatetime()
+    if isinstance(timestamp, datetime):
+        return timestamp
+    return None
 
-            # Delete entries not on minute 0 or 30
-            if timestamp.minute not in [0, 30]:
-                logging.info(f"Deleting entry with timestamp: {timestamp}")
-                entry.reference.delete()
+class MetricsFixer:
+    def __init__(self, db, max_workers=10, dry_run=False, batch_size=MAX_BATCH_SIZE):
+        self.db = db
+        self.max_workers = max_workers
+        self.dry_run = dry_run
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+
+    def compute_fixes(self, entries):
+        """
+        Works out the fixes for a timestamp-ordered series in one pass: entries not on
+        minute 0 or 30 are deleted, and every remaining entry after the first gets
+        new_view_count = max(0, view_count - previous view_count).
+        Returns (entries to delete, [(entry, old new_view_count, new new_view_count)] to update).
+        """
+        valid_entries = []
+        minutes = []
+        for entry in entries:
+            timestamp = to_datetime(entry.to_dict().get('timestamp'))
+            if timestamp is None:
+                logging.error(f"Unknown timestamp type for entry {entry.reference.path}")
                 continue
+            valid_entries.append(entry)
+            minutes.append(timestamp.minute)
+
+        if not valid_entries:
+            return [], []
+
+        on_grid = np.isin(np.array(minutes), (0, 30))
+        deletions = [entry for entry, keep in zip(valid_entries, on_grid) if not keep]
+        kept_entries = [entry for entry, keep in zip(valid_entries, on_grid) if keep]
+        if not kept_entries:
+            return deletions, []
+
+        kept_data = [entry.to_dict() for entry in kept_entries]
+        # Counts can be stored as null, which numpy can't hold in an int64 array
+        view_counts = np.array([data.get('view_count') or 0 for data in kept_data], dtype=np.int64)
+        # -1 marks a missing new_view_count so it is always written
+        current = np.array([-1 if data.get('new_view_count') is None else data['new_view_count'] for data in kept_data], dtype=np.int64)
+
+        corrected = current.copy()
+        corrected[1:] = np.maximum(0, np.diff(view_counts))
+
+        changed = np.nonzero(corrected != current)[0]
+        # The first entry has no predecessor, so it is never changed
+        updates = [(kept_entries[i], int(current[i]), int(corrected[i])) for i in changed if i > 0]
+        return deletions, updates
+
+    def commit_fixes(self, deletions, updates):
+        batch = self.db.batch()
+        pending = 0
+        for entry in deletions:
+            batch.delete(entry.reference)
+            pending += 1
+            if pending >= self.batch_size:
+                batch.commit()
+                batch, pending = self.db.batch(), 0
+        for entry, _, new_view_count in updates:
+            batch.update(entry.reference, {'new_view_count': new_view_count})
+            pending += 1
+            if pending >= self.batch_size:
+                batch.commit()
+                batch, pending = self.db.batch(), 0
+        if pending:
+            batch.commit()
 
-            # Adjust new_view_count based on the previous entry
-            if previous_entry_data:
-                # Calculate the new_view_count based on the difference from the previous entry's view_count
-                entry_data['new_view_count'] = max(
-                    0, entry_data.get('view_count', 0) - previous_entry_data.get('view_count', 0)
-                )
-                logging.info(f"Adjusted new_view_count for entry at {timestamp}: {entry_data['new_view_count']}")
-
-            # Update the entry with the corrected new_view_count and timestamp
-            entry.reference.set(entry_data, merge=True)
-            previous_entry_data = entry_data
+    def fix_metrics_for_collection(self, collection_ref):
+        """Fix the metrics for a given collection, removing invalid entries and adjusting new_view_count."""
+        entries = list(collection_ref.order_by('timestamp').stream())
+        deletions, updates = self.compute_fixes(entries)
+
+        if not self.dry_run:
+            self.commit_fixes(deletions, updates)
+
+        return {
+            'collection': f"{collection_ref.parent.path}/{collection_ref.id}",
+            'entries': len(entries),
+            'deleted': [entry.id for entry in deletions],
+            'updated': [
+                {'id': entry.id, 'old_new_view_count': None if old < 0 else old, 'new_view_count': new}
+                for entry, old, new in updates
+            ]
+        }
 
     def process_organization_metrics(self, org_id):
         """Process and fix metrics for the organization-level collection."""
         logging.info(f"Processing organization metrics for {org_id}")
         org_metrics_ref = self.db.collection('organizations').document(org_id).collection('metrics').document('hourly').collection('data')
-        self.fix_metrics_for_collection(org_metrics_ref)
+        return self.fix_metrics_for_collection(org_metrics_ref)
 
     def process_content_plan_metrics(self, org_id, plan_id):
         """Process and fix metrics for the content plan-level collection."""
         logging.info(f"Processing content plan {plan_id} in organization {org_id}")
         content_plan_metrics_ref = self.db.collection('organizations').document(org_id).collection('contentPlans').document(plan_id).collection('metrics').document('hourly').collection('data')
-        self.fix_metrics_for_collection(content_plan_metrics_ref)
+        return self.fix_metrics_for_collection(content_plan_metrics_ref)
 
     def run(self):
-        """Process all organizations and content plans to fix their metrics."""
-        logging.info("Starting metrics processing...")
-
-        orgs_ref = self.db.collection('organizations').stream()
-
-        for org in orgs_ref:
-            org_id = org.id
-            # Process organization metrics
-            try:
-                self.process_organization_metrics(org_id)
-            except Exception as e:
-                logging.error(f"An error occurred while processing metrics for organization {org_id}: {e}")
-
-            # Process content plan metrics
-            content_plans_ref = self.db.collection('organizations').document(org_id).collection('contentPlans').stream()
-            for plan in content_plans_ref:
-                plan_id = plan.id
+        """Process all organizations and content plans in parallel and return the per-collection report."""
+        logging.info(f"Starting metrics processing (dry_run={self.dry_run})...")
+        reports = []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for org in self.db.collection('organizations').stream():
+                futures[executor.submit(self.process_organization_metrics, org.id)] = f"organization {org.id}"
+
+                content_plans_ref = self.db.collection('organizations').document(org.id).collection('contentPlans')
+                # Only the plan IDs are needed
+                for plan in content_plans_ref.select([]).stream():
+                    futures[executor.submit(self.process_content_plan_metrics, org.id, plan.id)] = f"content plan {plan.id} in organization {org.id}"
+
+            for future in as_completed(futures):
                 try:
-                    self.process_content_plan_metrics(org_id, plan_id)
+                    reports.append(future.result())
                 except Exception as e:
-                    logging.error(f"An error occurred while processing metrics for content plan {plan_id} in organization {org_id}: {e}")
+                    logging.error(f"An error occurred while processing metrics for {futures[future]}: {e}")
 
+        deleted = sum(len(report['deleted']) for report in reports)
+        updated = sum(len(report['updated']) for report in reports)
+        logging.info(f"{'Dry run: ' if self.dry_run else ''}{deleted} entries deleted and {updated} entries updated across {len(reports)} collections.")
         logging.info("Metrics processing completed for all content plans and organizations.")
+        return reports
+
+def main():
+    parser = argparse.ArgumentParser(description="Deletes off-grid hourly metric entries and recomputes new_view_count.")
+    parser.add_argument('--credentials', default="firebase_credentials.json")
+    parser.add_argument('--workers', type=int, default=10, help="Collections fixed in parallel")
+    parser.add_argument('--dry-run', action='store_true', help="Report the changes without writing them")
+    parser.add_argument('--report', help="Write the per-collection diff report to this JSON file")
+    args = parser.parse_args()
+
+    fixer = MetricsFixer(initialize_firestore(args.credentials), max_workers=args.workers, dry_run=args.dry_run)
+    reports = fixer.run()
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(sorted(reports, key=lambda report: report['collection']), f, indent=2)
+        logging.info(f"Wrote diff report to {args.report}")
+    elif args.dry_run:
+        for report in reports:
+            if report['deleted'] or report['updated']:
+                logging.info(f"{report['collection']}: delete {report['deleted']}, update {report['updated']}")
 
 if __name__ == "__main__":
-    fixer = MetricsFixer()
-    fixer.run()
+    main()
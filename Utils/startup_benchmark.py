@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (function directory, HTTP entry point)
+FUNCTIONS = [
+    ('Automation', 'metrics_scraper_http'),
+    ('Refresh', 'video_refresh_http'),
+    ('TokenRefresh', 'token_refresher_http'),
+    ('ContentPlanHistory', 'historical_content_plan_http'),
+    ('DocumentFiller', 'document_filler_http'),
+]
+
+# Runs inside a fresh interpreter so every measurement is a real cold start
+CHILD_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+function_dir, entry_point, invoke = sys.argv[1], sys.argv[2], sys.argv[3] == '1'
+sys.path.insert(0, function_dir)
+
+class BenchmarkRequest:
+    def __init__(self, method, payload=None):
+        self.method = method
+        self.args = {}
+        self._payload = payload
+
+    def get_json(self, silent=False):
+        return self._payload
+
+result = {'import_seconds': None, 'first_request_seconds': None, 'error': None}
+try:
+    import main
+    result['import_seconds'] = time.perf_counter() - started
+
+    if invoke:
+        getattr(main, entry_point)(BenchmarkRequest('POST', json.loads(sys.argv[4])))
+    elif entry_point == 'video_refresh_http':
+        # A CORS preflight is the cheapest real request the endpoint serves
+        getattr(main, entry_point)(BenchmarkRequest('OPTIONS'))
+    elif hasattr(main, 'get_db'):
+        # Scheduled jobs are ready for work once Firestore is initialized
+        main.get_db()
+    result['first_request_seconds'] = time.perf_counter() - started
+except Exception as e:
+    result['error'] = f"{type(e).__name__}: {e}"
+
+print('BENCHMARK_RESULT ' + json.dumps(result))
+'''
+
+def measure(function_dir, entry_point, invoke, payload):
+    command = [sys.executable, '-c', CHILD_SCRIPT, function_dir, entry_point, '1' if invoke else '0', json.dumps(payload)]
+    completed = subprocess.run(command, cwd=function_dir, capture_output=True, text=True)
+    for line in completed.stdout.splitlines():
+        if line.startswith('BENCHMARK_RESULT '):
+            return json.loads(line[len('BENCHMARK_RESULT '):])
+    return {'import_seconds': None, 'first_request_seconds': None, 'error': completed.stderr.strip().splitlines()[-1:] or 'no result'}
+
+def format_seconds(value):
+    return '-' if value is None else f"{value * 1000:.0f} ms"
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures cold start import time and time-to-first-request for each Cloud Function.")
+    parser.add_argument('--runs', type=int, default=3, help="Cold starts to measure per function (the median is reported)")
+    parser.add_argument('--functions', nargs='*', help="Only benchmark these function directories")
+    parser.add_argument('--invoke', action='store_true', help="Run the real entry point as the first request (runs the job!)")
+    parser.add_argument('--payload', default='{}', help="JSON body passed to the entry point with --invoke")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args()
+
+    payload = json.loads(args.payload)
+    results = []
+    for function_name, entry_point in FUNCTIONS:
+        if args.functions and function_name not in args.functions:
+            continue
+        function_dir = os.path.join(REPO_ROOT, function_name)
+        runs = [measure(function_dir, entry_point, args.invoke, payload) for _ in range(args.runs)]
+
+        def median(key):
+            values = sorted(run[key] for run in runs if run[key] is not None)
+            return values[len(values) // 2] if values else None
+
+        results.append({
+            'function': function_name,
+            'entry_point': entry_point,
+            'import_seconds': median('import_seconds'),
+            'first_request_seconds': median('first_request_seconds'),
+            'errors': sorted({str(run['error']) for run in runs if run['error']}),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'function':<20} {'import':>10} {'first request':>15}")
+    for result in results:
+        print(f"{result['function']:<20} {format_seconds(result['import_seconds']):>10} {format_seconds(result['first_request_seconds']):>15}")
+        for error in result['errors']:
+            print(f"    error: {error}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each function is deployed from its own directory, so modules they share are copied into
+# every utils package that needs them. Automation/utils holds the copy that is edited;
+# the others are synced from it.
+SOURCE_FUNCTION = 'Automation'
+
+# module -> functions that carry a copy of it
+SHARED_MODULES = {
+    'firestore_accounting.py': ['ContentPlanHistory', 'DocumentFiller', 'Refresh', 'TokenRefresh'],
+    'profiling.py': ['ContentPlanHistory', 'DocumentFiller', 'Refresh', 'TokenRefresh'],
+    'circuit_breaker.py': ['Refresh', 'TokenRefresh'],
+    'tiktok_fixtures.py': ['Refresh', 'TokenRefresh'],
+    'token_provider.py': ['Refresh', 'TokenRefresh'],
+    # The other functions have a storage.py without the client pool, which their workers don't use
+    'storage.py': ['DocumentFiller'],
+}
+
+def module_path(function_name, module):
+    return os.path.join(REPO_ROOT, function_name, 'utils', module)
+
+def out_of_date():
+    """Yields (module, function) for every copy that differs from the source."""
+    for module, functions in SHARED_MODULES.items():
+        source = module_path(SOURCE_FUNCTION, module)
+        for function_name in functions:
+            copy = module_path(function_name, module)
+            if not os.path.exists(copy) or not filecmp.cmp(source, copy, shallow=False):
+                yield module, function_name
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Copies the modules shared between functions from {SOURCE_FUNCTION}/utils into the other functions.")
+    parser.add_argument('--check', action='store_true', help="Only report copies that differ from the source, exiting with status 1 if any do")
+    args = parser.parse_args()
+
+    stale = list(out_of_date())
+    for module, function_name in stale:
+        if args.check:
+            print(f"{function_name}/utils/{module} differs from {SOURCE_FUNCTION}/utils/{module}")
+        else:
+            shutil.copyfile(module_path(SOURCE_FUNCTION, module), module_path(function_name, module))
+            print(f"Updated {function_name}/utils/{module}")
+    if args.check and stale:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+from datetime import datetime
+from metric_fixer import MetricsFixer
+
+class Entry:
+    def __init__(self, entry_id, data):
+        self.id = entry_id
+        self.reference = entry_id
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data)
+
+def test_compute_fixes_treats_null_counts_as_zero():
+    entries = [
+        Entry('a', {'timestamp': datetime(2024, 1, 1, 0, 0), 'view_count': 10, 'new_view_count': 0}),
+        Entry('b', {'timestamp': datetime(2024, 1, 1, 0, 30), 'view_count': None, 'new_view_count': None}),
+        Entry('c', {'timestamp': datetime(2024, 1, 1, 0, 45), 'view_count': 99}),
+        Entry('d', {'timestamp': datetime(2024, 1, 1, 1, 0), 'view_count': 25}),
+    ]
+
+    deletions, updates = MetricsFixer(db=None).compute_fixes(entries)
+
+    assert [entry.id for entry in deletions] == ['c']
+    assert [(entry.id, old, new) for entry, old, new in updates] == [('b', -1, 0), ('d', -1, 25)]